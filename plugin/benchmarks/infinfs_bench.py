@@ -0,0 +1,303 @@
+"""
+Benchmarks the InfinFS data path against a local S3 compatible server, e.g.
+
+    moto_server -p 5000 &
+    python benchmarks/infinfs_bench.py --endpoint-url http://127.0.0.1:5000 --generate
+
+or a MinIO server with its access keys in AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY.
+Generates a synthetic tree of objects under s3://<bucket>/<prefix>, then reports
+ops/sec, p50/p99 latency, bytes fetched and S3 calls for the parallel listing behind
+concurrent_core.list(), infin_download one object at a time and in a batch, and InfinFS
+getattr, readdir and open/read/release with a cold and a warm cache, and reads of only the
+first --read-size bytes of every file with the prefetcher running ahead of them.
+FUSE operations are called on the InfinFS object directly, no mount is needed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+
+class S3CallCounter:
+    """
+    Counts S3 API calls and GetObject bytes of every client created from the default session.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.bytes_fetched = 0
+
+    def install(self):
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register('after-call.s3', self.after_call)
+
+    def after_call(self, http_response=None, parsed=None, model=None, **kwargs):
+        with self.lock:
+            self.calls[model.name] += 1
+            if model.name == 'GetObject' and parsed:
+                self.bytes_fetched += int(parsed.get('ContentLength', 0))
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls), self.bytes_fetched
+
+
+class OpStats:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.bytes_read = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timed(self):
+        start = time.perf_counter()
+        yield
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(latency)
+
+    def add_bytes(self, nbytes):
+        with self.lock:
+            self.bytes_read += nbytes
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run_phase(name, counter, func, items, threads, batches=None):
+    ##Runs func(stats, item) for every item on threads workers, returns the phase report.
+    ##With batches, each batch of items completes before the next one starts
+    stats = OpStats(name)
+    calls_before, bytes_before = counter.snapshot()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for batch in batches or [items]:
+            for _ in executor.map(lambda item: func(stats, item), batch):
+                pass
+    elapsed = time.perf_counter() - start
+    calls_after, bytes_after = counter.snapshot()
+    calls_after.subtract(calls_before)
+    return {
+        'phase': name,
+        'ops': len(stats.latencies),
+        'seconds': round(elapsed, 4),
+        'ops_per_sec': round(len(stats.latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(stats.latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(stats.latencies, 99) * 1000, 3),
+        'bytes_read': stats.bytes_read,
+        'bytes_fetched': bytes_after - bytes_before,
+        's3_calls': {op: n for op, n in sorted(calls_after.items()) if n}
+    }
+
+
+def get_tree(prefix, depth, fanout, files_per_dir):
+    ##Returns the folders and object keys of a tree with fanout sub folders per level
+    folders = [prefix]
+    level = [prefix]
+    for d in range(depth):
+        level = ['{0}/d{1}-{2:03d}'.format(parent, d, i) for parent in level for i in range(fanout)]
+        folders.extend(level)
+    keys = ['{0}/f{1:05d}.bin'.format(folder, i) for folder in folders for i in range(files_per_dir)]
+    return folders, keys
+
+
+def generate_objects(client, bucket, keys, object_size, threads):
+    try:
+        client.create_bucket(Bucket=bucket)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    except client.exceptions.BucketAlreadyExists:
+        pass
+    body = os.urandom(object_size)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in executor.map(lambda key: client.put_object(Bucket=bucket, Key=key, Body=body), keys):
+            pass
+    print('Generated {0} objects of {1} bytes'.format(len(keys), object_size))
+
+
+def bench_listing(args, counter):
+    from concurrent_plugin import concurrent_listing
+    client = boto3.client('s3', config=Config(max_pool_connections=args.threads))
+
+    def list_all(stats, _):
+        with stats.timed():
+            columns = concurrent_listing.list_prefix(client, args.bucket, args.prefix,
+                                                     max_workers=args.threads)
+        stats.add_bytes(sum(columns.sizes))
+    return [run_phase('list_prefix', counter, list_all, [None], 1)]
+
+
+def bench_download(args, counter, keys, shadow_path):
+    from concurrent_plugin.infinfs import infin_download
+    client = boto3.client('s3', config=Config(max_pool_connections=args.threads))
+    download_dir = os.path.join(shadow_path, 'download')
+    os.makedirs(download_dir)
+
+    def download_one(stats, key):
+        local_path = os.path.join(download_dir, key.replace('/', '_'))
+        with stats.timed():
+            infin_download.download_one_object(local_path, args.bucket, key, None, client)
+        stats.add_bytes(os.path.getsize(local_path))
+        os.remove(local_path)
+
+    def download_batch(stats, batch):
+        downloads = [(args.bucket, key, os.path.join(download_dir, key.replace('/', '_'))) for key in batch]
+        with stats.timed():
+            infin_download.download_objects_batch(downloads, None, client)
+        for _, _, local_path in downloads:
+            stats.add_bytes(os.path.getsize(local_path))
+            os.remove(local_path)
+    return [run_phase('infin_download', counter, download_one, keys, args.threads),
+            run_phase('download_batch', counter, download_batch, [keys], 1)]
+
+
+def bench_infinfs(args, counter, folders, keys, shadow_path):
+    from concurrent_plugin.infinfs.infinfs import InfinFS
+    mount_specs = {
+        'mountpoint': os.path.join(shadow_path, 'mnt'),
+        'bucket': args.bucket,
+        'prefix': args.prefix
+    }
+    ifs = InfinFS(mount_specs, shadow_path=shadow_path, use_cache=False)
+    dirs = ['/' + folder[len(args.prefix):].lstrip('/') for folder in folders]
+    ##Like the kernel, look up a folder only after its parent has been read
+    levels = dict()
+    for path in dirs:
+        levels.setdefault(path.rstrip('/').count('/'), []).append(path)
+    dir_levels = [levels[depth] for depth in sorted(levels)]
+    files = ['/' + key[len(args.prefix):].lstrip('/') for key in keys]
+
+    def getattr_one(stats, path):
+        with stats.timed():
+            ifs.getattr(path)
+
+    def readdir_one(stats, path):
+        with stats.timed():
+            for _ in ifs.readdir(path, None):
+                pass
+
+    def read_one(stats, path):
+        with stats.timed():
+            fh = ifs.open(path, os.O_RDONLY)
+            offset = 0
+            while True:
+                data = ifs.read(path, args.read_size, offset, fh)
+                if not data:
+                    break
+                offset += len(data)
+            ifs.release(path, fh)
+        stats.add_bytes(offset)
+
+    results = []
+    for cache in ['cold', 'warm']:
+        results.append(run_phase('readdir_' + cache, counter, readdir_one, dirs, args.threads,
+                                  batches=dir_levels))
+        results.append(run_phase('getattr_' + cache, counter, getattr_one, files, args.threads))
+        results.append(run_phase('read_' + cache, counter, read_one, files, args.threads))
+    results.append(bench_head_prefetch(args, counter, mount_specs, files, shadow_path))
+    return results
+
+
+def bench_head_prefetch(args, counter, mount_specs, files, shadow_path):
+    ##A task reading only the head of each file in list order, on a cold mount with the
+    ##prefetcher on. bytes fetched shows whether prefetch downloads whole objects
+    from concurrent_plugin.infinfs.infinfs import InfinFS
+    from concurrent_plugin.infinfs.infin_prefetch import Prefetcher
+    ifs = InfinFS(mount_specs, shadow_path=os.path.join(shadow_path, 'prefetch'), use_cache=False)
+    ifs.prefetcher = Prefetcher(ifs, files)
+    ifs.prefetcher.start()
+
+    def read_head(stats, path):
+        with stats.timed():
+            fh = ifs.open(path, os.O_RDONLY)
+            data = ifs.read(path, args.read_size, 0, fh)
+            ifs.release(path, fh)
+        stats.add_bytes(len(data))
+    try:
+        return run_phase('read_head_prefetch', counter, read_head, files, 1)
+    finally:
+        ifs.prefetcher.stop()
+
+
+def print_report(results):
+    header = '{0:<20} {1:>8} {2:>10} {3:>10} {4:>10} {5:>14} {6:>14}  {7}'
+    print(header.format('phase', 'ops', 'ops/sec', 'p50 ms', 'p99 ms', 'bytes read', 'bytes fetched', 's3 calls'))
+    for r in results:
+        print(header.format(r['phase'], r['ops'], r['ops_per_sec'], r['p50_ms'], r['p99_ms'],
+                            r['bytes_read'], r['bytes_fetched'],
+                            ' '.join('{0}={1}'.format(op, n) for op, n in r['s3_calls'].items())))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='InfinFS data path benchmark')
+    parser.add_argument('--endpoint-url', required=True, help='S3 compatible endpoint, e.g. moto_server or MinIO')
+    parser.add_argument('--bucket', default='infinfs-bench')
+    parser.add_argument('--prefix', default='bench')
+    parser.add_argument('--generate', action='store_true', help='create the bucket and upload the tree first')
+    parser.add_argument('--depth', type=int, default=2, help='levels of sub folders')
+    parser.add_argument('--fanout', type=int, default=4, help='sub folders per folder')
+    parser.add_argument('--files-per-dir', type=int, default=25)
+    parser.add_argument('--object-size', type=int, default=256 * 1024)
+    parser.add_argument('--read-size', type=int, default=128 * 1024, help='bytes per read call')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--read-mode', choices=['block', 'whole'], help='INFINFS_READ_MODE for the InfinFS phases')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep the output of the code under test')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.prefix = args.prefix.strip('/')
+    ##Picked up by every boto3 client, including the ones created inside InfinFS
+    os.environ['AWS_ENDPOINT_URL_S3'] = args.endpoint_url
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    if args.read_mode:
+        os.environ['INFINFS_READ_MODE'] = args.read_mode
+
+    counter = S3CallCounter()
+    counter.install()
+    folders, keys = get_tree(args.prefix, args.depth, args.fanout, args.files_per_dir)
+    if args.generate:
+        generate_objects(boto3.client('s3', config=Config(max_pool_connections=args.threads)),
+                         args.bucket, keys, args.object_size, args.threads)
+
+    shadow_path = tempfile.mkdtemp(prefix='infinfs-bench-')
+    try:
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+            results = bench_listing(args, counter)
+            results.extend(bench_download(args, counter, keys, shadow_path))
+            results.extend(bench_infinfs(args, counter, folders, keys, shadow_path))
+    finally:
+        shutil.rmtree(shadow_path, ignore_errors=True)
+
+    print('{0} folders, {1} objects of {2} bytes, {3} threads'.format(
+        len(folders), len(keys), args.object_size, args.threads))
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'args': vars(args), 'results': results}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
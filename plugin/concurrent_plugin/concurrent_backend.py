@@ -11,6 +11,7 @@ from urllib.parse import urlparse
 import base64
 import uuid
 import concurrent_plugin.utils
+from concurrent_plugin import concurrent_upload
 from datetime import datetime
 
 # Use lazy % or % formatting in logging functionspylint(logging-format-interpolation)
@@ -52,6 +53,7 @@ verbose = True
 
 CONCURRENT_FUSE_MOUNT_BASE = '/mount_base_dir'
 MOUNT_SERVICE_READY_MARKER_FILE = os.path.join(CONCURRENT_FUSE_MOUNT_BASE,  '__service_ready__')
+MOUNT_SERVICE_SOCKET = os.path.join(CONCURRENT_FUSE_MOUNT_BASE,  '__mount_service__.sock')
 
 '''
 For running in k8s, invoke as 'mlflow run . -b infinstor-backend --backend-config kubernetes_config.json'
@@ -142,28 +144,16 @@ def upload_objects(run_id, bucket_name, path_in_bucket, local_path):
     if (verbose):
         _logger.info('upload_objects: Entered. bucket=' + bucket_name
                 + ', path_in_bucket=' + path_in_bucket + ', local_path=' + local_path)
+    path_in_bucket = path_in_bucket.rstrip('/')
     try:
-        for path, _, files in os.walk(local_path):
-            path = path.replace("\\","/")
-            directory_name = path.replace(local_path, "")
-            if directory_name.startswith('/.git'): # skip .git and subdirs
-                continue
-            for onefile in files:
-                src_path = os.path.join(path, onefile)
-                if (path_in_bucket.endswith('/')):
-                    path_in_bucket = path_in_bucket[:-1]
-                if (directory_name.startswith('/')):
-                    directory_name = directory_name[1:]
-                if (len(directory_name) > 0):
-                    dst_path = path_in_bucket + '/' + directory_name
-                else:
-                    dst_path = path_in_bucket
-                    dst_path = dst_path.rstrip('\n')
-                if (verbose):
-                    _logger.info('upload_objects: Uploading ' + src_path + ' to ' + dst_path)
-                tracking.MlflowClient().log_artifact(run_id, src_path, dst_path)
+        # skip .git and subdirs
+        all_files = concurrent_upload.list_local_files(local_path, skip_dir=lambda d: d.startswith('.git'))
+        if (verbose):
+            _logger.info('upload_objects: Uploading ' + str(len(all_files)) + ' files to ' + path_in_bucket)
+        concurrent_upload.upload_files(run_id, path_in_bucket, all_files)
     except Exception as err:
-        _logger.info(str(err))
+        _logger.error('upload_objects: Failed to upload ' + local_path + ': ' + str(err))
+        raise
 
 # Hack workaround for https://github.com/kubernetes-client/python/issues/2056
 class V1FixedPodFailurePolicyRule(kubernetes.client.V1PodFailurePolicyRule):
@@ -1,4 +1,5 @@
 import boto3
+from botocore.config import Config
 
 # traceback-with variables: https://pypi.org/project/traceback-with-variables/
 # Simplest usage in regular Python, for the whole program:
@@ -12,57 +13,82 @@ import mlflow
 import os
 import json
 import pandas as pd
-from concurrent_plugin.infinfs import infinmount
+from concurrent_plugin.infinfs import infinmount, infin_prefetch, mount_protocol
+from concurrent_plugin import concurrent_listing, concurrent_manifest, concurrent_upload
 from urllib.parse import urlparse
 import multiprocessing
 import glob
-import copy
 import re
-from io import StringIO
+import functools
 import socket
 import string
 import random
 import time
+import itertools
+import threading
+import atexit
+import uuid
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from concurrent_plugin.concurrent_backend import (
     CONCURRENT_FUSE_MOUNT_BASE,
-    MOUNT_SERVICE_READY_MARKER_FILE
+    MOUNT_SERVICE_SOCKET
 )
 
+##Concurrent LIST calls, and optional characters at which each folder listing is split
+##into key ranges that are listed in parallel, e.g. '0123456789abcdef' for hashed names
+CONCURRENT_LIST_WORKERS = int(os.environ.get('CONCURRENT_LIST_WORKERS', concurrent_listing.DEFAULT_LIST_WORKERS))
+CONCURRENT_LIST_SHARD_CHARS = os.environ.get('CONCURRENT_LIST_SHARD_CHARS')
+##Partitions of an input share one listing manifest, unless this is set to False
+USE_LISTING_MANIFEST = os.environ.get('USE_LISTING_MANIFEST') != 'False'
+CONCURRENT_MANIFEST_WAIT = int(os.environ.get('CONCURRENT_MANIFEST_WAIT', concurrent_manifest.DEFAULT_MANIFEST_WAIT_SECONDS))
+##Metadata csv files fetched and parsed concurrently
+CONCURRENT_METADATA_WORKERS = int(os.environ.get('CONCURRENT_METADATA_WORKERS', '8'))
+##Output metadata records are buffered and written as newline delimited JSON parts of up to
+##this many records, 0 writes a part for every call. Records are written at the latest
+##CONCURRENT_METADATA_FLUSH_SECONDS after their artifacts were uploaded
+CONCURRENT_METADATA_PART_RECORDS = int(os.environ.get('CONCURRENT_METADATA_PART_RECORDS', '10000'))
+CONCURRENT_METADATA_FLUSH_SECONDS = float(os.environ.get('CONCURRENT_METADATA_FLUSH_SECONDS', '30'))
+METADATA_FOLDER = '.concurrent/metadata'
+##Write time of each metadata record, orders the records of an output logged more than once
+METADATA_LOG_TIME = '_log_time'
+##Rows per DataFrame yielded by iter_list and iter_local_paths
+DEFAULT_ITER_CHUNKSIZE = 10000
+
+##run_id -> buffered metadata lines
+metadata_buffers = dict()
+metadata_lock = threading.Lock()
+metadata_part_prefix = uuid.uuid4().hex
+metadata_part_seq = 0
+metadata_flush_timer = None
+
 def _list_one_dir(client, bucket, prefix_in, arr):
     print("INFO: _list_one_dir: ", bucket, prefix_in)
-    paginator = client.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix_in, Delimiter="/")
-    for page in page_iterator:
-        contents = page.get('Contents')
-        if (contents != None):
-            print('Num keys = ' + str(len(contents)))
-            for one_content in contents:
-                if one_content['Key'].endswith('/'):
-                    ##Ignore folders
-                    continue
-                if 'Metadata' in one_content:
-                    md = json.loads(one_content['Metadata'])
-                else:
-                    md = {}
-                md['FileName'] = one_content['Key']
-                md['FileSize'] = one_content['Size']
-                md['FileLastModified'] = one_content['LastModified']
-                if 'versionId' in one_content:
-                    md['FileVersionId'] = one_content['versionId']
-                arr.append(md)
-
-        common_prefixes = page.get('CommonPrefixes')
-        if (common_prefixes != None):
-            for prefix in common_prefixes:
-                this_prefix = str(prefix['Prefix'])
-                if this_prefix:
-                    if not prefix_in.endswith('/') and this_prefix[len(prefix_in)] != '/':
-                        ## E.g. if two folders abc and abc_x are at the same level
-                        ##     and prefix_in is abc, only abc/ is considered, abc_x is ignored
-                        print(this_prefix + ' is not a subfolder of ' + prefix_in + ', ignoring')
-                        continue
-                    print('List recursively for  ' + this_prefix)
-                    _list_one_dir(client, bucket, this_prefix, arr)
+    columns = _list_prefix(client, bucket, prefix_in)
+    if len(columns):
+        arr.extend(columns.to_records())
+
+
+def _get_list_client(infinstor_time_spec, max_pool_connections=CONCURRENT_LIST_WORKERS):
+    ##Sized so that every worker gets its own pooled connection
+    config = Config(max_pool_connections=max_pool_connections)
+    if infinstor_time_spec:
+        return boto3.client('s3', infinstor_time_spec=infinstor_time_spec, config=config)
+    else:
+        return boto3.client('s3', config=config)
+
+
+def _list_prefix(client, bucket, prefix):
+    return concurrent_listing.list_prefix(client, bucket, prefix, max_workers=CONCURRENT_LIST_WORKERS,
+                                          shard_chars=CONCURRENT_LIST_SHARD_CHARS)
+
+
+def _iter_prefix(client, bucket, prefix, chunksize):
+    for columns in concurrent_listing.iter_prefix_columns(client, bucket, prefix, chunksize,
+                                                          max_workers=CONCURRENT_LIST_WORKERS,
+                                                          shard_chars=CONCURRENT_LIST_SHARD_CHARS):
+        yield columns.to_dataframe()
 
 
 def _get_artifact_info_from_run(run_info, input_spec=None):
@@ -97,7 +123,56 @@ def _load_input_spec(input_spec):
     return bucket, prefix, time_spec
 
 
-def _load_local_csv_metadata(request_path):
+def _open_local_file(path):
+    return open(path, 'rb')
+
+
+def _open_s3_object(client, bucket, key):
+    return client.get_object(Bucket=bucket, Key=key)['Body']
+
+
+def _read_csv(opener):
+    with closing(opener()) as fh:
+        return pd.read_csv(fh, sep=",")
+
+
+def _iter_csv_chunks(openers, chunksize, max_workers):
+    ##Up to max_workers files are opened ahead of the one being parsed
+    openers = iter(openers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(opener) for opener in itertools.islice(openers, max_workers))
+        try:
+            while pending:
+                fh = pending.popleft().result()
+                next_opener = next(openers, None)
+                if next_opener:
+                    pending.append(executor.submit(next_opener))
+                with closing(fh):
+                    for df in pd.read_csv(fh, sep=",", chunksize=chunksize):
+                        if not df.empty:
+                            yield df
+        finally:
+            ##A parse error or an abandoned iterator leaves files opened ahead
+            for future in pending:
+                if not future.cancel() and not future.exception():
+                    future.result().close()
+
+
+def _read_csv_files(openers, chunksize=None, max_workers=CONCURRENT_METADATA_WORKERS):
+    ##openers return binary file objects, which are parsed without an intermediate copy.
+    ##Returns one DataFrame, or an iterator of DataFrames of up to chunksize rows
+    if chunksize:
+        return _iter_csv_chunks(openers, chunksize, max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        data_frames = [df for df in executor.map(_read_csv, openers) if not df.empty]
+
+    ##Merge all dataframes
+    if not data_frames:
+        return pd.DataFrame()
+    return pd.concat(data_frames, ignore_index=True)
+
+
+def _load_local_csv_metadata(request_path, chunksize=None):
     if os.path.isdir(request_path):
         all_files = []
         for root, dirnames, filenames in os.walk(request_path):
@@ -109,37 +184,27 @@ def _load_local_csv_metadata(request_path):
         all_files = [request_path]
 
     print(all_files)
-    data_frames = []
+    openers = []
     for f in all_files:
         print('processing file: ', f)
         if f.lower().endswith('.csv'):
-            with open(f, "r") as infh:
-                df = pd.read_csv(StringIO(infh.read()), sep=",")
-                if not df.empty:
-                    data_frames.append(df)
+            openers.append(functools.partial(_open_local_file, f))
+    return _read_csv_files(openers, chunksize)
 
-    ##Merge all dataframes
-    combined_df = pd.concat(data_frames, ignore_index=True)
-    return combined_df
 
-
-def _load_csv_metadata(path, input_name=None):
+def _load_csv_metadata(path, input_name=None, chunksize=None):
+    ##Returns a DataFrame, or with chunksize an iterator of DataFrames
     ##Override input with runtime inputspec
     input_spec_list = infinmount.get_input_spec_json(input_name=input_name)
     #print("Input specs for metadata: ", input_spec_list)
     if not input_spec_list:
         ##Fallback to default local files
-        return _load_local_csv_metadata(path)
-    data_frames = []
-    all_keys = set()
-    storage_spec_list = []
+        return _load_local_csv_metadata(path, chunksize)
+    openers = []
     for input_spec in input_spec_list:
         print("Processing input spec: ", input_spec)
         bucket, prefix, infinstor_time_spec = _load_input_spec(input_spec)
-        if infinstor_time_spec:
-            client = boto3.client('s3', infinstor_time_spec=infinstor_time_spec)
-        else:
-            client = boto3.client('s3')
+        client = _get_list_client(infinstor_time_spec, CONCURRENT_METADATA_WORKERS)
         ##read csv files at the bucket/prefix
         remote_folder = prefix
         paginator = client.get_paginator('list_objects_v2')
@@ -150,15 +215,8 @@ def _load_csv_metadata(path, input_name=None):
                 for one_content in contents:
                     key = one_content['Key']
                     if key.endswith('.csv'):
-                        data = client.get_object(Bucket=bucket, Key=key)
-                        csv_meta = data['Body'].read()
-                        df = pd.read_csv(StringIO(csv_meta), sep=",")
-                        if not df.empty:
-                            data_frames.append(df)
-
-    ##Merge all dataframes
-    combined_df = pd.concat(data_frames, ignore_index=True)
-    return combined_df
+                        openers.append(functools.partial(_open_s3_object, client, bucket, key))
+    return _read_csv_files(openers, chunksize)
 
 
 def __list_local_data_files(request_path):
@@ -185,22 +243,8 @@ def list(path, input_name=None):
     storage_spec_list = []
     for input_spec in input_spec_list:
         print("Processing input spec: ", input_spec)
-        arr = []
         bucket, prefix, infinstor_time_spec = _load_input_spec(input_spec)
-        if infinstor_time_spec:
-            client = boto3.client('s3', infinstor_time_spec=infinstor_time_spec)
-        else:
-            client = boto3.client('s3')
-        if input_spec['type'] == 'mlflow-run-artifacts':
-            metadata_found = _load_mlflow_artifacts_metadata(bucket, prefix, arr)
-            if not metadata_found:
-                print("No metadata file found, extracting objects")
-                _list_one_dir(client, bucket, prefix, arr)
-            else:
-                print("Loaded metadata file")
-        else:
-            _list_one_dir(client, bucket, prefix, arr)
-        df = pd.DataFrame(arr)
+        df = _list_input_with_manifest(input_spec, bucket, prefix, infinstor_time_spec)
         if df.empty:
             print(f"No data found for input spec {input_spec}... Skipping")
             continue
@@ -227,6 +271,169 @@ def list(path, input_name=None):
         return _combine_and_filter_dataframes(data_frames, input_spec_list, all_keys, storage_spec_list)
 
 
+def _list_input(input_spec, bucket, prefix, infinstor_time_spec):
+    client = _get_list_client(infinstor_time_spec)
+    if input_spec['type'] == 'mlflow-run-artifacts':
+        df = _load_mlflow_artifacts_metadata(bucket, prefix)
+        if df.empty:
+            print("No metadata file found, extracting objects")
+            return _list_prefix(client, bucket, prefix).to_dataframe()
+        else:
+            print("Loaded metadata file")
+            return df
+    else:
+        return _list_prefix(client, bucket, prefix).to_dataframe()
+
+
+def _iter_input(input_spec, bucket, prefix, infinstor_time_spec, chunksize):
+    ##Chunks have the partitioning_key column that list adds
+    keygen_src = input_spec.get('partition_keygen')
+    if input_spec['type'] == 'mlflow-run-artifacts':
+        df = _load_mlflow_artifacts_metadata(bucket, prefix)
+        if not df.empty:
+            print("Loaded metadata file")
+            for start in range(0, df.shape[0], chunksize):
+                chunk = df[start:start + chunksize].reset_index(drop=True)
+                _apply_keygen(chunk, keygen_src)
+                yield chunk
+            return
+        print("No metadata file found, extracting objects")
+    client = _get_list_client(infinstor_time_spec)
+    for df in _iter_prefix(client, bucket, prefix, chunksize):
+        _apply_keygen(df, keygen_src)
+        yield df
+
+
+def _iter_dataframe(df, chunksize):
+    for start in range(0, df.shape[0], chunksize):
+        yield df[start:start + chunksize]
+
+
+def iter_list(path, input_name=None, chunksize=DEFAULT_ITER_CHUNKSIZE):
+    """
+    Lazy version of list, yields the listing as DataFrames of up to chunksize rows while
+    it is being listed. Partitioned inputs need the keys of the whole listing to pick this
+    partition's rows, they are listed in full before the first DataFrame is yielded.
+    """
+    input_spec_list = infinmount.get_input_spec_json(input_name=input_name)
+    if not input_spec_list or any('parallelization_schedule' in spec for spec in input_spec_list):
+        yield from _iter_dataframe(list(path, input_name=input_name), chunksize)
+        return
+    for input_spec in input_spec_list:
+        print("Processing input spec: ", input_spec)
+        bucket, prefix, infinstor_time_spec = _load_input_spec(input_spec)
+        yield from _iter_input(input_spec, bucket, prefix, infinstor_time_spec, chunksize)
+
+
+def iter_local_paths(path, input_name=None, chunksize=DEFAULT_ITER_CHUNKSIZE):
+    """
+    Lazy version of list followed by get_local_paths. Yields DataFrames of up to chunksize
+    listing rows with an added LocalPath column. Each input is mounted before its first
+    rows are listed, so the files can be read as soon as they are yielded.
+    """
+    input_spec_list = infinmount.get_input_spec_json(input_name=input_name)
+    if not input_spec_list or any('parallelization_schedule' in spec for spec in input_spec_list):
+        df = list(path, input_name=input_name)
+        if df.empty:
+            return
+        df['LocalPath'] = get_local_paths(df)
+        yield from _iter_dataframe(df, chunksize)
+        return
+    mount_path = os.path.join(CONCURRENT_FUSE_MOUNT_BASE,
+                              ''.join(random.choices(string.ascii_letters + string.digits, k=10)))
+    shadow_path, use_cache = _get_mount_options()
+    for i, input_spec in enumerate(input_spec_list):
+        print("Processing input spec: ", input_spec)
+        bucket, prefix, infinstor_time_spec = _load_input_spec(input_spec)
+        m_path = os.path.join(mount_path, "part-" + str(i))
+        os.makedirs(m_path, exist_ok=True)
+        m_spec = {
+            'bucket': bucket,
+            'prefix': prefix.strip('/'),
+            'input_spec_type': input_spec['type'],
+            'mountpoint': m_path
+        }
+        if infinstor_time_spec:
+            m_spec['infinstor_time_spec'] = infinstor_time_spec
+        mount_request(m_path, m_spec, shadow_path, use_cache)
+        cloud_prefix_len = len(m_spec['prefix']) + 1
+        for df in _iter_input(input_spec, bucket, prefix, infinstor_time_spec, chunksize):
+            df['LocalPath'] = [os.path.join(m_path, fpath[cloud_prefix_len:]) for fpath in df['FileName']]
+            yield df
+
+
+def _get_parent_run_artifact_info():
+    if 'MLFLOW_RUN_ID' not in os.environ:
+        return None, None
+    client = mlflow.tracking.MlflowClient()
+    run = client.get_run(os.environ['MLFLOW_RUN_ID'])
+    parent_run_id = run.data.tags.get('mlflow.parentRunId')
+    if not parent_run_id:
+        return None, None
+    return _get_artifact_info_from_run(client.get_run(parent_run_id))
+
+
+def _list_input_with_manifest(input_spec, bucket, prefix, infinstor_time_spec):
+    ##Every partition of an input lists the same prefix. The partition that claims the manifest
+    ##lists it once and writes the manifest under the parent run's artifacts, the others load it
+    psched = input_spec.get('parallelization_schedule')
+    if not USE_LISTING_MANIFEST or not psched or psched[0] != 'default':
+        return _list_input(input_spec, bucket, prefix, infinstor_time_spec)
+    try:
+        manifest_bucket, artifact_prefix = _get_parent_run_artifact_info()
+    except Exception as ex:
+        print('Listing manifest disabled, failed to find the parent run: ' + str(ex))
+        manifest_bucket = None
+    if not manifest_bucket:
+        return _list_input(input_spec, bucket, prefix, infinstor_time_spec)
+    manifest_key = concurrent_manifest.get_manifest_key(artifact_prefix, bucket, prefix,
+                                                        infinstor_time_spec, input_spec['type'])
+    client = boto3.client('s3')
+    try:
+        df = concurrent_manifest.load_manifest(client, manifest_bucket, manifest_key)
+    except concurrent_manifest.ManifestUnavailable as ex:
+        print(str(ex) + ', listing input')
+        return _list_input(input_spec, bucket, prefix, infinstor_time_spec)
+    if df is not None:
+        print('Loaded listing manifest ' + manifest_key)
+        return df
+    ##Whichever partition starts first lists, so a late or evicted partition 0 stalls nobody
+    claimed = concurrent_manifest.claim_manifest(client, manifest_bucket, manifest_key,
+                                                 'partition {0}'.format(psched[2]))
+    if claimed is None:
+        return _list_input(input_spec, bucket, prefix, infinstor_time_spec)
+    if claimed:
+        ##Always leaves a manifest, empty or a failure marker, so that the others never wait in vain
+        try:
+            df = _list_input(input_spec, bucket, prefix, infinstor_time_spec)
+        except Exception as ex:
+            try:
+                concurrent_manifest.save_manifest_failure(client, manifest_bucket, manifest_key, str(ex))
+            except Exception as marker_ex:
+                print('Failed to write listing manifest failure marker: ' + str(marker_ex))
+            raise
+        try:
+            concurrent_manifest.save_manifest(client, manifest_bucket, manifest_key, df)
+        except Exception as ex:
+            print('Failed to write listing manifest: ' + str(ex))
+            try:
+                concurrent_manifest.save_manifest_failure(client, manifest_bucket, manifest_key, str(ex))
+            except Exception as marker_ex:
+                print('Failed to write listing manifest failure marker: ' + str(marker_ex))
+        return df
+    try:
+        df = concurrent_manifest.wait_for_manifest(client, manifest_bucket, manifest_key,
+                                                      CONCURRENT_MANIFEST_WAIT)
+    except concurrent_manifest.ManifestUnavailable as ex:
+        print(str(ex) + ', listing input')
+        return _list_input(input_spec, bucket, prefix, infinstor_time_spec)
+    if df is not None:
+        print('Loaded listing manifest ' + manifest_key)
+        return df
+    print('No listing manifest from the claiming partition, listing input')
+    return _list_input(input_spec, bucket, prefix, infinstor_time_spec)
+
+
 def _combine_and_filter_dataframes(data_frames, input_spec_list, all_keys, storage_spec_list):
     df_to_keep = []
     storage_specs_to_keep = []
@@ -260,67 +467,111 @@ def _filter_df_for_partition(df, input_spec, all_keys):
     return df
 
 
-def mount_request(mount_path, mount_spec, shadow_path, use_cache):
-    ##Check if mount service is ready
+##Connection to the mount service, kept open for all mount requests of this process
+mount_service_conn = None
+mount_request_id = 0
+
+
+def _connect_mount_service():
+    ##Wait for the mount service to listen on its socket
     max_wait_time = 3*60
     start = time.time()
-    while time.time() - start <= max_wait_time:
-        if os.path.exists(MOUNT_SERVICE_READY_MARKER_FILE):
+    while True:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(MOUNT_SERVICE_SOCKET)
             print('Mount service available')
-            break
-        else:
-            print('Wait for mount service to be ready')
-            time.sleep(10)
+            return s
+        except OSError as ex:
+            s.close()
+            if time.time() - start > max_wait_time:
+                print('ERROR: No mount service available')
+                raise Exception("No mount service available")
+            if time.time() - start < 1:
+                print('Wait for mount service to be ready: ' + str(ex))
+            time.sleep(0.5)
+
+
+def mount_requests(mount_reqs, on_mount=None):
+    ##Sends all mount requests in one message. on_mount(mount_path, status, error) is called
+    ##for each mount as the service completes it, in completion order
+    global mount_service_conn, mount_request_id
+    if mount_service_conn is None:
+        mount_service_conn = _connect_mount_service()
+    mount_request_id += 1
+    req = {'op': 'mount', 'id': mount_request_id, 'mounts': mount_reqs}
+    print('Sending mount request: ', req)
+    failures = []
+    try:
+        mount_protocol.send_message(mount_service_conn, req)
+        while True:
+            response = mount_protocol.recv_message(mount_service_conn)
+            if response is None:
+                raise Exception('Mount service closed the connection')
+            if response['status'] == mount_protocol.STATUS_DONE:
+                break
+            if response['status'] == mount_protocol.STATUS_SUCCESS:
+                print('Mount created successfully: ' + response['mount_path'])
+            else:
+                print('Mount failed: {0}: {1}'.format(response['mount_path'], response.get('error')))
+                failures.append('{0}: {1}'.format(response['mount_path'], response.get('error')))
+            if on_mount:
+                on_mount(response['mount_path'], response['status'], response.get('error'))
+    except Exception:
+        ##The connection is in an unknown state, reconnect on the next request
+        mount_service_conn.close()
+        mount_service_conn = None
+        raise
+    if failures:
+        raise Exception('Failed to create mount: ' + '; '.join(failures))
+
+
+def mount_request(mount_path, mount_spec, shadow_path, use_cache):
+    mount_requests([mount_protocol.get_mount_request(mount_path, mount_spec, shadow_path, use_cache)])
+
+
+def _get_mount_options():
+    if os.environ.get('USE_DATA_CACHE') == 'False':
+        use_cache = False
     else:
-        print('ERROR: No mount service available')
-        raise Exception("No mount service available")
-
-    req = {
-        'mount_path': mount_path,
-        'mount_spec': mount_spec,
-        'shadow_path': shadow_path if shadow_path else 'None',
-        'use_cache': 'True' if use_cache else 'False'
-    }
-    req_data = json.dumps(req).encode('utf-8')
-
-    HOST = "127.0.0.1"  # Standard loopback interface address (localhost)
-    PORT = 7963  # Port to listen on (non-privileged ports are > 1023)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        print('Sending mount request: ', req_data)
-        s.connect((HOST, PORT))
-        s.sendall(req_data)
-        response = s.recv(1024)
-        response = response.decode('utf-8')
-        if response == 'success':
-            print('Mount created successfully')
-            return
-        else:
-            print('Mount failed: ' + response)
-            raise Exception('Failed to create mount: '+response)
+        use_cache = True
 
+    if 'SHARED_DATA_VOLUME' in os.environ:
+        shadow_path = os.environ['SHARED_DATA_VOLUME']
+    else:
+        shadow_path = None
+    return shadow_path, use_cache
 
-def _perform_mount_for_mount_spec(df, mount_spec, mount_path):
+
+def _prepare_mount_for_mount_spec(df, mount_spec, mount_path):
+    ##Returns the local paths of the files in df under mount_path, and the mount request
     path_list = df['FileName'].tolist()
     # replace the cloud prefix by mounted path
     cloud_prefix = mount_spec['prefix']
     cloud_prefix_len = len(cloud_prefix) + 1
     local_file_list = []
+    relative_file_list = []
     for fpath in path_list:
         local_path = os.path.join(mount_path, fpath[cloud_prefix_len:])
         local_file_list.append(local_path)
+        relative_file_list.append(fpath[cloud_prefix_len:])
 
-    if os.environ.get('USE_DATA_CACHE') == 'False':
-        use_cache = False
-    else:
-        use_cache = True
+    shadow_path, use_cache = _get_mount_options()
 
-    if 'SHARED_DATA_VOLUME' in os.environ:
-        shadow_path = os.environ['SHARED_DATA_VOLUME']
-    else:
-        shadow_path = None
+    if os.environ.get('USE_DATA_PREFETCH') != 'False':
+        ##The mount prefetches files in the order this partition will read them.
+        ##The list is written next to the mountpoint, which is visible to the mount service
+        prefetch_list = os.path.join(os.path.dirname(mount_path),
+                                     '.prefetch-' + os.path.basename(mount_path))
+        infin_prefetch.write_prefetch_list(prefetch_list, relative_file_list)
+        mount_spec['prefetch_list'] = prefetch_list
+
+    return local_file_list, mount_protocol.get_mount_request(mount_path, mount_spec, shadow_path, use_cache)
 
-    mount_request(mount_path, mount_spec, shadow_path, use_cache)
 
+def _perform_mount_for_mount_spec(df, mount_spec, mount_path):
+    local_file_list, mount_req = _prepare_mount_for_mount_spec(df, mount_spec, mount_path)
+    mount_requests([mount_req])
     return local_file_list
 
 
@@ -339,22 +590,22 @@ def get_local_paths(df):
                               ''.join(random.choices(string.ascii_letters + string.digits, k=10)))
 
     all_local_files = []
+    mount_reqs = []
     for i, m_spec in enumerate(mount_specs):
         m_path = os.path.join(mount_path, "part-" + str(i))
         os.makedirs(m_path, exist_ok=True)
         m_spec['mountpoint'] = m_path
         rb = m_spec['row_start']
         re = rb + m_spec['num_rows']
-        local_file_list = _perform_mount_for_mount_spec(df[rb:re], m_spec, m_path)
+        local_file_list, mount_req = _prepare_mount_for_mount_spec(df[rb:re], m_spec, m_path)
         all_local_files.extend(local_file_list)
+        mount_reqs.append(mount_req)
+    ##All mounts in one round trip, the mount service creates them concurrently
+    mount_requests(mount_reqs)
     return all_local_files
 
 
-def _log_metadata(local_path, artifact_path, **kwargs):
-    ##kwargs are treated as metadata.
-    print('Emitting output#')
-    print(local_path, artifact_path, kwargs)
-    metadata = kwargs
+def _get_active_run():
     active_run = mlflow.active_run()
     if not active_run and 'MLFLOW_RUN_ID' in os.environ:
         current_run_id = os.environ['MLFLOW_RUN_ID']
@@ -362,93 +613,196 @@ def _log_metadata(local_path, artifact_path, **kwargs):
         active_run = client.get_run(current_run_id)
     if not active_run:
         raise Exception("No mlflow run found in context")
+    return active_run
+
+
+def _write_metadata_part(run_id, lines):
+    global metadata_part_seq
+    with metadata_lock:
+        metadata_part_seq += 1
+        part_name = '{0}-{1:05d}.ndjson'.format(metadata_part_prefix, metadata_part_seq)
+    metadata_tmp_local = os.path.join(tempfile.mkdtemp(), part_name)
+    with open(metadata_tmp_local, "w") as fh:
+        fh.writelines(lines)
+    print("Log metadata: ", metadata_tmp_local, METADATA_FOLDER, len(lines))
+    mlflow.tracking.MlflowClient().log_artifact(run_id, metadata_tmp_local, METADATA_FOLDER)
+    os.remove(metadata_tmp_local)
+
+
+def _flush_metadata(run_id=None, min_records=0):
+    ##Writes the buffered metadata of run_id, or of all runs, if at least min_records are buffered
+    with metadata_lock:
+        run_ids = [run_id] if run_id else [rid for rid in metadata_buffers]
+        parts = []
+        for rid in run_ids:
+            lines = metadata_buffers.get(rid)
+            if lines and len(lines) >= min_records:
+                parts.append((rid, metadata_buffers.pop(rid)))
+    for rid, lines in parts:
+        _write_metadata_part(rid, lines)
+
+
+def _flush_metadata_after_upload(run_id):
+    ##Full parts are written right away, the rest by a timer so it is not held until exit
+    global metadata_flush_timer
+    _flush_metadata(run_id, min_records=max(CONCURRENT_METADATA_PART_RECORDS, 1))
+    with metadata_lock:
+        if not metadata_buffers or metadata_flush_timer:
+            return
+        metadata_flush_timer = threading.Timer(CONCURRENT_METADATA_FLUSH_SECONDS, _on_metadata_flush_timer)
+        metadata_flush_timer.daemon = True
+        metadata_flush_timer.start()
+
+
+def _on_metadata_flush_timer():
+    global metadata_flush_timer
+    with metadata_lock:
+        metadata_flush_timer = None
+    try:
+        _flush_metadata()
+    except Exception as ex:
+        print('Failed to write output metadata: ' + str(ex))
+
+
+def _flush_metadata_at_exit():
+    if metadata_flush_timer:
+        metadata_flush_timer.cancel()
+    _flush_metadata()
+
+
+##Final flush of the metadata still buffered when the task exits
+atexit.register(_flush_metadata_at_exit)
+
+
+def _log_metadata(local_path, artifact_path, **kwargs):
+    ##kwargs are treated as metadata.
+    print('Emitting output#')
+    print(local_path, artifact_path, kwargs)
+    metadata = kwargs
+    active_run = _get_active_run()
     bucket, prefix = _get_artifact_info_from_run(active_run)
+    run_id = active_run.info.run_id
     all_files = glob.iglob(local_path, recursive=True)
-    all_metadata = []
+    log_time = time.time()
+    lines = []
     for fpath in all_files:
-        md = copy.deepcopy(metadata)
         remote_path = os.path.join(prefix, artifact_path, os.path.basename(fpath))
+        ##Serialized right away, later changes to the metadata values are not picked up
+        md = dict(metadata)
         md['FileName'] = remote_path
-        all_metadata.append(md)
+        md[METADATA_LOG_TIME] = log_time
+        lines.append(json.dumps(md) + '\n')
 
-    meta_file_name = artifact_path.replace('/', '__') + "__" + os.path.basename(local_path) + ".json"
-    metadata_tmp_local = os.path.join(tempfile.mkdtemp(), meta_file_name)
-    os.makedirs(os.path.dirname(metadata_tmp_local), exist_ok=True)
-    with open(metadata_tmp_local, "w") as fh:
-        json.dump(all_metadata, fh)
-    print("Log metadata: ", metadata_tmp_local, ".concurrent/metadata")
-    mlflow.log_artifact(metadata_tmp_local, ".concurrent/metadata")
+    if not lines:
+        print('No files match ' + local_path)
+        return None
+    with metadata_lock:
+        metadata_buffers.setdefault(run_id, []).extend(lines)
+    return run_id
 
 
 def concurrent_log_artifact(local_path, artifact_path, **kwargs):
     ##kwargs are treated as metadata.
-    _log_metadata(local_path, artifact_path, **kwargs)
     print("Log data output: ", local_path, artifact_path)
     mlflow.log_artifact(local_path, artifact_path)
+    ##Only the metadata of uploaded artifacts is buffered
+    run_id = _log_metadata(local_path, artifact_path, **kwargs)
+    if run_id:
+        _flush_metadata_after_upload(run_id)
 
 
 def concurrent_log_artifacts(local_dir, artifact_path, **kwargs):
     ##kwargs are treated as metadata.
-    _log_metadata(local_dir, artifact_path, **kwargs)
     print("Log data output: ", local_dir, artifact_path)
-    mlflow.log_artifacts(local_dir, artifact_path)
-
-
-def _load_mlflow_artifacts_metadata(bucket, prefix, arr):
-    client = boto3.client('s3')
-    remote_folder = os.path.join(prefix, ".concurrent/metadata/")
+    ##Same layout as mlflow.log_artifacts, uploaded in parallel
+    all_files = concurrent_upload.list_local_files(local_dir)
+    concurrent_upload.upload_files(_get_active_run().info.run_id, artifact_path, all_files)
+    ##The whole batch is uploaded, write its metadata
+    run_id = _log_metadata(local_dir, artifact_path, **kwargs)
+    if run_id:
+        _flush_metadata(run_id)
+
+
+def _read_metadata_object(opener, key):
+    with closing(opener()) as fh:
+        if key.endswith('.ndjson'):
+            return pd.read_json(fh, lines=True, dtype=False, convert_dates=False)
+        ##One JSON list per file, written by earlier versions
+        return pd.DataFrame(json.load(fh))
+
+
+def _load_mlflow_artifacts_metadata(bucket, prefix):
+    ##Returns the output metadata of a run as one DataFrame, empty if there is none
+    client = _get_list_client(None, CONCURRENT_METADATA_WORKERS)
+    remote_folder = os.path.join(prefix, METADATA_FOLDER) + '/'
     paginator = client.get_paginator('list_objects_v2')
     page_iterator = paginator.paginate(Bucket=bucket, Prefix=remote_folder, Delimiter="/")
-    all_metadata = []
+    keys = []
     for page in page_iterator:
         contents = page.get('Contents')
         if contents:
             for one_content in contents:
                 key = one_content['Key']
-                if key.endswith('.json'):
-                    data = client.get_object(Bucket=bucket, Key=key)
-                    meta_object = data['Body'].read()
-                    metadata = json.loads(meta_object.decode("utf-8"))
-                    all_metadata = all_metadata + metadata
-    arr.extend(all_metadata)
-    return bool(all_metadata)
+                if key.endswith('.json') or key.endswith('.ndjson'):
+                    keys.append(key)
+    if not keys:
+        return pd.DataFrame()
+    with ThreadPoolExecutor(max_workers=CONCURRENT_METADATA_WORKERS) as executor:
+        data_frames = [df for df in executor.map(
+            lambda key: _read_metadata_object(functools.partial(_open_s3_object, client, bucket, key), key),
+            keys) if not df.empty]
+    if not data_frames:
+        return pd.DataFrame()
+    df = pd.concat(data_frames, ignore_index=True)
+    ##An output logged again replaces its earlier metadata. The order of the parts is random,
+    ##the records are ordered by their write time, records written by earlier versions first
+    if METADATA_LOG_TIME in df.columns:
+        df = df.sort_values(METADATA_LOG_TIME, kind='stable', na_position='first') \
+            .drop(columns=[METADATA_LOG_TIME])
+    return df.drop_duplicates('FileName', keep='last', ignore_index=True)
 
 
 def _default_partitioner_filter(df, all_keys, num_bins, index):
     if not all_keys:
         print("Warning: No filtering applied")
         return df
-    key_subset = set()
-    for i, key in enumerate(all_keys):
-        if i % num_bins == index:
-            key_subset.add(key)
-    filtered_df = df[df.apply(lambda row: row['partitioning_key'] in key_subset, axis=1)]
+    ##all_keys is sorted, the position of a key in it decides its bin
+    key_positions = pd.Categorical(df['partitioning_key'], categories=all_keys).codes
+    keep = (key_positions >= 0) & (key_positions % num_bins == index)
+    filtered_df = df[keep]
     return filtered_df
 
 
+def _get_directory_keys(file_names):
+    ##Vectorized os.path.basename(os.path.dirname(name))
+    return file_names.str.extract(r'([^/]*)/+[^/]*$', expand=False).fillna('')
+
+
 def _apply_keygen(df, keygen_src):
     print("Keygen function for partitioning:", keygen_src)
+    keygen_func = None
     if not keygen_src:
         if 'partitioning_key' in df.columns:
-            keygen_func = lambda row : row['partitioning_key']
+            keys = df['partitioning_key']
         else:
             ##By default we use object partitioning
-            keygen_func = lambda row: row['FileName']
+            keys = df['FileName']
     elif keygen_src == 'directory':
-        keygen_func = lambda row : os.path.basename(os.path.dirname(row['FileName']))
+        keys = _get_directory_keys(df['FileName'].astype(str))
     elif keygen_src == 'custom':
         keygen_func = eval(keygen_src)
     elif keygen_src == 'object':
-        keygen_func = lambda row: row['FileName']
+        keys = df['FileName']
     elif keygen_src == 'broadcast':
         ##No partitioning, same data is partitioned for all parallel instances
         return []
     else:
         keygen_func = eval(keygen_src)
-    keydf = pd.DataFrame([])
-    keydf['partitioning_key'] = df.apply(lambda row: keygen_func(row), axis = 1)
-    df['partitioning_key'] = keydf['partitioning_key']
-    return sorted(keydf['partitioning_key'].unique())
+    if keygen_func:
+        ##Custom keygens work on one row at a time
+        keys = df.apply(lambda row: keygen_func(row), axis = 1)
+    df['partitioning_key'] = keys
+    return sorted(pd.unique(df['partitioning_key']))
 
 def download_remote_path(run_id, path, tmpdir):
     experiment_id = mlflow.get_run(run_id=run_id).info.experiment_id
@@ -0,0 +1,267 @@
+import json
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+
+##Entries per list_objects_v2 page, keys and common prefixes both count against it
+LIST_PAGE_SIZE = 1000
+DEFAULT_LIST_WORKERS = 16
+##Folders listed ahead of the depth first walk, their listings are held until they are walked
+DEFAULT_MAX_LISTED_FOLDERS = 64
+
+##Largest code point, sorts after any character that can follow it in a key
+MAX_CHAR = '\U0010FFFF'
+
+
+class ListingColumns:
+    """
+    Columnar listing result, one list per column, in listing order.
+    """
+    def __init__(self):
+        self.keys = []
+        self.sizes = []
+        self.mtimes = []
+        self.version_ids = None
+        self.metadata = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def extend(self, rows):
+        ##rows are (key, size, last_modified, version_id, metadata) tuples
+        for key, size, mtime, version_id, md in rows:
+            num_rows = len(self.keys)
+            self.keys.append(key)
+            self.sizes.append(size)
+            self.mtimes.append(mtime)
+            if version_id is not None or self.version_ids is not None:
+                if self.version_ids is None:
+                    self.version_ids = [None] * num_rows
+                self.version_ids.append(version_id)
+            if md or self.metadata is not None:
+                if self.metadata is None:
+                    self.metadata = dict()
+                for name in (md or {}):
+                    if name not in self.metadata:
+                        self.metadata[name] = [None] * num_rows
+                for name, values in self.metadata.items():
+                    values.append((md or {}).get(name))
+
+    def to_dataframe(self):
+        columns = dict()
+        if self.metadata:
+            columns.update(self.metadata)
+        columns['FileName'] = self.keys
+        columns['FileSize'] = self.sizes
+        columns['FileLastModified'] = self.mtimes
+        if self.version_ids is not None:
+            columns['FileVersionId'] = self.version_ids
+        if not self.keys:
+            return pd.DataFrame()
+        return pd.DataFrame(columns)
+
+    def to_records(self):
+        return self.to_dataframe().to_dict('records')
+
+
+def _get_shard_ranges(prefix, shard_chars):
+    ##[lower, upper) key ranges that split the listing of prefix by the next character
+    if not shard_chars:
+        return [(None, None)]
+    boundaries = sorted(set(shard_chars))
+    ranges = []
+    lower = None
+    for ch in boundaries:
+        ranges.append((lower, prefix + ch))
+        lower = prefix + ch
+    ranges.append((lower, None))
+    return ranges
+
+
+def _content_row(one_content):
+    if 'Metadata' in one_content:
+        md = json.loads(one_content['Metadata'])
+    else:
+        md = None
+    return (one_content['Key'], one_content['Size'], one_content['LastModified'],
+            one_content.get('versionId'), md)
+
+
+def _list_dir_range(client, bucket, prefix, lower, upper):
+    ##Lists one directory level, returns the pages as (content rows, sub prefixes).
+    ##Folder keys and foreign prefixes are kept, they take up room in the pages
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': '/'}
+    if lower:
+        ##StartAfter is exclusive, begin just before the first key of the range
+        kwargs['StartAfter'] = lower[:-1] + chr(ord(lower[-1]) - 1) + MAX_CHAR
+    paginator = client.get_paginator('list_objects_v2')
+    segments = []
+    for page in paginator.paginate(**kwargs):
+        past_upper = False
+        rows = []
+        for one_content in page.get('Contents') or []:
+            key = one_content['Key']
+            if upper and key >= upper:
+                past_upper = True
+                break
+            if lower and key < lower:
+                continue
+            rows.append(_content_row(one_content))
+        sub_prefixes = []
+        for common_prefix in page.get('CommonPrefixes') or []:
+            this_prefix = str(common_prefix['Prefix'])
+            if upper and this_prefix >= upper:
+                past_upper = True
+                break
+            if lower and this_prefix < lower:
+                continue
+            sub_prefixes.append(this_prefix)
+        segments.append((rows, sub_prefixes))
+        if past_upper:
+            break
+    return segments
+
+
+def _merge_shards(shard_segments):
+    ##Rebuild the pages an unsharded listing would have returned, so that the
+    ##depth first order of the result does not depend on the sharding
+    entries = []
+    for segments in shard_segments:
+        for rows, sub_prefixes in segments:
+            entries.extend(heapq.merge(((row[0], row) for row in rows),
+                                       ((p, p) for p in sub_prefixes)))
+    segments = []
+    for start in range(0, len(entries), LIST_PAGE_SIZE):
+        page = entries[start:start + LIST_PAGE_SIZE]
+        segments.append(([item for _, item in page if not isinstance(item, str)],
+                         [item for _, item in page if isinstance(item, str)]))
+    return segments
+
+
+def _filter_segments(prefix, segments):
+    filtered = []
+    for rows, sub_prefixes in segments:
+        ##Ignore folders
+        rows = [row for row in rows if not row[0].endswith('/')]
+        valid_prefixes = []
+        for this_prefix in sub_prefixes:
+            if not this_prefix:
+                continue
+            if not prefix.endswith('/') and this_prefix[len(prefix)] != '/':
+                ## E.g. if two folders abc and abc_x are at the same level
+                ##     and prefix is abc, only abc/ is considered, abc_x is ignored
+                print(this_prefix + ' is not a subfolder of ' + prefix + ', ignoring')
+                continue
+            valid_prefixes.append(this_prefix)
+        filtered.append((rows, valid_prefixes))
+    return filtered
+
+
+def _dir_items(segments):
+    for rows, sub_prefixes in segments:
+        yield rows
+        for sub_prefix in sub_prefixes:
+            yield sub_prefix
+
+
+def iter_prefix(client, bucket, prefix, max_workers=DEFAULT_LIST_WORKERS, shard_chars=None,
+                max_listed_folders=DEFAULT_MAX_LISTED_FOLDERS):
+    """
+    Recursively lists bucket/prefix with up to max_workers concurrent LIST calls. Folders
+    are listed ahead of the walk in depth first order, at most max_listed_folders of them
+    are listed or being listed and not yet walked. With shard_chars, each folder is also
+    split into key ranges at those characters that are listed in parallel.
+    Yields lists of (key, size, last_modified, version_id, metadata) rows in the same order
+    as a sequential depth first listing, each as soon as all folders before it are listed.
+    """
+    print("INFO: iter_prefix: ", bucket, prefix)
+    dir_segments = dict()
+    pending_shards = dict()
+    futures = dict()
+    ##Folders submitted and not walked yet, and folders found but not submitted, the first
+    ##one in depth first order on top
+    submitted = set()
+    to_submit = []
+    num_folders = 0
+    num_keys = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_dir(dir_prefix):
+            ranges = _get_shard_ranges(dir_prefix, shard_chars)
+            pending_shards[dir_prefix] = [None] * len(ranges)
+            submitted.add(dir_prefix)
+            for index, (lower, upper) in enumerate(ranges):
+                future = executor.submit(_list_dir_range, client, bucket, dir_prefix, lower, upper)
+                futures[future] = (dir_prefix, index)
+
+        submit_dir(prefix)
+        ##Depth first walk over the listed folders, next_dir is the folder it waits for
+        stack = []
+        next_dir = prefix
+        while True:
+            while next_dir is None or next_dir in dir_segments:
+                if next_dir is not None:
+                    ##Each folder is walked once, its listing is not needed after that
+                    stack.append(_dir_items(dir_segments.pop(next_dir)))
+                    submitted.discard(next_dir)
+                    num_folders += 1
+                    next_dir = None
+                if not stack:
+                    break
+                item = next(stack[-1], None)
+                if item is None:
+                    stack.pop()
+                elif isinstance(item, str):
+                    next_dir = item
+                elif item:
+                    num_keys += len(item)
+                    yield item
+            if next_dir is None:
+                break
+            if next_dir not in submitted:
+                ##The walk waits for it, listed regardless of max_listed_folders
+                to_submit.remove(next_dir)
+                submit_dir(next_dir)
+            while to_submit and len(submitted) < max_listed_folders:
+                submit_dir(to_submit.pop())
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_prefix, index = futures.pop(future)
+                pending_shards[dir_prefix][index] = future.result()
+                if any(shard is None for shard in pending_shards[dir_prefix]):
+                    continue
+                shards = pending_shards.pop(dir_prefix)
+                if len(shards) == 1:
+                    segments = shards[0]
+                else:
+                    segments = _merge_shards(shards)
+                segments = _filter_segments(dir_prefix, segments)
+                dir_segments[dir_prefix] = segments
+                sub_prefixes = [sub_prefix for _, sub_prefixes in segments for sub_prefix in sub_prefixes]
+                to_submit.extend(reversed(sub_prefixes))
+    print('INFO: iter_prefix: {0} folders, {1} keys'.format(num_folders, num_keys))
+
+
+def list_prefix(client, bucket, prefix, max_workers=DEFAULT_LIST_WORKERS, shard_chars=None):
+    """
+    Lists bucket/prefix like iter_prefix, returns a ListingColumns of all rows.
+    """
+    columns = ListingColumns()
+    for rows in iter_prefix(client, bucket, prefix, max_workers=max_workers, shard_chars=shard_chars):
+        columns.extend(rows)
+    return columns
+
+
+def iter_prefix_columns(client, bucket, prefix, chunksize, max_workers=DEFAULT_LIST_WORKERS, shard_chars=None):
+    ##Yields ListingColumns of up to chunksize rows
+    columns = ListingColumns()
+    for rows in iter_prefix(client, bucket, prefix, max_workers=max_workers, shard_chars=shard_chars):
+        start = 0
+        while start < len(rows):
+            num_rows = chunksize - len(columns)
+            columns.extend(rows[start:start + num_rows])
+            start += num_rows
+            if len(columns) >= chunksize:
+                yield columns
+                columns = ListingColumns()
+    if len(columns):
+        yield columns
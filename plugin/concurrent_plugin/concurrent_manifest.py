@@ -0,0 +1,113 @@
+import json
+import time
+import hashlib
+from io import BytesIO
+import pandas as pd
+from botocore.exceptions import ClientError
+
+MANIFEST_FOLDER = '.concurrent/manifests'
+##Longest a partition waits for the manifest after another partition claimed the listing
+DEFAULT_MANIFEST_WAIT_SECONDS = 60
+MANIFEST_POLL_SECONDS = 2
+##The partition that creates <manifest_key>.claim lists the input and writes the manifest
+MANIFEST_CLAIM_SUFFIX = '.claim'
+##S3 user metadata of the marker written in place of a manifest that could not be written
+MANIFEST_STATUS_METADATA = 'concurrent-manifest-status'
+
+
+class ManifestUnavailable(Exception):
+    pass
+
+
+def get_manifest_key(artifact_prefix, bucket, prefix, time_spec, input_type):
+    ##One manifest per listed (bucket, prefix, time_spec), stored under artifact_prefix
+    listing_key = json.dumps([bucket, prefix, time_spec, input_type])
+    digest = hashlib.sha256(listing_key.encode('utf-8')).hexdigest()
+    return '/'.join([artifact_prefix.rstrip('/'), MANIFEST_FOLDER, digest + '.parquet'])
+
+
+def load_manifest(client, manifest_bucket, manifest_key):
+    ##Returns the listing DataFrame, or None if there is no manifest yet. Raises
+    ##ManifestUnavailable if the manifest will never be usable
+    try:
+        data = client.get_object(Bucket=manifest_bucket, Key=manifest_key)
+    except client.exceptions.NoSuchKey:
+        return None
+    except Exception as ex:
+        print('Failed to fetch listing manifest {0}: {1}'.format(manifest_key, ex))
+        return None
+    body = data['Body'].read()
+    if data.get('Metadata', {}).get(MANIFEST_STATUS_METADATA) == 'failed':
+        raise ManifestUnavailable('No listing manifest {0}: {1}'.format(manifest_key, body.decode('utf-8')))
+    try:
+        return pd.read_parquet(BytesIO(body))
+    except Exception as ex:
+        raise ManifestUnavailable('Unreadable listing manifest {0}: {1}'.format(manifest_key, ex))
+
+
+def claim_manifest(client, manifest_bucket, manifest_key, owner):
+    ##Returns True if this partition won the listing, False if another partition did, and None
+    ##if the claim could not be made, e.g. the store does not support conditional puts
+    try:
+        client.put_object(Bucket=manifest_bucket, Key=manifest_key + MANIFEST_CLAIM_SUFFIX,
+                          Body=owner.encode('utf-8'), IfNoneMatch='*')
+        print('Claimed listing manifest {0} for {1}'.format(manifest_key, owner))
+        return True
+    except ClientError as ex:
+        if ex.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        print('Failed to claim listing manifest {0}: {1}'.format(manifest_key, ex))
+        return None
+    except Exception as ex:
+        print('Failed to claim listing manifest {0}: {1}'.format(manifest_key, ex))
+        return None
+
+
+def get_claim_time(client, manifest_bucket, manifest_key):
+    ##Epoch seconds at which the listing was claimed, None if there is no claim
+    try:
+        resp = client.head_object(Bucket=manifest_bucket, Key=manifest_key + MANIFEST_CLAIM_SUFFIX)
+    except Exception:
+        return None
+    return resp['LastModified'].timestamp()
+
+
+def save_manifest_failure(client, manifest_bucket, manifest_key, reason):
+    ##Tells the partitions waiting for the manifest to list the input themselves
+    client.put_object(Bucket=manifest_bucket, Key=manifest_key, Body=reason.encode('utf-8'),
+                      Metadata={MANIFEST_STATUS_METADATA: 'failed'})
+    print('Wrote listing manifest failure marker s3://{0}/{1}'.format(manifest_bucket, manifest_key))
+
+
+def save_manifest(client, manifest_bucket, manifest_key, df):
+    buf = BytesIO()
+    try:
+        df.to_parquet(buf, index=False)
+    except Exception as ex:
+        ##e.g. pyarrow is not installed or metadata columns have mixed types
+        print('Not writing listing manifest {0}: {1}'.format(manifest_key, ex))
+        save_manifest_failure(client, manifest_bucket, manifest_key, str(ex))
+        return False
+    client.put_object(Bucket=manifest_bucket, Key=manifest_key, Body=buf.getvalue())
+    print('Wrote listing manifest s3://{0}/{1} with {2} rows'.format(manifest_bucket, manifest_key, df.shape[0]))
+    return True
+
+
+def wait_for_manifest(client, manifest_bucket, manifest_key, max_wait_time=DEFAULT_MANIFEST_WAIT_SECONDS):
+    ##Waits for the partition holding the claim. Returns None as soon as there is no claim or the
+    ##claim is older than max_wait_time, e.g. its partition was evicted, and raises
+    ##ManifestUnavailable as soon as that partition reports it has no manifest
+    while True:
+        df = load_manifest(client, manifest_bucket, manifest_key)
+        if df is not None:
+            return df
+        claim_time = get_claim_time(client, manifest_bucket, manifest_key)
+        if claim_time is None:
+            print('No claim on listing manifest ' + manifest_key)
+            return None
+        if time.time() - claim_time > max_wait_time:
+            print('Listing manifest {0} claimed {1:.0f} seconds ago, giving up'.format(
+                manifest_key, time.time() - claim_time))
+            return None
+        print('Waiting for listing manifest ' + manifest_key)
+        time.sleep(MANIFEST_POLL_SECONDS)
@@ -0,0 +1,128 @@
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import threading
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import mlflow.tracking
+
+_logger = logging.getLogger(__name__)
+
+##Concurrent uploads, and in bundling mode the size up to which files are packed into tar bundles
+CONCURRENT_UPLOAD_WORKERS = int(os.environ.get('CONCURRENT_UPLOAD_WORKERS', 16))
+CONCURRENT_UPLOAD_BUNDLE_FILE_SIZE = int(os.environ.get('CONCURRENT_UPLOAD_BUNDLE_FILE_SIZE', 0))
+MAX_BUNDLE_SIZE = 256 * 1024 * 1024
+BUNDLE_NAME = 'concurrent-bundle-{0}-{1:05d}.tar'
+
+##MlflowClient shared by all uploads of this process
+upload_client = None
+upload_client_lock = threading.Lock()
+
+
+def get_upload_client():
+    global upload_client
+    with upload_client_lock:
+        if not upload_client:
+            upload_client = mlflow.tracking.MlflowClient()
+        return upload_client
+
+
+def list_local_files(local_dir, skip_dir=None):
+    ##Returns (local path, path relative to local_dir with '/' separators) for every file
+    all_files = []
+    for root, dirnames, filenames in os.walk(local_dir):
+        dirnames.sort()
+        relative_dir = os.path.relpath(root, local_dir).replace('\\', '/')
+        if relative_dir == '.':
+            relative_dir = ''
+        if skip_dir and skip_dir(relative_dir):
+            continue
+        for onefile in sorted(filenames):
+            relative_path = relative_dir + '/' + onefile if relative_dir else onefile
+            all_files.append((os.path.join(root, onefile), relative_path))
+    return all_files
+
+
+def _upload_one(client, run_id, local_path, artifact_path):
+    ##Through the run's artifact repository, as mlflow.log_artifact does
+    client.log_artifact(run_id, local_path, artifact_path or None)
+    return os.path.getsize(local_path)
+
+
+def _upload_bundle(client, run_id, artifact_path, bundle_name, members):
+    bundle_dir = tempfile.mkdtemp()
+    try:
+        bundle_path = os.path.join(bundle_dir, bundle_name)
+        with tarfile.open(bundle_path, mode='w') as tar:
+            for local_path, relative_path in members:
+                tar.add(local_path, arcname=relative_path)
+        return _upload_one(client, run_id, bundle_path, artifact_path)
+    finally:
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+
+
+def _get_bundles(files, bundle_file_size):
+    ##Splits files into those uploaded as is, and tar bundles of the small ones
+    single_files = []
+    bundles = []
+    bundle = []
+    bundle_size = 0
+    for local_path, relative_path in files:
+        size = os.path.getsize(local_path)
+        if size > bundle_file_size:
+            single_files.append((local_path, relative_path))
+            continue
+        if bundle and bundle_size + size > MAX_BUNDLE_SIZE:
+            bundles.append(bundle)
+            bundle = []
+            bundle_size = 0
+        bundle.append((local_path, relative_path))
+        bundle_size += size
+    if bundle:
+        bundles.append(bundle)
+    return single_files, bundles
+
+
+def upload_files(run_id, artifact_path, files, max_workers=CONCURRENT_UPLOAD_WORKERS,
+                 bundle_file_size=CONCURRENT_UPLOAD_BUNDLE_FILE_SIZE):
+    """
+    Logs (local path, relative path) files as artifacts of run_id at artifact_path/relative path,
+    the layout of mlflow.log_artifacts, with up to max_workers concurrent uploads through one
+    shared MlflowClient. With bundle_file_size, files up to that size are instead packed into
+    artifact_path/concurrent-bundle-*.tar archives.
+    Returns the number of bytes uploaded, raises the first failure after all uploads were tried.
+    """
+    client = get_upload_client()
+    artifact_path = (artifact_path or '').strip('/')
+    if bundle_file_size > 0:
+        single_files, bundles = _get_bundles(files, bundle_file_size)
+    else:
+        single_files, bundles = files, []
+    print('upload_files: {0} files and {1} bundles to run {2} artifact path {3}'.format(
+        len(single_files), len(bundles), run_id, artifact_path))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for local_path, relative_path in single_files:
+            dst_path = '/'.join(filter(None, [artifact_path, posixpath.dirname(relative_path)]))
+            futures[executor.submit(_upload_one, client, run_id, local_path, dst_path)] = local_path
+        ##Unique names, other uploads may bundle into the same artifact path
+        upload_id = uuid.uuid4().hex
+        for index, members in enumerate(bundles):
+            bundle_name = BUNDLE_NAME.format(upload_id, index)
+            futures[executor.submit(_upload_bundle, client, run_id, artifact_path, bundle_name, members)] = bundle_name
+    num_bytes = 0
+    failures = []
+    for future, name in futures.items():
+        if future.exception():
+            _logger.error('upload_files: Failed to upload {0}: {1}'.format(name, future.exception()))
+            failures.append(future.exception())
+        else:
+            num_bytes += future.result()
+    if failures:
+        _logger.error('upload_files: {0} of {1} uploads to run {2} failed'.format(
+            len(failures), len(futures), run_id))
+        raise failures[0]
+    return num_bytes
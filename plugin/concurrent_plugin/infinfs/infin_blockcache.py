@@ -0,0 +1,167 @@
+import os
+import time
+import logging
+import threading
+from concurrent_plugin.infinfs import infin_download
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class BlockCachedFile:
+    """
+    Sparse shadow file for one remote object. Byte ranges are fetched on demand with
+    ranged GETs in units of block_size and written in place into the temporary shadow
+    file. A bitmap of the blocks already present is persisted next to it, so partially
+    cached files survive a remount. Once every block is present the temporary file is
+    renamed to the final shadow path, exactly like a whole-object download. Blocks are
+    fetched with If-Match on the object's ETag, which is saved with the bitmap, so a file
+    never mixes blocks of two versions of the object.
+    """
+    def __init__(self, local_shadow_path, tmp_shadow_file, bitmap_file, bucket, remote_path,
+                 size, block_size, infinstor_time_spec, client=None, on_complete=None, metrics=None,
+                 etag=None, on_fetch=None):
+        self.local_shadow_path = local_shadow_path
+        self.tmp_shadow_file = tmp_shadow_file
+        self.bitmap_file = bitmap_file
+        self.bucket = bucket
+        self.remote_path = remote_path
+        self.size = size
+        self.block_size = block_size
+        self.infinstor_time_spec = infinstor_time_spec
+        self.client = client
+        ##Called with the final shadow path once all blocks are present
+        self.on_complete = on_complete
+        ##InfinMetrics of the mount, counts the ranged GETs
+        self.metrics = metrics
+        self.etag = etag
+        ##Called with the number of bytes written by every ranged GET
+        self.on_fetch = on_fetch
+        ##Set when the object changed, the partial file is discarded
+        self.stale = False
+        self.num_blocks = (size + block_size - 1) // block_size
+        self.bitmap = self.load_bitmap()
+        ##Serializes block fetches and bitmap updates across FUSE threads
+        self.lock = threading.Lock()
+        self.fd = os.open(tmp_shadow_file, os.O_RDWR)
+        self.complete = False
+        if self.is_complete():
+            self.finalize()
+
+    def get_bitmap_header(self):
+        ##The blocks in the bitmap are of this version of the object
+        return (self.etag or '').encode('utf-8') + b'\n'
+
+    def load_bitmap(self):
+        num_bytes = (self.num_blocks + 7) // 8
+        if os.path.exists(self.bitmap_file):
+            with open(self.bitmap_file, 'rb') as fh:
+                data = fh.read()
+            header = self.get_bitmap_header()
+            if data.startswith(header) and len(data) == len(header) + num_bytes:
+                return bytearray(data[len(header):])
+            logger.warning('Ignoring stale block bitmap %s', self.bitmap_file)
+        return bytearray(num_bytes)
+
+    def save_bitmap(self):
+        tmp_bitmap_file = self.bitmap_file + '.new'
+        with open(tmp_bitmap_file, 'wb') as fh:
+            fh.write(self.get_bitmap_header())
+            fh.write(self.bitmap)
+        os.replace(tmp_bitmap_file, self.bitmap_file)
+
+    def has_block(self, block):
+        return self.bitmap[block // 8] & (1 << (block % 8)) != 0
+
+    def set_block(self, block):
+        self.bitmap[block // 8] |= (1 << (block % 8))
+
+    def is_complete(self):
+        for block in range(self.num_blocks):
+            if not self.has_block(block):
+                return False
+        return True
+
+    def get_missing_ranges(self, first_block, last_block):
+        ##Coalesce adjacent missing blocks, so that each run is fetched with one GET
+        missing = []
+        run_start = None
+        for block in range(first_block, last_block + 1):
+            if self.has_block(block):
+                if run_start is not None:
+                    missing.append((run_start, block - 1))
+                    run_start = None
+            elif run_start is None:
+                run_start = block
+        if run_start is not None:
+            missing.append((run_start, last_block))
+        return missing
+
+    def ensure_range(self, offset, length):
+        if self.complete or length <= 0 or offset >= self.size:
+            return
+        with self.lock:
+            self._ensure_range(offset, length)
+
+    def _ensure_range(self, offset, length):
+        if self.complete:
+            return
+        first_block = offset // self.block_size
+        last_block = (min(offset + length, self.size) - 1) // self.block_size
+        missing = self.get_missing_ranges(first_block, last_block)
+        if not missing:
+            return
+        for start_block, end_block in missing:
+            start = start_block * self.block_size
+            end = min((end_block + 1) * self.block_size, self.size) - 1
+            fetch_start = time.perf_counter()
+            try:
+                data = infin_download.download_range(self.bucket, self.remote_path, start, end,
+                                                     self.infinstor_time_spec, self.client, self.etag)
+            except infin_download.ObjectChangedError:
+                self.discard()
+                raise
+            if self.metrics:
+                self.metrics.observe('range_download_seconds', time.perf_counter() - fetch_start)
+                self.metrics.incr('s3_get_calls')
+                self.metrics.incr('bytes_downloaded', len(data))
+            if len(data) != end - start + 1:
+                raise Exception('Short read for {0} range {1}-{2}: got {3} bytes'
+                                .format(self.remote_path, start, end, len(data)))
+            os.pwrite(self.fd, data, start)
+            if self.on_fetch:
+                self.on_fetch(len(data))
+            for block in range(start_block, end_block + 1):
+                self.set_block(block)
+        if self.is_complete():
+            self.finalize()
+        else:
+            self.save_bitmap()
+
+    def finalize(self):
+        logger.debug('rename %s to %s', self.tmp_shadow_file, self.local_shadow_path)
+        os.rename(self.tmp_shadow_file, self.local_shadow_path)
+        if os.path.exists(self.bitmap_file):
+            os.remove(self.bitmap_file)
+        self.complete = True
+        if self.on_complete:
+            self.on_complete(self.local_shadow_path)
+
+    def discard(self):
+        ##The blocks present are of an older version, the next open starts over. Open
+        ##handles keep reading the unlinked file
+        logger.warning('%s changed since version %s, discarding its cached blocks', self.remote_path, self.etag)
+        self.stale = True
+        for path in (self.tmp_shadow_file, self.bitmap_file):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        with self.lock:
+            if not self.complete and not self.stale:
+                self.save_bitmap()
+            os.close(self.fd)
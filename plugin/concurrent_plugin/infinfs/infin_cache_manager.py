@@ -0,0 +1,262 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_HIGH_WATERMARK = 0.90
+DEFAULT_LOW_WATERMARK = 0.75
+DEFAULT_CHECK_INTERVAL = 15
+##Full walks of the cache that correct the usage tracked from the mounts' downloads
+DEFAULT_RECONCILE_INTERVAL = 300
+##Partially fetched files untouched for this long are not being downloaded and may be evicted
+PARTIAL_FILE_MIN_IDLE_SECONDS = 60
+EVICTION_LOCK_FILE = '.evict.lock'
+PARTIAL_FILE_PREFIX = '.infin-'
+##Files kept next to the temporary file of a partially fetched object: the block bitmap and the
+##progress of a resumable download
+PARTIAL_FILE_SUFFIXES = ('.blocks', '.tmp.parts')
+
+
+class ShadowCacheManager:
+    """
+    Keeps the shadow cache under cache_root within capacity. With max_bytes, usage is the
+    bytes of cached data and capacity is max_bytes. With max_bytes 0, usage and capacity
+    are those of the filesystem holding the cache, so that other data on it also counts.
+    When usage goes above the high watermark, cached files are evicted in least recently
+    accessed order until usage is below the low watermark. Completed shadow files and
+    partially fetched objects, i.e. sparse .infin-*.tmp files with their block bitmap,
+    are both evicted, but not files pinned by an open FUSE handle or partial files that
+    are still being written.
+    Cached bytes are tracked from the downloads reported by the mounts through
+    record_added(), and corrected by a full walk of the cache every reconcile_interval
+    seconds, or when eviction needs the list of cached files.
+    One manager serves all the mounts of a process on the same cache_root, see
+    get_cache_manager(). Several processes can share one cache_root: eviction is
+    serialized with a lock file, and open handles hold a shared flock that the evictor
+    of any process respects.
+    """
+    def __init__(self, cache_root, max_bytes=0, high_watermark=DEFAULT_HIGH_WATERMARK,
+                 low_watermark=DEFAULT_LOW_WATERMARK, check_interval=DEFAULT_CHECK_INTERVAL,
+                 reconcile_interval=DEFAULT_RECONCILE_INTERVAL):
+        self.cache_root = cache_root
+        self.max_bytes = max_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.check_interval = check_interval
+        self.reconcile_interval = reconcile_interval
+        self.last_scan_time = 0
+        ##path -> number of open handles, guarded by lock like stats
+        self.pinned = dict()
+        self.lock = threading.Lock()
+        ##Mounts of this process using the manager
+        self.users = 0
+        self.stats = {'cached_bytes': 0, 'cached_files': 0, 'evicted_bytes': 0,
+                      'evicted_files': 0, 'eviction_runs': 0, 'scans': 0}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='infin-cache-manager', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def pin(self, path, fd=None):
+        with self.lock:
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+        if fd is not None:
+            ##Visible to the evictors of other processes sharing the cache, released on close
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError as ex:
+                logger.debug('Failed to lock %s: %s', path, ex)
+        ##Record the access explicitly, atime updates are often disabled by relatime/noatime
+        try:
+            st = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        except OSError:
+            pass
+
+    def unpin(self, path):
+        with self.lock:
+            count = self.pinned.get(path, 0) - 1
+            if count > 0:
+                self.pinned[path] = count
+            else:
+                self.pinned.pop(path, None)
+
+    def is_pinned(self, path):
+        with self.lock:
+            return path in self.pinned
+
+    def is_locked_elsewhere(self, path):
+        ##True if a handle of any process holds the flock taken by pin()
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def update_stats(self, **deltas):
+        with self.lock:
+            for name, value in deltas.items():
+                self.stats[name] += value
+
+    def record_added(self, nbytes, files=0):
+        ##Bytes and completed files added by a download of one of the mounts
+        self.update_stats(cached_bytes=nbytes, cached_files=files)
+
+    def get_capacity_and_usage(self):
+        if self.max_bytes:
+            with self.lock:
+                return self.max_bytes, self.stats['cached_bytes']
+        ##Free space of the filesystem, whatever else is stored on it
+        stv = os.statvfs(self.cache_root)
+        capacity = stv.f_blocks * stv.f_frsize
+        return capacity, capacity - stv.f_bavail * stv.f_frsize
+
+    def get_partial_entry(self, root, name, now):
+        ##(atime, allocated bytes, paths, pinned paths, 0) of a partially fetched object, and
+        ##whether it may be evicted, i.e. is not still being written
+        paths = [os.path.join(root, name)]
+        for suffix in PARTIAL_FILE_SUFFIXES:
+            path = os.path.join(root, name[:-len('.tmp')] + suffix)
+            if os.path.exists(path):
+                paths.append(path)
+        try:
+            st = os.lstat(paths[0])
+            mtime = max(os.lstat(path).st_mtime for path in paths)
+        except OSError:
+            return None, False
+        ##Sparse, only the blocks fetched so far take up space
+        size = st.st_blocks * 512
+        shadow_path = os.path.join(root, name[len(PARTIAL_FILE_PREFIX):-len('.tmp')])
+        return (st.st_atime, size, paths, [shadow_path], 0), now - mtime >= PARTIAL_FILE_MIN_IDLE_SECONDS
+
+    def scan(self):
+        ##Returns (atime, size, paths, pinned paths, completed files) for the cached files that
+        ##may be evicted, and updates the totals.
+        ##Shadow trees hardlink into the object store, so all the links to one inode form
+        ##one entry that is evicted as a whole
+        inodes = dict()
+        partial_entries = []
+        partial_bytes = 0
+        now = time.time()
+        for root, dirnames, filenames in os.walk(self.cache_root):
+            for name in filenames:
+                if name.startswith(PARTIAL_FILE_PREFIX):
+                    if name.endswith('.tmp'):
+                        entry, evictable = self.get_partial_entry(root, name, now)
+                        if entry and entry[1]:
+                            partial_bytes += entry[1]
+                            if evictable:
+                                partial_entries.append(entry)
+                    ##Bitmaps and progress files go with their .tmp file
+                    continue
+                if name == EVICTION_LOCK_FILE:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                inode_key = (st.st_dev, st.st_ino)
+                if inode_key in inodes:
+                    inodes[inode_key][2].append(path)
+                else:
+                    paths = [path]
+                    inodes[inode_key] = (st.st_atime, st.st_size, paths, paths, 1)
+        entries = list(inodes.values()) + partial_entries
+        with self.lock:
+            self.stats['cached_bytes'] = sum(entry[1] for entry in inodes.values()) + partial_bytes
+            self.stats['cached_files'] = len(inodes)
+            self.stats['scans'] += 1
+        self.last_scan_time = time.time()
+        return entries
+
+    def check(self):
+        entries = None
+        if time.time() - self.last_scan_time >= self.reconcile_interval:
+            entries = self.scan()
+        capacity, used = self.get_capacity_and_usage()
+        if capacity <= 0 or used <= capacity * self.high_watermark:
+            return
+        if entries is None:
+            entries = self.scan()
+            capacity, used = self.get_capacity_and_usage()
+        lock_path = os.path.join(self.cache_root, EVICTION_LOCK_FILE)
+        with open(lock_path, 'w') as lock_fh:
+            try:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                ##Another mount process is evicting from the same cache
+                return
+            self.evict(entries, used - int(capacity * self.low_watermark))
+
+    def evict(self, entries, bytes_to_free):
+        logger.info('Shadow cache above high watermark, evicting %d bytes from %s',
+                    bytes_to_free, self.cache_root)
+        self.update_stats(eviction_runs=1)
+        freed = 0
+        for atime, size, paths, pinned_paths, num_files in sorted(entries, key=lambda entry: entry[0]):
+            if freed >= bytes_to_free:
+                break
+            if any(self.is_pinned(path) for path in pinned_paths) or self.is_locked_elsewhere(paths[0]):
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            freed += size
+            self.update_stats(evicted_bytes=size, evicted_files=1, cached_bytes=-size, cached_files=-num_files)
+        logger.info('Evicted %d bytes, cache stats %s', freed, self.get_stats())
+
+    def run(self):
+        while not self.stopped.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as ex:
+                logger.warning('Shadow cache check failed: %s', ex)
+
+
+##realpath of cache_root -> the ShadowCacheManager of this process for that cache
+cache_managers = dict()
+cache_managers_lock = threading.Lock()
+
+
+def get_cache_manager(cache_root, **kwargs):
+    ##kwargs of the first mount on cache_root configure the manager
+    cache_root = os.path.realpath(cache_root)
+    with cache_managers_lock:
+        manager = cache_managers.get(cache_root)
+        if manager is None:
+            manager = ShadowCacheManager(cache_root, **kwargs)
+            manager.start()
+            cache_managers[cache_root] = manager
+        manager.users += 1
+        return manager
+
+
+def release_cache_manager(manager):
+    ##Stops the manager when its last mount is gone
+    with cache_managers_lock:
+        manager.users -= 1
+        if manager.users <= 0:
+            manager.stop()
+            if cache_managers.get(manager.cache_root) is manager:
+                cache_managers.pop(manager.cache_root)
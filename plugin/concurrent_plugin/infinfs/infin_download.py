@@ -1,7 +1,24 @@
 import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.exceptions import ClientError
 from infinstor import infin_boto3
 
+logger = logging.getLogger(__name__)
+
+##Parallel GETs shared by all batch downloads of this process, and the size of the ranges
+##large objects are fetched in
+INFINFS_DOWNLOAD_WORKERS = int(os.environ.get('INFINFS_DOWNLOAD_WORKERS', 16))
+INFINFS_DOWNLOAD_PART_SIZE = int(os.environ.get('INFINFS_DOWNLOAD_PART_SIZE', 8 * 1024 * 1024))
+PROGRESS_SUFFIX = '.parts'
+
+
+class ObjectChangedError(Exception):
+    pass
+
 
 def get_s3_client(infinstor_time_spec):
     if infinstor_time_spec:
@@ -10,11 +27,10 @@ def get_s3_client(infinstor_time_spec):
         return boto3.client('s3')
 
 def download_objects(local_path, tmp_local_file, bucket, remote_path, infinstor_time_spec, client = None):
-    print("Download from bucket {0}, path {1} to the local path {2} for timespec {3}"
-             .format(bucket, remote_path, tmp_local_file, str(infinstor_time_spec)))
-    download_one_object(tmp_local_file, bucket, remote_path, infinstor_time_spec, client)
-    print('rename {0} to {1}'.format(tmp_local_file, local_path))
-    os.rename(tmp_local_file, local_path)
+    logger.debug('Download from bucket %s, path %s to the local path %s for timespec %s',
+                 bucket, remote_path, tmp_local_file, infinstor_time_spec)
+    return download_objects_batch([(bucket, remote_path, local_path, tmp_local_file)],
+                                  infinstor_time_spec, client)[0]
 
 def download_one_object(local_path, bucket, remote_path, infinstor_time_spec, client = None):
     if client:
@@ -24,5 +40,263 @@ def download_one_object(local_path, bucket, remote_path, infinstor_time_spec, cl
     s3_client.download_file(bucket, remote_path, local_path)
 
 
+def download_range(bucket, remote_path, start, end, infinstor_time_spec, client = None, etag = None):
+    ##Ranged GET, start and end are inclusive byte offsets. With etag, raises ObjectChangedError
+    ##if the object is no longer that version
+    if client:
+        s3_client = client
+    else:
+        s3_client = get_s3_client(infinstor_time_spec)
+    kwargs = {}
+    if etag:
+        kwargs['IfMatch'] = etag
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=remote_path,
+                                        Range='bytes={0}-{1}'.format(start, end), **kwargs)
+    except ClientError as ex:
+        if etag and ex.response.get('Error', {}).get('Code') in ('PreconditionFailed', '412'):
+            raise ObjectChangedError('{0} changed since version {1}'.format(remote_path, etag))
+        raise
+    return response['Body'].read()
+
+
+def get_object_size(bucket, remote_path, infinstor_time_spec, client = None):
+    response = head_object(bucket, remote_path, infinstor_time_spec, client)
+    return int(response['ContentLength'])
+
+
+def get_object_etag(bucket, remote_path, infinstor_time_spec, client = None):
+    response = head_object(bucket, remote_path, infinstor_time_spec, client)
+    return response['ETag']
+
+
+def head_object(bucket, remote_path, infinstor_time_spec, client = None):
+    if client:
+        s3_client = client
+    else:
+        s3_client = get_s3_client(infinstor_time_spec)
+    return s3_client.head_object(Bucket=bucket, Key=remote_path)
+
+
+class ObjectDownload:
+    """
+    One object of a batch download, fetched in part_size ranges into tmp_local_file and
+    renamed to local_path when complete. The parts already written are recorded with the
+    object's ETag in tmp_local_file + '.parts', so an interrupted download resumes where
+    it left off as long as the object has not changed.
+    """
+    def __init__(self, bucket, remote_path, local_path, tmp_local_file, part_size):
+        self.bucket = bucket
+        self.remote_path = remote_path
+        self.local_path = local_path
+        self.tmp_local_file = tmp_local_file
+        self.progress_file = tmp_local_file + PROGRESS_SUFFIX
+        self.part_size = part_size
+        self.size = None
+        self.etag = None
+        self.fd = None
+        self.parts_done = set()
+        self.pending = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.stats = {'bytes_downloaded': 0, 'gets': 0, 'bytes_resumed': 0}
+
+    def num_parts(self):
+        return max(1, (self.size + self.part_size - 1) // self.part_size)
+
+    def get_range(self, part):
+        start = part * self.part_size
+        return start, min(start + self.part_size, self.size) - 1
 
+    def load_progress(self):
+        try:
+            with open(self.progress_file, 'r') as fh:
+                progress = json.load(fh)
+            if progress['part_size'] != self.part_size \
+                    or os.path.getsize(self.tmp_local_file) != progress['size']:
+                return False
+        except (OSError, ValueError, KeyError):
+            return False
+        self.size = progress['size']
+        self.etag = progress['etag']
+        self.parts_done = set(progress['parts'])
+        return True
 
+    def save_progress(self):
+        ##Called with the lock held
+        tmp_progress_file = self.progress_file + '.new'
+        with open(tmp_progress_file, 'w') as fh:
+            json.dump({'etag': self.etag, 'size': self.size, 'part_size': self.part_size,
+                       'parts': sorted(self.parts_done)}, fh)
+        os.replace(tmp_progress_file, self.progress_file)
+
+    def discard_progress(self):
+        self.parts_done = set()
+        if os.path.exists(self.progress_file):
+            os.remove(self.progress_file)
+
+    def open_tmp_file(self):
+        ##No O_TRUNC, the file may be the size placeholder that getattr reports until the rename
+        self.fd = os.open(self.tmp_local_file, os.O_RDWR | os.O_CREAT)
+        os.ftruncate(self.fd, self.size)
+
+
+class ParallelDownloader:
+    """
+    Downloads batches of objects on one pool of max_workers threads. Each object is fetched
+    with ranged GETs of part_size, the first of which also returns its size and ETag, so a
+    small object costs one GET and the parts of a large one are fetched concurrently.
+    """
+    def __init__(self, max_workers=INFINFS_DOWNLOAD_WORKERS, part_size=INFINFS_DOWNLOAD_PART_SIZE):
+        self.part_size = part_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='infin-download')
+
+    def download(self, downloads, client):
+        objects = []
+        for download in downloads:
+            bucket, remote_path, local_path = download[:3]
+            tmp_local_file = download[3] if len(download) > 3 else local_path + '.tmp'
+            objects.append(ObjectDownload(bucket, remote_path, local_path, tmp_local_file, self.part_size))
+        for obj in objects:
+            self.executor.submit(self.start, client, obj)
+        for obj in objects:
+            obj.done.wait()
+        ##Raises the first failure after all downloads have completed
+        for obj in objects:
+            if obj.error:
+                raise obj.error
+        return [obj.stats for obj in objects]
+
+    def get_part(self, client, obj, part):
+        start, end = obj.get_range(part)
+        response = client.get_object(Bucket=obj.bucket, Key=obj.remote_path,
+                                     Range='bytes={0}-{1}'.format(start, end))
+        data = response['Body'].read()
+        if response.get('ETag') != obj.etag:
+            raise ObjectChangedError('{0} changed since the download started'.format(obj.remote_path))
+        if len(data) != end - start + 1:
+            raise Exception('Short read for {0} range {1}-{2}: got {3} bytes'
+                            .format(obj.remote_path, start, end, len(data)))
+        return data
+
+    def get_first_part(self, client, obj):
+        ##Learns the object size and ETag from the first ranged GET
+        try:
+            response = client.get_object(Bucket=obj.bucket, Key=obj.remote_path,
+                                         Range='bytes=0-{0}'.format(self.part_size - 1))
+        except ClientError as ex:
+            if ex.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise
+            ##Empty object
+            response = client.get_object(Bucket=obj.bucket, Key=obj.remote_path)
+        data = response['Body'].read()
+        content_range = response.get('ContentRange')
+        obj.size = int(content_range.split('/')[-1]) if content_range else len(data)
+        obj.etag = response.get('ETag')
+        return data
+
+    def start(self, client, obj):
+        try:
+            data = None
+            missing = None
+            if obj.load_progress():
+                missing = [part for part in range(obj.num_parts()) if part not in obj.parts_done]
+                try:
+                    if missing:
+                        data = self.get_part(client, obj, missing[0])
+                except ObjectChangedError as ex:
+                    logger.info('Restarting download: %s', ex)
+                    missing = None
+            if missing is None:
+                obj.discard_progress()
+                data = self.get_first_part(client, obj)
+                missing = list(range(obj.num_parts()))
+            else:
+                obj.stats['bytes_resumed'] = sum(end - start + 1 for start, end in
+                                                 map(obj.get_range, obj.parts_done))
+            obj.open_tmp_file()
+            if not missing:
+                self.finish(obj)
+                return
+            obj.pending = len(missing)
+            for part in missing[1:]:
+                self.executor.submit(self.fetch_part, client, obj, part)
+            self.write_part(obj, missing[0], data)
+        except Exception as ex:
+            obj.error = ex
+            self.finish(obj)
+
+    def fetch_part(self, client, obj, part):
+        try:
+            if obj.error:
+                ##Another part failed, the remaining parts are resumed on the next attempt
+                data = None
+            else:
+                data = self.get_part(client, obj, part)
+        except Exception as ex:
+            obj.error = ex
+            data = None
+        self.write_part(obj, part, data)
+
+    def write_part(self, obj, part, data):
+        ##Must account for every submitted part, the last one to finish completes the download
+        if data is not None:
+            try:
+                os.pwrite(obj.fd, data, part * self.part_size)
+            except OSError as ex:
+                obj.error = ex
+                data = None
+        with obj.lock:
+            if data is not None:
+                obj.parts_done.add(part)
+                obj.stats['gets'] += 1
+                obj.stats['bytes_downloaded'] += len(data)
+                if obj.num_parts() > 1:
+                    try:
+                        obj.save_progress()
+                    except OSError as ex:
+                        logger.warning('Failed to save download progress of %s: %s', obj.remote_path, ex)
+            obj.pending -= 1
+            last = obj.pending == 0
+        if last:
+            self.finish(obj)
+
+    def finish(self, obj):
+        try:
+            if obj.fd is not None:
+                os.close(obj.fd)
+            if not obj.error:
+                logger.debug('rename %s to %s', obj.tmp_local_file, obj.local_path)
+                os.rename(obj.tmp_local_file, obj.local_path)
+                obj.discard_progress()
+        except Exception as ex:
+            obj.error = obj.error or ex
+        obj.done.set()
+
+
+downloader = None
+downloader_lock = threading.Lock()
+
+
+def get_downloader():
+    global downloader
+    with downloader_lock:
+        if downloader is None:
+            downloader = ParallelDownloader()
+        return downloader
+
+
+def download_objects_batch(downloads, infinstor_time_spec=None, client=None):
+    """
+    Downloads (bucket, key, local_path[, tmp_local_file]) objects concurrently on the pool
+    shared by all batches of this process. Each object is written to tmp_local_file, by
+    default local_path + '.tmp', and renamed to local_path when complete; an earlier
+    partial download of the same object version is resumed. Returns for every object the
+    bytes downloaded, GETs issued and bytes resumed from an earlier attempt.
+    """
+    if client:
+        s3_client = client
+    else:
+        s3_client = get_s3_client(infinstor_time_spec)
+    return get_downloader().download(downloads, s3_client)
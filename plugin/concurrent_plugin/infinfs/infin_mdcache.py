@@ -0,0 +1,91 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_MAX_ENTRIES = 1000000
+
+
+class DirListing:
+    def __init__(self, prefix, list_response):
+        self.prefix = prefix
+        self.list_response = list_response
+        self.created = time.time()
+        ##name relative to prefix -> size and ETag for objects, and the set of sub folder names
+        self.files = dict()
+        self.etags = dict()
+        self.folders = set()
+        for key in list_response.get('Contents', []):
+            name = key['Key'][len(prefix):]
+            if name and not name.endswith('/'):
+                self.files[name] = int(key['Size'])
+                if 'ETag' in key:
+                    self.etags[name] = key['ETag']
+        for key in list_response.get('CommonPrefixes', []):
+            name = key['Prefix'][len(prefix):].rstrip('/')
+            if name:
+                self.folders.add(name)
+
+    def num_entries(self):
+        return len(self.files) + len(self.folders) + 1
+
+
+class MetadataCache:
+    """
+    LRU cache of remote directory listings keyed by the remote prefix, with a time to live.
+    The size cap is the total number of objects and folders held across all listings.
+    """
+    def __init__(self, ttl=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.listings = OrderedDict()
+        self.num_entries = 0
+        self.lock = threading.Lock()
+
+    def get(self, prefix):
+        with self.lock:
+            listing = self.listings.get(prefix)
+            if not listing:
+                return None
+            if time.time() - listing.created > self.ttl:
+                self._remove(prefix)
+                return None
+            self.listings.move_to_end(prefix)
+            return listing
+
+    def put(self, prefix, list_response):
+        listing = DirListing(prefix, list_response)
+        if listing.num_entries() > self.max_entries:
+            return listing
+        with self.lock:
+            if prefix in self.listings:
+                self._remove(prefix)
+            self.listings[prefix] = listing
+            self.num_entries += listing.num_entries()
+            while self.num_entries > self.max_entries:
+                self._remove(next(iter(self.listings)))
+        return listing
+
+    def lookup(self, parent_prefix, name):
+        ##Returns ('file', size), ('directory', None), (None, None) if the name does not
+        ##exist in a cached listing, or None if the parent listing is not cached
+        listing = self.get(parent_prefix)
+        if not listing:
+            return None
+        if name in listing.files:
+            return 'file', listing.files[name]
+        elif name in listing.folders:
+            return 'directory', None
+        else:
+            return None, None
+
+    def lookup_etag(self, parent_prefix, name):
+        listing = self.get(parent_prefix)
+        if not listing:
+            return None
+        return listing.etags.get(name)
+
+    def _remove(self, prefix):
+        listing = self.listings.pop(prefix)
+        self.num_entries -= listing.num_entries()
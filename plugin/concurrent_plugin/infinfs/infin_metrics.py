@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+##Every process hosting mounts writes the metrics of its mounts to <dir>/<pid>.json this often,
+##the sidecar uploads the directory with the run logs
+INFINFS_METRICS_DIR = os.environ.get('INFINFS_METRICS_DIR', '/tmp/infinfs-metrics')
+INFINFS_METRICS_INTERVAL = int(os.environ.get('INFINFS_METRICS_INTERVAL', 30))
+##Serve the same json on http://127.0.0.1:<port>/ if set
+INFINFS_METRICS_PORT = int(os.environ.get('INFINFS_METRICS_PORT', 0))
+
+##Upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        buckets = dict(zip([str(b) for b in self.bounds] + ['+Inf'], self.counts))
+        return {'count': self.count, 'sum': round(self.sum, 6), 'max': round(self.max, 6),
+                'buckets': buckets}
+
+
+class InfinMetrics:
+    """
+    Counters and latency histograms of one mount, updated from the FUSE threads.
+    """
+    def __init__(self, mountpoint):
+        self.mountpoint = mountpoint
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if not histogram:
+                histogram = Histogram()
+                self.histograms[name] = histogram
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {'mountpoint': self.mountpoint,
+                    'uptime_seconds': round(time.time() - self.start_time, 3),
+                    'counters': dict(self.counters),
+                    'histograms': {name: h.snapshot() for name, h in self.histograms.items()}}
+
+
+##mountpoint -> InfinMetrics of the mounts hosted by this process
+registered_metrics = dict()
+registry_lock = threading.Lock()
+reporter = None
+
+
+def register(metrics):
+    global reporter
+    with registry_lock:
+        registered_metrics[metrics.mountpoint] = metrics
+        if reporter is None:
+            reporter = MetricsReporter()
+            reporter.start()
+
+
+def unregister(metrics):
+    with registry_lock:
+        if registered_metrics.get(metrics.mountpoint) is metrics:
+            registered_metrics.pop(metrics.mountpoint)
+
+
+def get_all_snapshots():
+    with registry_lock:
+        all_metrics = list(registered_metrics.values())
+    return {'pid': os.getpid(), 'time': time.time(),
+            'mounts': [metrics.snapshot() for metrics in all_metrics]}
+
+
+def write_metrics_file(metrics_dir=INFINFS_METRICS_DIR):
+    os.makedirs(metrics_dir, exist_ok=True)
+    metrics_file = os.path.join(metrics_dir, '{0}.json'.format(os.getpid()))
+    tmp_file = metrics_file + '.tmp'
+    with open(tmp_file, 'w') as fh:
+        json.dump(get_all_snapshots(), fh, indent=1)
+    ##The sidecar may read the file at any time
+    os.replace(tmp_file, metrics_file)
+    return metrics_file
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(get_all_snapshots(), indent=1).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsReporter:
+    def __init__(self, interval=INFINFS_METRICS_INTERVAL, port=INFINFS_METRICS_PORT):
+        self.interval = interval
+        self.port = port
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='infin-metrics', daemon=True)
+
+    def start(self):
+        if self.port:
+            try:
+                server = ThreadingHTTPServer(('127.0.0.1', self.port), MetricsRequestHandler)
+                threading.Thread(target=server.serve_forever, name='infin-metrics-http', daemon=True).start()
+                logger.info('Serving InfinFS metrics on port %d', self.port)
+            except OSError as ex:
+                ##Another mount process already serves the port
+                logger.warning('Not serving InfinFS metrics on port %d: %s', self.port, ex)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                write_metrics_file()
+            except Exception as ex:
+                logger.warning('Failed to write InfinFS metrics: %s', ex)
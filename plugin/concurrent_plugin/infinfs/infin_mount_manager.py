@@ -0,0 +1,89 @@
+import os
+import threading
+import traceback
+
+from concurrent_plugin.infinfs.infinfs import InfinFS
+from concurrent_plugin.infinfs import infin_metrics
+from concurrent_plugin.infinfs.mount_main import start_prefetch, launch_fuse_infinfs, unmount_infinfs
+
+DEFAULT_MOUNT_TIMEOUT = 300
+##How long a failed mount waits for its FUSE thread to exit before leaving it to a watcher
+ABANDON_JOIN_TIMEOUT = 10
+
+
+class InfinMount:
+    def __init__(self, ifs):
+        self.ifs = ifs
+        self.error = None
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def serve(self):
+        try:
+            ##FUSE must stay in the foreground, it runs its request loop on this thread
+            launch_fuse_infinfs(self.ifs, foreground=True)
+            self.error = 'FUSE loop exited'
+        except Exception as ex:
+            traceback.print_exc()
+            self.error = ex
+        finally:
+            ##Unblock a waiter if the mount failed before the FUSE handshake
+            self.ifs.mounted.set()
+
+    def is_alive(self):
+        return self.thread.is_alive() and os.path.ismount(self.ifs.get_mountpoint())
+
+    def abandon(self, join_timeout=ABANDON_JOIN_TIMEOUT):
+        ##Undo everything mount() set up for a mount that failed or timed out
+        ifs = self.ifs
+        if ifs.prefetcher:
+            ifs.prefetcher.stop()
+        infin_metrics.unregister(ifs.metrics)
+        unmount_infinfs(ifs.get_mountpoint())
+        self.thread.join(join_timeout)
+        if self.thread.is_alive():
+            ##Still in the FUSE handshake, it may complete the mount after we gave up on it
+            threading.Thread(target=self.unmount_when_mounted, daemon=True).start()
+        ##Guarded, FUSE calls destroy again if the loop ever unmounts
+        ifs.destroy('/')
+
+    def unmount_when_mounted(self):
+        self.ifs.mounted.wait()
+        unmount_infinfs(self.ifs.get_mountpoint())
+        self.thread.join()
+
+
+class MountManager:
+    """
+    Hosts any number of InfinFS mounts in the calling process, one FUSE loop thread per
+    mount. mount() returns as soon as the kernel has completed the FUSE handshake.
+    """
+    def __init__(self):
+        self.mounts = dict()
+        self.lock = threading.Lock()
+
+    def mount(self, mount_specs, use_cache=True, shadow_path=None, timeout=DEFAULT_MOUNT_TIMEOUT):
+        mountpoint = mount_specs['mountpoint']
+        with self.lock:
+            existing = self.mounts.get(mountpoint)
+            if existing and existing.is_alive():
+                print("{0} is already mounted".format(mountpoint))
+                return existing.ifs
+            ifs = InfinFS(mount_specs, shadow_path=shadow_path, use_cache=use_cache)
+            start_prefetch(ifs, mount_specs.get('prefetch_list'))
+            infin_mount = InfinMount(ifs)
+            self.mounts[mountpoint] = infin_mount
+        print("Waiting for mountpoint {0} to be visible".format(mountpoint))
+        infin_mount.thread.start()
+        if not ifs.mounted.wait(timeout) or infin_mount.error is not None:
+            error = infin_mount.error or 'timed out after {0} seconds'.format(timeout)
+            with self.lock:
+                if self.mounts.get(mountpoint) is infin_mount:
+                    self.mounts.pop(mountpoint)
+            infin_mount.abandon()
+            raise Exception('Failed to mount {0}: {1}'.format(mountpoint, error))
+        print("{0} mounted successfully".format(mountpoint))
+        return ifs
+
+
+##Shared by all mount requests served by this process
+mount_manager = MountManager()
@@ -0,0 +1,46 @@
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+OBJECT_STORE_DIR = 'objects'
+
+
+class ObjectStore:
+    """
+    Content addressed store of downloaded objects, shared by all mounts under one cache
+    root. An entry is keyed by (bucket, key, ETag, time_spec), so any mount that reads the
+    same version of an object, whatever its mountpoint or mount spec, can hardlink the
+    cached bytes into its own shadow tree instead of downloading them again.
+    """
+    def __init__(self, cache_root):
+        self.store_location = os.path.join(cache_root, OBJECT_STORE_DIR)
+        os.makedirs(self.store_location, exist_ok=True)
+
+    def get_store_path(self, bucket, key, etag, infinstor_time_spec):
+        content_key = json.dumps([bucket, key, etag.strip('"'), infinstor_time_spec])
+        digest = hashlib.sha256(content_key.encode('utf-8')).hexdigest()
+        return os.path.join(self.store_location, digest[:2], digest)
+
+    def link_into(self, store_path, local_shadow_path):
+        ##Returns True if the object was found in the store and linked into the shadow tree
+        try:
+            os.link(store_path, local_shadow_path)
+        except FileExistsError:
+            return True
+        except FileNotFoundError:
+            return False
+        logger.debug('Linked cached object %s to %s', store_path, local_shadow_path)
+        return True
+
+    def publish(self, local_shadow_path, store_path):
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        try:
+            os.link(local_shadow_path, store_path)
+        except FileExistsError:
+            pass
+        except OSError as ex:
+            logger.warning('Failed to add %s to the object store: %s', local_shadow_path, ex)
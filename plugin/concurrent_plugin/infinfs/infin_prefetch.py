@@ -1,44 +1,87 @@
-import sys
 import os
-import asyncio
-import boto3
-import time
-
-def get_s3_client():
-    return boto3.client('s3')
-
-async def download_one_object(local_path, bucket, remote_path, tmp_location):
-    s3_client = get_s3_client()
-    local_tmp_path = tmp_location + "/" + os.path.basename(local_path)
-    s3_client.download_file(bucket, remote_path, local_tmp_path)
-    os.rename(local_tmp_path, local_path)
-
-async def download_batch(batchfile, tmp_location):
-    fh = open(batchfile, "r")
-    all_lines = fh.readlines()
-    taskList = []
-    for line in all_lines:
-        local_path, bucket, remote_path = line.split(' ')
-        t = asyncio.create_task(download_one_object(local_path, bucket, remote_path, tmp_location))
-        taskList.append(t)
-
-    for t in taskList:
-        await t
-
-
-def prefetch(local_cache_metadata):
-    batch_localtion = local_cache_metadata +"/batches"
-    tmp_location = local_cache_metadata +"/tmp"
-    while (True):
-        batchlist = os.listdir(batch_localtion)
-        if batchlist:
-            for batchfile in batchlist:
-                asyncio.run(download_batch(batchfile, tmp_location))
-                done_location = local_cache_metadata +"/done_batches"
-                os.rename(batchfile, done_location)
-        else:
-            print("Done")
-
-
-if __name__ == '__main__':
-    prefetch(sys.argv[1])
\ No newline at end of file
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PREFETCH_WINDOW = 16
+DEFAULT_PREFETCH_WORKERS = 8
+
+
+def load_prefetch_list(prefetch_list_file):
+    ##One mount relative path per line, in the order the task reads them
+    with open(prefetch_list_file, 'r', encoding='utf-8') as fh:
+        return ['/' + line.rstrip('\n').lstrip('/') for line in fh if line.strip()]
+
+
+def write_prefetch_list(prefetch_list_file, relative_paths):
+    with open(prefetch_list_file, 'w', encoding='utf-8') as fh:
+        for rel_path in relative_paths:
+            fh.write(rel_path + '\n')
+
+
+class Prefetcher:
+    """
+    Downloads the files of a mount into its shadow location ahead of the task.
+    The task's read position is the last file of the list it opened through FUSE, and at
+    most 'window' files beyond that position are scheduled, 'max_workers' at a time.
+    """
+    def __init__(self, ifs, paths, window=DEFAULT_PREFETCH_WINDOW, max_workers=DEFAULT_PREFETCH_WORKERS):
+        self.ifs = ifs
+        self.paths = paths
+        self.window = window
+        self.path_index = dict()
+        for i, path in enumerate(paths):
+            self.path_index.setdefault(path, i)
+        self.position = 0
+        self.next_to_submit = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='infin-prefetch')
+        self.thread = threading.Thread(target=self.run, name='infin-prefetch-scheduler', daemon=True)
+
+    def start(self):
+        logger.info('Starting prefetch of %d files, window %d', len(self.paths), self.window)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.executor.shutdown(wait=False)
+
+    def notify_open(self, path):
+        index = self.path_index.get(path)
+        if index is None:
+            return
+        with self.cond:
+            if index + 1 > self.position:
+                self.position = index + 1
+                self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopped and self.next_to_submit >= self.position + self.window:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                ##Files the task has already opened are fetched on demand, skip past them
+                self.next_to_submit = max(self.next_to_submit, self.position)
+                if self.next_to_submit >= len(self.paths):
+                    break
+                path = self.paths[self.next_to_submit]
+                self.next_to_submit += 1
+            self.executor.submit(self.prefetch_one, path)
+        logger.info('All prefetch requests scheduled')
+
+    def prefetch_one(self, path):
+        with self.cond:
+            if self.stopped or self.path_index[path] < self.position:
+                return
+        try:
+            self.ifs.prefetch(path)
+        except Exception as ex:
+            logger.warning('Prefetch failed for %s: %s', path, ex)
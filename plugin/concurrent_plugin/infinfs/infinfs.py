@@ -1,20 +1,53 @@
 from __future__ import print_function
 import os
+import time
 import builtins
 import json
+import logging
 import mlflow
 from fuse import Operations
 from urllib.parse import urlparse
 import sys
 from concurrent_plugin.infinfs import infin_download
+from concurrent_plugin.infinfs.infin_blockcache import BlockCachedFile, DEFAULT_BLOCK_SIZE
+from concurrent_plugin.infinfs.infin_mdcache import MetadataCache, DEFAULT_TTL_SECONDS, DEFAULT_MAX_ENTRIES
+from concurrent_plugin.infinfs.infin_object_store import ObjectStore
+from concurrent_plugin.infinfs.infin_metrics import InfinMetrics
+from concurrent_plugin.infinfs import infin_metrics
+from concurrent_plugin.infinfs.infin_cache_manager import get_cache_manager, release_cache_manager, \
+    DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, DEFAULT_CHECK_INTERVAL
 import boto3
+from botocore.config import Config
 import hashlib
 import shutil
 import tempfile
+import threading
+from contextlib import contextmanager
 
 ##This import is required
 from infinstor import infin_boto3
 
+##Level of all infinfs loggers, DEBUG logs every FUSE operation
+INFINFS_LOG_LEVEL = os.environ.get('INFINFS_LOG_LEVEL', 'INFO').upper()
+logging.getLogger('concurrent_plugin.infinfs').setLevel(INFINFS_LOG_LEVEL)
+logger = logging.getLogger(__name__)
+
+##'block' fetches byte ranges on read, 'whole' downloads the entire object on open
+INFINFS_READ_MODE = os.environ.get('INFINFS_READ_MODE', 'block').lower()
+INFINFS_BLOCK_SIZE = int(os.environ.get('INFINFS_BLOCK_SIZE', DEFAULT_BLOCK_SIZE))
+##In block mode the prefetcher fetches only this many leading blocks of each file, 0 disables it
+INFINFS_PREFETCH_BLOCKS = int(os.environ.get('INFINFS_PREFETCH_BLOCKS', 1))
+##Directory listing cache, TTL in seconds and cap on the number of cached objects and folders
+INFINFS_MD_CACHE_TTL = int(os.environ.get('INFINFS_MD_CACHE_TTL', DEFAULT_TTL_SECONDS))
+INFINFS_MD_CACHE_MAX_ENTRIES = int(os.environ.get('INFINFS_MD_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+##Connection pool size of the S3 client shared by all FUSE threads
+INFINFS_MAX_POOL_CONNECTIONS = int(os.environ.get('INFINFS_MAX_POOL_CONNECTIONS', 32))
+##Shadow cache capacity in bytes, 0 means the filesystem holding the cache, with everything
+##stored on it counting as usage, and the usage fractions at which eviction starts and stops
+INFINFS_CACHE_MAX_BYTES = int(os.environ.get('INFINFS_CACHE_MAX_BYTES', 0))
+INFINFS_CACHE_HIGH_WATERMARK = float(os.environ.get('INFINFS_CACHE_HIGH_WATERMARK', DEFAULT_HIGH_WATERMARK))
+INFINFS_CACHE_LOW_WATERMARK = float(os.environ.get('INFINFS_CACHE_LOW_WATERMARK', DEFAULT_LOW_WATERMARK))
+INFINFS_CACHE_CHECK_INTERVAL = int(os.environ.get('INFINFS_CACHE_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL))
 
 def get_cache_key(mount_spec):
    return hashlib.md5(json.dumps(mount_spec).encode('utf-8')).hexdigest()
@@ -33,26 +66,66 @@ class InfinFS(Operations):
         shadowbasename = "infin-" + mountbasename + "-shadow"
         cache_key = get_cache_key(mount_specs)
         if shadow_path:
-            self.shadow_location = os.path.join(shadow_path, '.concurrent', cache_key, shadowbasename)
+            cache_root = os.path.join(shadow_path, '.concurrent')
         else:
             tmpdir = tempfile.mkdtemp()
-            self.shadow_location = os.path.join(tmpdir, '.concurrent', cache_key, shadowbasename)
+            cache_root = os.path.join(tmpdir, '.concurrent')
+        self.shadow_location = os.path.join(cache_root, cache_key, shadowbasename)
         if not os.path.exists(self.shadow_location):
             os.makedirs(self.shadow_location)
         elif not use_cache:
             shutil.rmtree(self.shadow_location)
             os.mkdir(self.shadow_location)
+        self.use_cache = use_cache
+        ##Downloaded objects are shared with other mounts through the content addressed store
+        self.object_store = ObjectStore(cache_root)
         self.s3_client = self.get_s3_client()
-        print(self.prefix, self.mountpoint, self.shadow_location, self.bucket, self.s3_client)
+        self.md_cache = MetadataCache(ttl=INFINFS_MD_CACHE_TTL, max_entries=INFINFS_MD_CACHE_MAX_ENTRIES)
+        self.block_mode = INFINFS_READ_MODE == 'block'
+        self.block_size = INFINFS_BLOCK_SIZE
+        ##local_shadow_path -> BlockCachedFile, and fh -> local_shadow_path for open files
+        self.block_files = dict()
+        self.open_block_fhs = dict()
+        ##Guards the maps above; per-file locks coalesce concurrent downloads of the same file
+        self.lock = threading.Lock()
+        self.path_locks = dict()
+        ##Set by mount_main when the task supplied the ordered list of files it will read
+        self.prefetcher = None
+        ##Shadow files with an open fh are pinned in the cache, fh -> local_shadow_path
+        self.pinned_fhs = dict()
+        ##Shared with the other mounts of this process on the same cache_root
+        self.cache_manager = get_cache_manager(cache_root, max_bytes=INFINFS_CACHE_MAX_BYTES,
+                                               high_watermark=INFINFS_CACHE_HIGH_WATERMARK,
+                                               low_watermark=INFINFS_CACHE_LOW_WATERMARK,
+                                               check_interval=INFINFS_CACHE_CHECK_INTERVAL)
+        self.cache_manager_released = False
+        ##Set once the kernel has completed the FUSE handshake and the mountpoint is live
+        self.mounted = threading.Event()
+        ##S3 calls, bytes downloaded, cache hits and I/O latencies of this mount
+        self.metrics = InfinMetrics(self.mountpoint)
+        infin_metrics.register(self.metrics)
+        logger.info('Mounting s3://%s/%s at %s, shadow location %s', self.bucket, self.prefix,
+                    self.mountpoint, self.shadow_location)
 
     def get_mountpoint(self):
         return self.mountpoint
 
+    def init(self, path):
+        self.mounted.set()
+
+    def destroy(self, path):
+        ##Called by FUSE on unmount
+        with self.lock:
+            released, self.cache_manager_released = self.cache_manager_released, True
+        if not released:
+            release_cache_manager(self.cache_manager)
+
     def get_s3_client(self):
+        config = Config(max_pool_connections=INFINFS_MAX_POOL_CONNECTIONS)
         if self.infinstor_time_spec:
-            return boto3.client('s3', infinstor_time_spec=self.infinstor_time_spec)
+            return boto3.client('s3', infinstor_time_spec=self.infinstor_time_spec, config=config)
         else:
-            return boto3.client('s3')
+            return boto3.client('s3', config=config)
 
 
     def get_bucket_prefix(self, s3path):
@@ -81,35 +154,57 @@ class InfinFS(Operations):
         return spath
 
 
+    @contextmanager
+    def path_lock(self, local_shadow_path):
+        with self.lock:
+            entry = self.path_locks.get(local_shadow_path)
+            if not entry:
+                entry = [threading.Lock(), 0]
+                self.path_locks[local_shadow_path] = entry
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.path_locks[local_shadow_path]
+
     def _full_path(self, partial):
         if partial.startswith("/"):
             partial = partial[1:]
         path = os.path.join(self.mountpoint, partial)
         return path
 
-    def get_file_type(self, s3_list_response):
-        if s3_list_response.get('CommonPrefixes', None):
-            return 'directory'
-        elif 'Contents' in s3_list_response:
-            if len(s3_list_response['Contents']) > 1 \
-                    or s3_list_response['Contents'][0]['Key'].endswith('/') \
-                    or s3_list_response['Contents'][0]['Size'] == 0:
-                return 'directory'
-            else:
-                return 'file'
-        else:
-            return None
+    def get_file_type(self, remote_path, s3_list_response):
+        ##Same rule as the cached listings of readdir: a key is a file whatever its size, a
+        ##common prefix is a directory. The listing of remote_path also has its siblings that
+        ##share the prefix, e.g. remote_path + '.txt', so only exact matches count
+        for key in s3_list_response.get('Contents', []):
+            if key['Key'] == remote_path:
+                return 'file', int(key['Size'])
+        for key in s3_list_response.get('CommonPrefixes', []):
+            if key['Prefix'] == remote_path + '/':
+                return 'directory', None
+        return None, None
 
     ##File Methods
 
     def readdir(self, path, fh):
         ##List operation
-        print("Inside readdir ## ", path)
+        logger.debug('readdir %s', path)
         full_path = self._full_path(path)
         prefix = self.get_remote_path(full_path)
         prefix = prefix + '/'
-        obj_list_response = self.get_remote_ls(prefix)
-        print(obj_list_response)
+        listing = self.md_cache.get(prefix)
+        if listing:
+            self.metrics.incr('listing_cache_hits')
+            obj_list_response = listing.list_response
+        else:
+            self.metrics.incr('listing_cache_misses')
+            obj_list_response = self.get_remote_ls(prefix)
+            self.md_cache.put(prefix, obj_list_response)
         dirents = ['.', '..']
         if 'Contents' in obj_list_response:
             for key in obj_list_response['Contents']:
@@ -130,43 +225,244 @@ class InfinFS(Operations):
                 local_shadow_folder = self.get_shadow_path(folder_path)
                 st = self.create_folder(local_shadow_folder)
                 dirents.append(rel_path)
-        print(dirents)
+        logger.debug('readdir %s: %d entries', path, len(dirents))
         for r in dirents:
             yield r
 
     def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        with self.lock:
+            bfile = self.block_files.get(self.open_block_fhs.get(fh))
+        if bfile:
+            start = time.perf_counter()
+            bfile.ensure_range(offset, length)
+            self.metrics.observe('read_blocked_seconds', time.perf_counter() - start)
+        ##pread, the same fh may be read from several FUSE threads
+        return os.pread(fh, length, offset)
 
     def open(self, path, flags):
+        if self.prefetcher:
+            self.prefetcher.notify_open(path)
+        full_path = self._full_path(path)
+        local_shadow_path = self.get_shadow_path(full_path)
+        with self.metrics.timed('open_seconds'):
+            fh = self.open_shadow_file(full_path, local_shadow_path, flags)
+        self.cache_manager.pin(local_shadow_path, fh)
+        with self.lock:
+            self.pinned_fhs[fh] = local_shadow_path
+        return fh
+
+    def open_shadow_file(self, full_path, local_shadow_path, flags):
+        if os.path.exists(local_shadow_path):
+            self.metrics.incr('shadow_cache_hits')
+            return os.open(local_shadow_path, flags)
+        ##Concurrent opens of the same file wait here for the one in-flight download
+        with self.path_lock(local_shadow_path):
+            ##Size and ETag of the object, looked up at most once for this open
+            object_info = dict()
+            if os.path.exists(local_shadow_path):
+                ##Downloaded by a concurrent open or the prefetcher while we waited
+                self.metrics.incr('shadow_cache_hits')
+            elif self.link_from_object_store(full_path, local_shadow_path, object_info):
+                self.metrics.incr('object_store_hits')
+            else:
+                self.metrics.incr('shadow_cache_misses')
+            if self.block_mode and not os.path.exists(local_shadow_path):
+                return self.open_block_file(full_path, local_shadow_path, flags, object_info)
+            if not os.path.exists(local_shadow_path):
+                remote_path = self.get_remote_path(full_path)
+                tmp_shadow_file = self.get_temporary_shadow_file(local_shadow_path, ".tmp")
+                with self.metrics.timed('open_download_seconds'):
+                    self.download_object(local_shadow_path, tmp_shadow_file, remote_path)
+                self.publish_to_object_store(local_shadow_path)
+        return os.open(local_shadow_path, flags)
+
+    def download_object(self, local_shadow_path, tmp_shadow_file, remote_path):
+        ##Fetched on the pool shared by all mounts, resuming an interrupted download of the same version
+        stats = infin_download.download_objects_batch([(self.bucket, remote_path, local_shadow_path,
+                                                        tmp_shadow_file)],
+                                                      self.infinstor_time_spec, self.s3_client)[0]
+        self.metrics.incr('s3_get_calls', stats['gets'])
+        self.metrics.incr('bytes_downloaded', stats['bytes_downloaded'])
+        self.metrics.incr('bytes_resumed', stats['bytes_resumed'])
+        self.cache_manager.record_added(os.path.getsize(local_shadow_path), files=1)
+
+    def prefetch(self, path):
+        ##Download the whole object into the shadow location, unless it is already
+        ##there or is being read block by block. In block mode only the leading blocks
+        ##are fetched, the task may never read the rest
+        if self.block_mode and INFINFS_PREFETCH_BLOCKS <= 0:
+            return
         full_path = self._full_path(path)
         local_shadow_path = self.get_shadow_path(full_path)
-        if not os.path.exists(local_shadow_path):
+        if os.path.exists(local_shadow_path):
+            return
+        with self.path_lock(local_shadow_path):
+            with self.lock:
+                if local_shadow_path in self.block_files:
+                    return
+            if os.path.exists(local_shadow_path):
+                return
+            os.makedirs(os.path.dirname(local_shadow_path), exist_ok=True)
+            object_info = dict()
+            if self.link_from_object_store(full_path, local_shadow_path, object_info):
+                return
+            if self.block_mode:
+                self.prefetch_blocks(full_path, local_shadow_path, object_info)
+                return
             remote_path = self.get_remote_path(full_path)
             tmp_shadow_file = self.get_temporary_shadow_file(local_shadow_path, ".tmp")
-            infin_download.download_objects(local_shadow_path, tmp_shadow_file, self.bucket,
-                                        remote_path, self.infinstor_time_spec, self.s3_client)
-        return os.open(local_shadow_path, flags)
+            with self.metrics.timed('prefetch_download_seconds'):
+                self.download_object(local_shadow_path, tmp_shadow_file, remote_path)
+            self.remove_partial_shadow_files(local_shadow_path)
+            self.publish_to_object_store(local_shadow_path)
+
+    def prefetch_blocks(self, full_path, local_shadow_path, object_info):
+        ##Called with the path lock held, the blocks are kept in the bitmap for the next open
+        bfile = self.new_block_file(full_path, local_shadow_path, object_info)
+        try:
+            with self.metrics.timed('prefetch_download_seconds'):
+                bfile.ensure_range(0, INFINFS_PREFETCH_BLOCKS * self.block_size)
+            self.metrics.incr('prefetch_block_files')
+        finally:
+            bfile.close()
+
+    def get_object_info(self, remote_path, object_info=None):
+        ##Size and ETag from the cached parent listing, or from one HEAD. Memoized in
+        ##object_info, so that an open looks the object up once
+        if object_info is None:
+            object_info = dict()
+        if 'etag' not in object_info:
+            parent_prefix, name = self.split_remote_path(remote_path)
+            cached = self.md_cache.lookup(parent_prefix, name)
+            etag = self.md_cache.lookup_etag(parent_prefix, name)
+            if cached and cached[0] == 'file' and etag:
+                object_info['size'] = cached[1]
+                object_info['etag'] = etag
+            else:
+                self.metrics.incr('s3_head_calls')
+                response = infin_download.head_object(self.bucket, remote_path,
+                                                      self.infinstor_time_spec, self.s3_client)
+                object_info['size'] = int(response['ContentLength'])
+                object_info['etag'] = response['ETag']
+        return object_info
+
+    def get_object_store_path(self, local_shadow_path, object_info=None):
+        remote_path = self.get_remote_path(self.mountpoint + local_shadow_path[len(self.shadow_location):])
+        etag = self.get_object_info(remote_path, object_info)['etag']
+        return self.object_store.get_store_path(self.bucket, remote_path, etag, self.infinstor_time_spec)
+
+    def link_from_object_store(self, full_path, local_shadow_path, object_info=None):
+        ##Called with the path lock held
+        if not self.use_cache:
+            return False
+        with self.lock:
+            if local_shadow_path in self.block_files:
+                return False
+        try:
+            store_path = self.get_object_store_path(local_shadow_path, object_info)
+        except Exception as ex:
+            logger.warning('Object store lookup failed for %s: %s', full_path, ex)
+            return False
+        os.makedirs(os.path.dirname(local_shadow_path), exist_ok=True)
+        if not self.object_store.link_into(store_path, local_shadow_path):
+            return False
+        self.remove_partial_shadow_files(local_shadow_path)
+        return True
+
+    def on_block_file_complete(self, local_shadow_path):
+        ##The bytes were counted as the blocks were fetched
+        self.cache_manager.record_added(0, files=1)
+        self.publish_to_object_store(local_shadow_path)
+
+    def publish_to_object_store(self, local_shadow_path):
+        try:
+            store_path = self.get_object_store_path(local_shadow_path)
+        except Exception as ex:
+            logger.warning('Object store publish failed for %s: %s', local_shadow_path, ex)
+            return
+        self.object_store.publish(local_shadow_path, store_path)
+
+    def remove_partial_shadow_files(self, local_shadow_path):
+        ##The complete object supersedes the placeholder and any blocks fetched earlier
+        for suffix in (".tmp", ".tmp" + infin_download.PROGRESS_SUFFIX, ".blocks"):
+            partial_file = self.get_temporary_shadow_file(local_shadow_path, suffix)
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+
+    def new_block_file(self, full_path, local_shadow_path, object_info=None):
+        ##Called with the path lock held
+        remote_path = self.get_remote_path(full_path)
+        tmp_shadow_file = self.get_temporary_shadow_file(local_shadow_path, ".tmp")
+        ##Reuses the lookup of the object store path, the blocks are fetched from this version only
+        object_info = self.get_object_info(remote_path, object_info)
+        if os.path.exists(tmp_shadow_file):
+            ##Created by getattr/readdir and truncated to the remote object size
+            size = os.lstat(tmp_shadow_file).st_size
+        else:
+            size = object_info['size']
+            self.create_tmp_file(local_shadow_path, size)
+        bitmap_file = self.get_temporary_shadow_file(local_shadow_path, ".blocks")
+        return BlockCachedFile(local_shadow_path, tmp_shadow_file, bitmap_file, self.bucket,
+                               remote_path, size, self.block_size, self.infinstor_time_spec,
+                               self.s3_client, on_complete=self.on_block_file_complete,
+                               metrics=self.metrics, etag=object_info['etag'],
+                               on_fetch=self.cache_manager.record_added)
+
+    def open_block_file(self, full_path, local_shadow_path, flags, object_info=None):
+        ##Called with the path lock held
+        with self.lock:
+            bfile = self.block_files.get(local_shadow_path)
+        if not bfile:
+            bfile = self.new_block_file(full_path, local_shadow_path, object_info)
+            if bfile.complete:
+                bfile.close()
+                return os.open(local_shadow_path, flags)
+            with self.lock:
+                self.block_files[local_shadow_path] = bfile
+        ##Reads are served through the block cache, the caller only gets read access
+        try:
+            fh = os.open(bfile.tmp_shadow_file, os.O_RDONLY)
+        except FileNotFoundError:
+            ##Last block was fetched by a concurrent reader and the file was renamed
+            return os.open(local_shadow_path, flags)
+        with self.lock:
+            self.open_block_fhs[fh] = local_shadow_path
+        return fh
 
     def get_remote_ls(self, prefix):
-        print("#get_remote_ls#  Bucket = " + self.bucket + ", prefix = " + prefix)
-        client = self.get_s3_client()
-        paginator = client.get_paginator('list_objects_v2')
+        logger.debug('get_remote_ls bucket %s, prefix %s', self.bucket, prefix)
+        paginator = self.s3_client.get_paginator('list_objects_v2')
         pages = paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/')
 
         contents = []
         common_prefixes = []
-        for page in pages:
-            if 'Contents' in page:
-                contents.extend(page['Contents'])
-            if 'CommonPrefixes' in page:
-                common_prefixes.extend(page['CommonPrefixes'])
+        with self.metrics.timed('list_seconds'):
+            for page in pages:
+                self.metrics.incr('s3_list_calls')
+                if 'Contents' in page:
+                    contents.extend(page['Contents'])
+                if 'CommonPrefixes' in page:
+                    common_prefixes.extend(page['CommonPrefixes'])
         obj_list_response = {'Contents': contents, 'CommonPrefixes': common_prefixes}
-        print(obj_list_response)
+        logger.debug('get_remote_ls %s: %d objects, %d prefixes', prefix, len(contents), len(common_prefixes))
         return obj_list_response
 
 
     def release(self, path, fh):
+        with self.lock:
+            pinned_path = self.pinned_fhs.pop(fh, None)
+            local_shadow_path = self.open_block_fhs.get(fh)
+        if pinned_path:
+            self.cache_manager.unpin(pinned_path)
+        if local_shadow_path:
+            with self.path_lock(local_shadow_path):
+                bfile = None
+                with self.lock:
+                    del self.open_block_fhs[fh]
+                    if local_shadow_path not in self.open_block_fhs.values():
+                        bfile = self.block_files.pop(local_shadow_path)
+                if bfile:
+                    bfile.close()
         return os.close(fh)
 
     def statfs(self, path):
@@ -175,40 +471,67 @@ class InfinFS(Operations):
                                                          'f_blocks', 'f_bsize', 'f_favail', 'f_ffree', 'f_files',
                                                          'f_flag',
                                                          'f_frsize', 'f_namemax'))
-        print('statfs #', stat)
+        if self.cache_manager.max_bytes:
+            ##Report the shadow cache capacity and usage instead of the whole filesystem
+            capacity, used = self.cache_manager.get_capacity_and_usage()
+            frsize = stv.f_frsize
+            stat['f_blocks'] = capacity // frsize
+            stat['f_bfree'] = max(capacity - used, 0) // frsize
+            stat['f_bavail'] = min(stat['f_bfree'], stv.f_bavail)
+        logger.debug('statfs %s, shadow cache stats %s', stat, self.cache_manager.get_stats())
         return stat
 
     def getattr(self, path, fh=None):
-        print("Inside getattr path = " + path)
+        logger.debug('getattr %s', path)
         if path == "/":
             st = os.lstat(self.shadow_location)
             return self.get_attr_from_lstat(st)
         full_path = self._full_path(path)
         local_shadow_path = self.get_shadow_path(full_path)
         temp_shadow_file = self.get_temporary_shadow_file(local_shadow_path, ".tmp")
-        print(full_path, local_shadow_path, temp_shadow_file)
         if os.path.exists(local_shadow_path):
             st = os.lstat(local_shadow_path)
         elif os.path.exists(temp_shadow_file):
-            st = os.lstat(temp_shadow_file)
+            try:
+                st = os.lstat(temp_shadow_file)
+            except FileNotFoundError:
+                ##Download completed concurrently
+                st = os.lstat(local_shadow_path)
         else:
             remote_prefix = self.get_remote_path(full_path)
-            list_response = self.get_remote_ls(remote_prefix)
-            ftype = self.get_file_type(list_response)
+            ftype, size = self.get_cached_file_type(remote_prefix)
+            if ftype == "unknown":
+                list_response = self.get_remote_ls(remote_prefix)
+                ftype, size = self.get_file_type(remote_prefix, list_response)
             if ftype == "directory":
                 st = self.create_folder(local_shadow_path)
             elif ftype == 'file':
-                st, tmp_shadow_file = self.create_tmp_file(local_shadow_path, int(list_response['Contents'][0]['Size']))
+                st, tmp_shadow_file = self.create_tmp_file(local_shadow_path, size)
             else:
                 return dict()
         attr = self.get_attr_from_lstat(st)
         return attr
 
+    def split_remote_path(self, remote_path):
+        ##Parent prefix as used by readdir to key its listing, and the name within it
+        if '/' in remote_path:
+            parent, name = remote_path.rsplit('/', 1)
+            return parent + '/', name
+        else:
+            return '/', remote_path
+
+    def get_cached_file_type(self, remote_path):
+        ##Answer from the cached listing of the parent folder, if readdir has listed it
+        parent_prefix, name = self.split_remote_path(remote_path)
+        cached = self.md_cache.lookup(parent_prefix, name)
+        if cached is None:
+            return "unknown", None
+        return cached
+
     def get_attr_from_lstat(self, st):
         stat = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
                                                         'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size',
                                                         'st_uid'))
-        print('get_attr_from_lstat #', stat)
         return stat
 
     def create_folder(self, shadow_path):
@@ -225,11 +548,20 @@ class InfinFS(Operations):
     def create_tmp_file(self, local_shadow_path, size=0):
         tmp_shadow_file = self.get_temporary_shadow_file(local_shadow_path, ".tmp")
         if not os.path.exists(tmp_shadow_file):
-            with open(tmp_shadow_file, "w") as fh:
+            ##Size the file under a private name and link it in place, so that a racing
+            ##thread never truncates a file that is being filled or sees it half created
+            private_tmp_file = tmp_shadow_file + "." + str(threading.get_ident())
+            with open(private_tmp_file, "w") as fh:
                 fh.close()
             #Truncate to actual filesize
             #Note: when the download starts, the file size will be reset
-            os.truncate(tmp_shadow_file, size)
+            os.truncate(private_tmp_file, size)
+            try:
+                os.link(private_tmp_file, tmp_shadow_file)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(private_tmp_file)
         return os.lstat(tmp_shadow_file), tmp_shadow_file
     ## Following methods will do nothing,
     ## but, will not throw exception
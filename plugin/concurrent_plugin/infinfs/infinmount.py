@@ -10,6 +10,9 @@ INPUT_SPEC_CONFIG = '/root/.concurrent-data/inputdataspec'
 
 VERBOSE = True
 
+##Host mounts in the calling process instead of starting a mount_main process per mount
+INFINFS_MOUNT_IN_PROCESS = os.environ.get('INFINFS_MOUNT_IN_PROCESS', 'True').lower() == 'true'
+
 def get_input_spec_json(input_name=None):
     config_path = INPUT_SPEC_CONFIG
     if 'MLFLOW_RUN_ID' in os.environ:
@@ -29,6 +32,12 @@ def get_input_spec_json(input_name=None):
 
 
 def perform_mount(mountpoint_path, mount_spec_object, use_cache=True, shadow_path=None):
+    if INFINFS_MOUNT_IN_PROCESS:
+        ##Imported here, the task container uses this module without fuse
+        from concurrent_plugin.infinfs.infin_mount_manager import mount_manager
+        mount_spec_object['mountpoint'] = mountpoint_path
+        mount_manager.mount(mount_spec_object, use_cache=use_cache, shadow_path=shadow_path)
+        return
     mounted_paths_list = []
     mounted_paths_list.append(mountpoint_path)
     mount_spec_str = json.dumps(mount_spec_object)
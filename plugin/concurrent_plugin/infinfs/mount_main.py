@@ -1,26 +1,53 @@
 import sys
 import os
 import json
+import logging
 import subprocess
 
 from fuse import FUSE, fuse_exit
 from concurrent_plugin.infinfs.infinfs import InfinFS
+from concurrent_plugin.infinfs import infin_prefetch
 
 VERBOSE = True
 
-def launch_fuse_infinfs(ifs):
-    mountpath = ifs.get_mountpoint()
+##Serve FUSE requests from multiple threads, so that a slow download does not stall other readers
+INFINFS_MULTITHREADED = os.environ.get('INFINFS_MULTITHREADED', 'True').lower() == 'true'
+
+##Number of files to stay ahead of the task's read position, and parallel downloads
+INFINFS_PREFETCH_WINDOW = int(os.environ.get('INFINFS_PREFETCH_WINDOW', infin_prefetch.DEFAULT_PREFETCH_WINDOW))
+INFINFS_PREFETCH_WORKERS = int(os.environ.get('INFINFS_PREFETCH_WORKERS', infin_prefetch.DEFAULT_PREFETCH_WORKERS))
+
+def start_prefetch(ifs, prefetch_list_file):
+    if not prefetch_list_file or INFINFS_PREFETCH_WINDOW <= 0:
+        return None
+    try:
+        paths = infin_prefetch.load_prefetch_list(prefetch_list_file)
+    except Exception as ex:
+        print('Failed to load prefetch list {0}: {1}'.format(prefetch_list_file, ex))
+        return None
+    prefetcher = infin_prefetch.Prefetcher(ifs, paths, window=INFINFS_PREFETCH_WINDOW,
+                                           max_workers=INFINFS_PREFETCH_WORKERS)
+    ifs.prefetcher = prefetcher
+    prefetcher.start()
+    return prefetcher
+
+
+def unmount_infinfs(mountpath):
     if os.path.ismount(mountpath):
         umountp = subprocess.Popen(['umount', '-lf', mountpath], stdout=sys.stdout, stderr=subprocess.STDOUT)
         umountp.wait()
-    if VERBOSE:
-        FUSE(ifs, mountpath, nothreads=True, foreground=True)
-    else:
-        FUSE(ifs, mountpath, nothreads=True, foreground=False)
+
+
+def launch_fuse_infinfs(ifs, foreground=VERBOSE):
+    mountpath = ifs.get_mountpoint()
+    unmount_infinfs(mountpath)
+    nothreads = not INFINFS_MULTITHREADED
+    FUSE(ifs, mountpath, nothreads=nothreads, foreground=foreground)
     print("exiting")
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     mount_spec_str = sys.argv[1]
     mount_specs = json.loads(mount_spec_str)
     use_cache_str = sys.argv[2]
@@ -40,5 +67,6 @@ if __name__ == '__main__':
         exit(-1)
 
     ifs = InfinFS(mount_specs, shadow_path=shadow_base_path, use_cache=use_cache)
+    start_prefetch(ifs, mount_specs.get('prefetch_list'))
     launch_fuse_infinfs(ifs)
     exit(0)
\ No newline at end of file
@@ -0,0 +1,51 @@
+import json
+import struct
+
+##Messages are JSON objects, each preceded by its length as a 4 byte big endian integer.
+##A client sends {'op': 'mount', 'id': <n>, 'mounts': [<mount request>, ...]}, the server
+##answers with one {'id', 'mount_path', 'status', 'error'} message per mount as soon as
+##that mount completes, in completion order, and then {'id': <n>, 'status': 'done'}.
+HEADER = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+STATUS_SUCCESS = 'success'
+STATUS_FAILED = 'failed'
+STATUS_DONE = 'done'
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_message(sock):
+    ##Returns None when the peer has closed the connection
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError('Mount protocol message too large: ' + str(size))
+    data = _recv_exactly(sock, size)
+    if data is None:
+        raise ConnectionError('Connection closed in the middle of a message')
+    return json.loads(data.decode('utf-8'))
+
+
+def get_mount_request(mount_path, mount_spec, shadow_path, use_cache):
+    return {
+        'mount_path': mount_path,
+        'mount_spec': mount_spec,
+        'shadow_path': shadow_path if shadow_path else 'None',
+        'use_cache': 'True' if use_cache else 'False'
+    }
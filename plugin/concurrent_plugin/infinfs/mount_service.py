@@ -1,19 +1,22 @@
 import socket
+import socketserver
+import threading
 import time
 import os
-from concurrent_plugin.infinfs import infinmount
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent_plugin.infinfs import infinmount, mount_protocol, infin_metrics
 import json
 import yaml
 from mlflow.tracking import MlflowClient
 import psutil
-from concurrent_plugin.concurrent_backend import MOUNT_SERVICE_READY_MARKER_FILE
+from concurrent_plugin.concurrent_backend import MOUNT_SERVICE_READY_MARKER_FILE, MOUNT_SERVICE_SOCKET
 import concurrent_plugin.utils
 import logging
 import requests
 import subprocess
 # importing it as kubernetes.client since 'client' is used in the code in some places as the Mlflow client.  this mlflow 'client' conflicts with 'from kubernetes import client'.  Need to cleanup.
 import kubernetes.client
-from kubernetes import client, config
+from kubernetes import client, config, watch
 import dpath
 from datetime import datetime
 
@@ -26,8 +29,29 @@ VERBOSE = False
 
 mlflow_run_status = None
 
+##Mounts of one batched request that are created concurrently
+MOUNT_WORKERS = int(os.environ.get('CONCURRENT_MOUNT_WORKERS', '8'))
+
+##Newly fetched log lines are uploaded as a log part once this many bytes or seconds accumulate
+LOG_UPLOAD_BYTES = int(os.environ.get('CONCURRENT_LOG_UPLOAD_BYTES', 1024*1024))
+LOG_UPLOAD_INTERVAL = int(os.environ.get('CONCURRENT_LOG_UPLOAD_INTERVAL', 180))
+##Extra seconds of log requested on each fetch, covers clock skew between this container and the node
+LOG_SINCE_SLACK_SECONDS = 10
+
+##container name -> PodLogTailer
+log_tailers = dict()
+
+##Seconds between log fetches, and the server side timeout of one pod watch request
+LOG_FETCH_INTERVAL = 15
+POD_WATCH_TIMEOUT = 300
+
+last_metrics_upload_time = 0
+
 def parse_mount_request(data):
-    req = json.loads(data.decode('utf-8'))
+    return parse_mount_request_object(json.loads(data.decode('utf-8')))
+
+
+def parse_mount_request_object(req):
     if req['use_cache'].lower() == 'false':
         use_cache = False
     else:
@@ -42,6 +66,70 @@ def parse_mount_request(data):
 def print_info(*args):
     print(str(datetime.utcnow()), *args, flush=True)
 
+
+def perform_mount_request(req):
+    mount_path, mount_spec, shadow_path, use_cache = parse_mount_request_object(req)
+    print_info("mount request {}, {}, {}, {}".format(mount_path, mount_spec, shadow_path, use_cache))
+    infinmount.perform_mount(mount_path, mount_spec, shadow_path=shadow_path, use_cache=use_cache)
+    return mount_path
+
+
+def serve_mount_batch(batch, send):
+    ##Mounts run concurrently, each one is reported as soon as it completes
+    with ThreadPoolExecutor(max_workers=MOUNT_WORKERS) as executor:
+        futures = {executor.submit(perform_mount_request, req): req for req in batch['mounts']}
+        for future in as_completed(futures):
+            response = {'id': batch.get('id'), 'mount_path': futures[future]['mount_path']}
+            try:
+                future.result()
+                response['status'] = mount_protocol.STATUS_SUCCESS
+                print_info("mount successful: " + response['mount_path'])
+            except Exception as ex:
+                print_info('Exception in mounting: '+str(ex))
+                response['status'] = mount_protocol.STATUS_FAILED
+                response['error'] = str(ex)
+            send(response)
+    send({'id': batch.get('id'), 'status': mount_protocol.STATUS_DONE})
+
+
+class MountRequestHandler(socketserver.BaseRequestHandler):
+    ##One connection carries any number of batched mount requests
+    def handle(self):
+        while True:
+            batch = mount_protocol.recv_message(self.request)
+            if batch is None:
+                return
+            serve_mount_batch(batch, lambda msg: mount_protocol.send_message(self.request, msg))
+
+
+def start_mount_server():
+    if os.path.exists(MOUNT_SERVICE_SOCKET):
+        os.remove(MOUNT_SERVICE_SOCKET)
+    server = socketserver.ThreadingUnixStreamServer(MOUNT_SERVICE_SOCKET, MountRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Listening on ' + MOUNT_SERVICE_SOCKET, flush=True)
+    return server
+
+
+def serve_tcp_mount_requests(s):
+    ##Single request per connection, for clients that predate the framed protocol
+    while True:
+        conn, addr = s.accept()
+        with conn:
+            print_info(f"Connected by {addr}")
+            data = conn.recv(1024*16)
+            if not data:
+                continue
+            try:
+                perform_mount_request(json.loads(data.decode('utf-8')))
+                response = "success".encode('utf-8')
+                print_info("mount successful")
+            except Exception as ex:
+                print_info('Exception in mounting: '+str(ex))
+                response = str(ex).encode('utf-8')
+            conn.send(response)
+
 def mount_service_ready():
     ##Create empty marker file
     if not os.path.exists(MOUNT_SERVICE_READY_MARKER_FILE):
@@ -56,7 +144,7 @@ def read_token(token_file):
                 return token_line[6:]
     return None
 
-def launch_dag_controller():
+def launch_dag_controller(run_id=None, run_status=None):
     infinstor_token = read_token('/root/.concurrent/token')
     mlflow_parallels_uri = os.environ['MLFLOW_CONCURRENT_URI']
     dag_execution_id = os.environ['DAG_EXECUTION_ID']
@@ -71,6 +159,10 @@ def launch_dag_controller():
     logger.info(execute_dag_url)
     headers = {'Content-Type': 'application/json', 'Authorization': infinstor_token}
     body = {'dagid': dagid, 'dag_execution_id': dag_execution_id, "periodic_run_name": periodic_run_name}
+    ##Completion event of this node, the dag controller need not look up the run's status
+    if run_id and run_status:
+      body['run_id'] = run_id
+      body['run_status'] = run_status
     if periodic_run_frequency:
       body['periodic_run_frequency'] = periodic_run_frequency
     if periodic_run_start_time:
@@ -98,44 +190,137 @@ def launch_dag_controller():
 
 def upload_logs_for_pod(k8s_client:kubernetes.client.CoreV1Api, run_id, pod_name, pod_namespace, tmp_log_file, container_name):
     try:
+        ##Flush the last log part before uploading the whole log
+        tailer = log_tailers.get(container_name)
+        if tailer:
+            tailer.upload_pending(run_id, force=True)
         client = MlflowClient()
         client.log_artifact(run_id, tmp_log_file, artifact_path='.concurrent/logs')
     except Exception as ex:
         logger.warning("Failed upload logs for {}, {}: {}".format(run_id, pod_name, ex))
-        
-def add_logs_for_pod(k8s_client:kubernetes.client.CoreV1Api, run_id, pod_name, pod_namespace, log_file, tmp_log_file, container_name):
+
+
+def upload_infinfs_metrics(run_id, force=False):
+    ##Uploads the metrics files of all InfinFS mounts with the run logs, every LOG_UPLOAD_INTERVAL
+    global last_metrics_upload_time
+    if not force and time.time() - last_metrics_upload_time < LOG_UPLOAD_INTERVAL:
+        return
+    last_metrics_upload_time = time.time()
     try:
-        # possible fix if only partial logs are read and full logs can't be read. Note that using follow=True for a running pod may make it wait forever??
-        # https://github.com/kubernetes-client/python/issues/199: Passing follow=True to read_namespaced_pod_log makes it never return #199
-        pod_logs = k8s_client.read_namespaced_pod_log(pod_name, pod_namespace, container=container_name)
-        logger.info(type(pod_logs))
-        with open(tmp_log_file, "w") as fh:
-            fh.write(pod_logs)
-        upload_logs_for_pod(k8s_client, run_id, pod_name, pod_namespace, tmp_log_file,
-                                container_name=container_name)
-        # Merging code
-        with open(log_file,'r+' if os.path.isfile(log_file) else 'w+') as f1,\
-             open(tmp_log_file,'r') as f2:
-                file1 = f1.readlines()
-                file2 = f2.readlines()
-                if len(file1)<=len(file2) and file1 == file2[:len(file1)]:          #check the file1 is in file2
-                    f1.writelines(file2[len(file1):])
-                    
-                elif file1 != [] and file1[-1] in file2:                            #check the common lines in both files
-                    index = 0
-                    ind = file2.index(file1[-1])+1  
-                    while ind<=len(file2):                                          #If there is any common lines,it will find the index and direct you    
-                        if file1[len(file1)-ind:] == file2[:ind]:
-                            index = ind                                   
-                        if file1[-1] in file2[ind:]:                                
-                            ind += file2[ind:].index(file1[-1])+1           
-                        else:
-                            break
-                    f1.writelines(file2[index:])                                    #If there is common line,merge file1 and file2
-                            
-                else:
-                    f1.writelines(file2)                                            #If there is no common line,then append file1 and file2
-                    
+        ##Mounts hosted by this process, mount_main processes write their own files periodically
+        if infin_metrics.registered_metrics:
+            infin_metrics.write_metrics_file()
+        if not os.path.isdir(infin_metrics.INFINFS_METRICS_DIR):
+            return
+        client = MlflowClient()
+        for metrics_file in sorted(os.listdir(infin_metrics.INFINFS_METRICS_DIR)):
+            if metrics_file.endswith('.json'):
+                client.log_artifact(run_id, os.path.join(infin_metrics.INFINFS_METRICS_DIR, metrics_file),
+                                    artifact_path='.concurrent/logs/infinfs-metrics')
+    except Exception as ex:
+        logger.warning("Failed to upload InfinFS metrics for {}: {}".format(run_id, ex))
+
+def parse_log_timestamp(timestamp):
+    ##RFC3339 timestamps from the kubelet, trailing zeros of the fraction are dropped
+    seconds, _, fraction = timestamp.rstrip('Z').partition('.')
+    datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+    return seconds, int(fraction.ljust(9, '0')[:9])
+
+
+class PodLogTailer:
+    """
+    Appends the new lines of a container log to log_file on every fetch. Only the log written
+    since the previous fetch is requested, lines are deduplicated by their kubelet timestamp.
+    """
+    def __init__(self, container_name, log_file):
+        self.container_name = container_name
+        self.log_file = log_file
+        self.last_fetch_time = None
+        self.last_timestamp = None
+        self.lines_at_last_timestamp = 0
+        ##Lines appended since the last uploaded log part
+        self.pending_file = log_file + '.pending'
+        self.pending_bytes = 0
+        self.last_upload_time = time.time()
+        self.part = 0
+
+    def get_new_lines(self, pod_logs):
+        new_lines = []
+        seen_at_timestamp = 0
+        ##Whether the last timestamped line was already appended by an earlier fetch
+        skipping = False
+        ##Only '\n' ends a log line, '\r' progress bars and the like stay inside the line
+        for line in pod_logs.split('\n'):
+            if not line:
+                continue
+            line += '\n'
+            timestamp, _, message = line.partition(' ')
+            try:
+                line_timestamp = parse_log_timestamp(timestamp)
+            except ValueError:
+                ##Not a timestamped line, it goes with the timestamped line before it
+                if not skipping:
+                    new_lines.append(line)
+                continue
+            skipping = True
+            if self.last_timestamp and line_timestamp < self.last_timestamp:
+                continue
+            if line_timestamp == self.last_timestamp:
+                seen_at_timestamp += 1
+                if seen_at_timestamp <= self.lines_at_last_timestamp:
+                    continue
+                self.lines_at_last_timestamp += 1
+            else:
+                self.last_timestamp = line_timestamp
+                self.lines_at_last_timestamp = 1
+                seen_at_timestamp = 1
+            skipping = False
+            new_lines.append(message)
+        return new_lines
+
+    def fetch(self, k8s_client, pod_name, pod_namespace):
+        kwargs = {'container': self.container_name, 'timestamps': True}
+        fetch_time = time.time()
+        if self.last_fetch_time:
+            kwargs['since_seconds'] = int(fetch_time - self.last_fetch_time) + LOG_SINCE_SLACK_SECONDS
+        pod_logs = k8s_client.read_namespaced_pod_log(pod_name, pod_namespace, **kwargs)
+        self.last_fetch_time = fetch_time
+        new_lines = self.get_new_lines(pod_logs)
+        if new_lines:
+            data = ''.join(new_lines)
+            with open(self.log_file, 'a') as fh:
+                fh.write(data)
+            with open(self.pending_file, 'a') as fh:
+                fh.write(data)
+            self.pending_bytes += len(data)
+        return len(new_lines)
+
+    def upload_pending(self, run_id, force=False):
+        ##Uploads the lines appended since the last upload as the next log part
+        if not self.pending_bytes:
+            return
+        if not force and self.pending_bytes < LOG_UPLOAD_BYTES \
+                and time.time() - self.last_upload_time < LOG_UPLOAD_INTERVAL:
+            return
+        self.part += 1
+        root, ext = os.path.splitext(self.log_file)
+        part_file = '{0}-part-{1:05d}{2}'.format(root, self.part, ext)
+        os.replace(self.pending_file, part_file)
+        self.pending_bytes = 0
+        self.last_upload_time = time.time()
+        client = MlflowClient()
+        client.log_artifact(run_id, part_file, artifact_path='.concurrent/logs')
+        os.remove(part_file)
+
+
+def add_logs_for_pod(k8s_client:kubernetes.client.CoreV1Api, run_id, pod_name, pod_namespace, log_file, container_name):
+    try:
+        tailer = log_tailers.get(container_name)
+        if not tailer:
+            tailer = log_tailers[container_name] = PodLogTailer(container_name, log_file)
+        num_lines = tailer.fetch(k8s_client, pod_name, pod_namespace)
+        logger.info("Fetched {} new log lines for {}".format(num_lines, container_name))
+        tailer.upload_pending(run_id)
     except Exception as ex:
         logger.warning("Failed to fetch logs for {}, {}: {}".format(run_id, pod_name, ex))
         return
@@ -209,9 +394,99 @@ def log_describe_pod(k8s_client:kubernetes.client.CoreV1Api, run_id, pod_name, p
         logger.warning('Failed to log describe pod, try again later: ' + str(ex))
         return
 
-def _fetch_upload_pod_status_logs(k8s_client:client.CoreV1Api, run_id, pod_name, pod_namespace, log_suffix:int):
+def get_task_container_state(pod_info:client.V1Pod):
+    container_statuses = pod_info.status.container_statuses
+    if not container_statuses or len(container_statuses) < 2:
+        return None
+    # the order of 'status/container_statuses' is not always the order of 'spec/containers'
+    task_index=0
+    if container_statuses[0].name.startswith('sidecar-'): task_index=1
+    return container_statuses[task_index].state
+
+
+class PodWatcher:
+    """
+    Watches this pod through the API server and keeps its latest state in pod_info.
+    task_terminated is set as soon as the task container terminates.
+    """
+    def __init__(self, k8s_client:client.CoreV1Api, pod_name, pod_namespace):
+        self.k8s_client = k8s_client
+        self.pod_name = pod_name
+        self.pod_namespace = pod_namespace
+        self.pod_info = None
+        self.resource_version = None
+        ##Set on every pod update, cleared by whoever consumes pod_info
+        self.changed = threading.Event()
+        self.task_terminated = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def on_pod_event(self, event_type, pod_info):
+        self.resource_version = pod_info.metadata.resource_version
+        self.pod_info = pod_info
+        self.changed.set()
+        if event_type == 'DELETED':
+            ##This container is being stopped as well
+            print_info('Pod deleted')
+            return
+        task_container_state = get_task_container_state(pod_info)
+        if task_container_state and task_container_state.terminated:
+            print_info('Task container terminated')
+            self.task_terminated.set()
+
+    def on_watch_error(self, status):
+        code = status.get('code') if isinstance(status, dict) else None
+        if code == 410:
+            ##Start over from the current pod
+            print_info('Pod watch expired, restarting')
+            self.resource_version = None
+        else:
+            print_info(f'Pod watch error: {status}, retrying')
+            time.sleep(5)
+
+    def run(self):
+        while not self.task_terminated.is_set():
+            try:
+                pod_watch = watch.Watch()
+                ##Resumes after the last seen version, without one the current pod comes first as ADDED
+                for event in pod_watch.stream(self.k8s_client.list_namespaced_pod, self.pod_namespace,
+                                              field_selector='metadata.name=' + self.pod_name,
+                                              resource_version=self.resource_version,
+                                              timeout_seconds=POD_WATCH_TIMEOUT):
+                    if event['type'] == 'ERROR':
+                        ##A Status object instead of a pod, e.g. code 410 when the resource version is too old
+                        pod_watch.stop()
+                        self.on_watch_error(event.get('raw_object') or event['object'])
+                        break
+                    self.on_pod_event(event['type'], event['object'])
+                    if self.task_terminated.is_set():
+                        pod_watch.stop()
+                        break
+            except kubernetes.client.exceptions.ApiException as ex:
+                if ex.status == 410:
+                    ##The resource version is too old, start over from the current pod
+                    print_info('Pod watch expired, restarting')
+                    self.resource_version = None
+                else:
+                    print_info(f'Pod watch failed: {ex}, retrying')
+                    time.sleep(5)
+            except Exception as ex:
+                print_info(f'Pod watch failed: {ex}, retrying')
+                time.sleep(5)
+
+
+def _fetch_upload_pod_status_logs(k8s_client:client.CoreV1Api, run_id, pod_name, pod_namespace, pod_watcher=None):
     try:
-        pod_info:client.V1Pod = k8s_client.read_namespaced_pod(pod_name, pod_namespace)
+        if pod_watcher and pod_watcher.pod_info:
+            ##Only describe the pod again if it has changed
+            describe_pod = pod_watcher.changed.is_set()
+            pod_watcher.changed.clear()
+            pod_info:client.V1Pod = pod_watcher.pod_info
+        else:
+            describe_pod = True
+            pod_info:client.V1Pod = k8s_client.read_namespaced_pod(pod_name, pod_namespace)
         if pod_info.spec.containers[1].name.startswith('sidecar-'):
             sidecar_index = 1
             task_index = 0
@@ -220,11 +495,13 @@ def _fetch_upload_pod_status_logs(k8s_client:client.CoreV1Api, run_id, pod_name,
             task_index = 1
         task_container_name = pod_info.spec.containers[task_index].name
         side_car_container_name = pod_info.spec.containers[sidecar_index].name
-        log_describe_pod(k8s_client, run_id, pod_name, pod_namespace, pod_info)
-        add_logs_for_pod(k8s_client, run_id, pod_name, pod_namespace, "/tmp/run-logs.txt", f"/tmp/run-logs-{log_suffix}.txt",
+        if describe_pod:
+            log_describe_pod(k8s_client, run_id, pod_name, pod_namespace, pod_info)
+        add_logs_for_pod(k8s_client, run_id, pod_name, pod_namespace, "/tmp/run-logs.txt",
                             container_name=task_container_name)
-        add_logs_for_pod(k8s_client, run_id, pod_name, pod_namespace, "/tmp/sidecar-logs.txt", f"/tmp/sidecar-logs-{log_suffix}.txt",
+        add_logs_for_pod(k8s_client, run_id, pod_name, pod_namespace, "/tmp/sidecar-logs.txt",
                             container_name=side_car_container_name)
+        upload_infinfs_metrics(run_id)
         # status:
         #   conditions:
         #   - lastProbeTime: null
@@ -248,14 +525,11 @@ def _fetch_upload_pod_status_logs(k8s_client:client.CoreV1Api, run_id, pod_name,
         #         exitCode: 0
         #         .
         #         .
-        pod_info_status = pod_info.status
-        container_statuses = pod_info_status.container_statuses
-        # recompute task_index and sidecar_index for the array 'status/container_statuses'.  Earlier computed index using 'spec/containers' will not always be valid for this array .
-        task_index=0; sidecar_index=1
-        if container_statuses[0].name.startswith('sidecar-'): sidecar_index=0; task_index=1
-        task_cont_status = container_statuses[task_index]
-        task_container_state = task_cont_status.state
-        if task_container_state.running:
+        task_container_state = get_task_container_state(pod_info)
+        if task_container_state is None:
+            print(f"Task container has no status yet. Continuing to loop")
+            return True
+        elif task_container_state.running:
             print(f"Task container is in running state. Continuing to loop")
             return True
         elif task_container_state.terminated:
@@ -263,6 +537,7 @@ def _fetch_upload_pod_status_logs(k8s_client:client.CoreV1Api, run_id, pod_name,
                                 container_name=task_container_name)
             upload_logs_for_pod(k8s_client, run_id, pod_name, pod_namespace, "/tmp/sidecar-logs.txt",
                                 container_name=side_car_container_name)
+            upload_infinfs_metrics(run_id, force=True)
             print(f"Task container is in terminated state. Exiting loop")
             return False
         elif task_container_state.waiting:
@@ -275,15 +550,13 @@ def _fetch_upload_pod_status_logs(k8s_client:client.CoreV1Api, run_id, pod_name,
         print(f"_fetch_upload_pod_status_logs: caught {ex}. Continuing to loop")
         return True # continue looping
 
-def get_task_exit_code(k8s_client, pod_name, pod_namespace, num_attempt=1):
+def get_task_exit_code(k8s_client, pod_name, pod_namespace, num_attempt=1, pod_info=None):
     max_attempts = 3
-    pod_info:client.V1Pod = k8s_client.read_namespaced_pod(pod_name, pod_namespace)
+    if pod_info is None:
+        pod_info:client.V1Pod = k8s_client.read_namespaced_pod(pod_name, pod_namespace)
     try:
         # see yaml further above for pod/status/containter_statuses structure
-        if pod_info.status.container_statuses[1].name.startswith('sidecar-'):
-            exitCode = pod_info.status.container_statuses[0].state.terminated.exit_code
-        else:
-            exitCode = pod_info.status.container_statuses[1].state.terminated.exit_code
+        exitCode = get_task_container_state(pod_info).terminated.exit_code
         logger.info("Task container finished with exitCode " + str(exitCode))
         return exitCode
     except Exception as ex:
@@ -297,6 +570,8 @@ def get_task_exit_code(k8s_client, pod_name, pod_namespace, num_attempt=1):
 
 
 if __name__ == '__main__':
+    ##Sends the leveled logs of the mount service and the InfinFS mounts it hosts to the sidecar's log
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     print_info("Starting..")
     HOST = "127.0.0.1"
     PORT = 7963
@@ -313,57 +588,37 @@ if __name__ == '__main__':
         pod_namespace = os.getenv('MY_POD_NAMESPACE')
         dag_execution_id = os.getenv('DAG_EXECUTION_ID')
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(15)
             s.bind((HOST, PORT))
             print('Mount/Monitor service starting for runid {0}, and podname {1}'.format(run_id, pod_name), flush=True)
             print('Listening on port {}:{}'.format(HOST, PORT), flush=True)
             s.listen()
+            ##Mount requests are served on their own threads, so that pod monitoring below never delays a mount
+            threading.Thread(target=serve_tcp_mount_requests, args=(s,), daemon=True).start()
+            start_mount_server()
             try:
                 mount_service_ready()
             except Exception as ex:
                 print(f"mount_service: Caught {ex} while marking mount service ready. Ignoring", flush=True)
-            i = 0
+            pod_watcher = PodWatcher(k8s_client, pod_name, pod_namespace)
+            pod_watcher.start()
             while True:
-                print_info('Waiting for request..')
-                try:
-                    conn, addr = s.accept()
-                except socket.timeout:
-                    print_info('accept timed out')
-                    pass
-                else:
-                    with conn:
-                        print_info(f"Connected by {addr}")
-                        data = conn.recv(1024*16)
-                        if not data:
-                            time.sleep(1)
-                            continue
-                        try:
-                            mount_path, mount_spec, shadow_path, use_cache = parse_mount_request(data)
-                            print_info("mount request {}, {}, {}, {}".format(
-                                mount_path, mount_spec, shadow_path, use_cache))
-                            infinmount.perform_mount(mount_path, mount_spec, shadow_path=shadow_path, use_cache=use_cache)
-                            response = "success".encode('utf-8')
-                            print_info("mount successful")
-                        except Exception as ex:
-                            print_info('Exception in mounting: '+str(ex))
-                            response = str(ex).encode('utf-8')
-                        conn.send(response)
-                if not _fetch_upload_pod_status_logs(k8s_client, run_id, pod_name, pod_namespace, int(i/12)):   # i/12 so that we don't create a new log once every 15 seconds
+                ##Wakes up as soon as the watch sees the task container terminate
+                pod_watcher.task_terminated.wait(LOG_FETCH_INTERVAL)
+                if not _fetch_upload_pod_status_logs(k8s_client, run_id, pod_name, pod_namespace, pod_watcher):
                     print_info("Task process done, exiting mount service")
-                    exitCode = get_task_exit_code(k8s_client, pod_name, pod_namespace)
+                    exitCode = get_task_exit_code(k8s_client, pod_name, pod_namespace, pod_info=pod_watcher.pod_info)
                     if exitCode == 0:
                         update_mlflow_run(run_id, "FINISHED")
                         mlflow_run_status = "FINISHED"
                     else:
                         update_mlflow_run(run_id, "FAILED")
                         mlflow_run_status = "FAILED"
-                    _fetch_upload_pod_status_logs(k8s_client, run_id, pod_name, pod_namespace, int(i/12))   # i/12 so that we don't create a new log once every 15 seconds
+                    _fetch_upload_pod_status_logs(k8s_client, run_id, pod_name, pod_namespace, pod_watcher)
                     if dag_execution_id:
-                        launch_dag_controller()
+                        launch_dag_controller(run_id, mlflow_run_status)
                     else:
                         print_info('Not a dag execution, skip dag controller')
                     exit(0)
-                i+=1
     except Exception as e1:
         if mlflow_run_status:
             print(f"mount_service: Caught {e1}. mlflow_run_status={mlflow_run_status}. Doing nothing", flush=True)
@@ -0,0 +1,135 @@
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class DagScheduler:
+    """
+    Incremental ready set of a DAG execution, saved in the 'scheduler' entry of the dag
+    execution status. Every node is in exactly one of: waiting, with the count of its
+    unfinished dependencies; ready; running, i.e. launched and not finished; or completed.
+    A finished node only decrements the counters of its successors, so the callbacks do
+    not rescan the whole graph. The successors of the nodes are saved with the state, a
+    callback only builds the graph of the dag if it has nodes to launch.
+    """
+    def __init__(self, indegree, ready, running, completed, failed_run=None, outgoing=None):
+        self.indegree = indegree
+        self.ready = ready
+        self.running = running
+        self.completed = completed
+        self.failed_run = failed_run
+        ##node -> successors, nodes without successors are left out
+        self.outgoing = outgoing if outgoing is not None else dict()
+
+    @classmethod
+    def build(cls, dag_graph, outgoing_graph, node_statuses):
+        ##Full scan, only when the execution starts or its graph was changed outside the scheduler
+        indegree = dict()
+        ready = list()
+        running = set()
+        completed = set()
+        for node, node_status in node_statuses.items():
+            if node_status['status'] == 'FINISHED':
+                completed.add(node)
+            elif node_status['status'] != 'PENDING':
+                running.add(node)
+        failed_run = None
+        for node in running:
+            if node_statuses[node]['status'] == 'FAILED':
+                failed_run = node_statuses[node]['run_id']
+                break
+        for node, node_status in node_statuses.items():
+            if node_status['status'] != 'PENDING':
+                continue
+            num_waiting = len([n for n in dag_graph.get(node, []) if n in node_statuses and n not in completed])
+            if num_waiting:
+                indegree[node] = num_waiting
+            else:
+                ready.append(node)
+        outgoing = {node: list(successors) for node, successors in outgoing_graph.items()
+                    if successors and node in node_statuses}
+        return cls(indegree, ready, running, completed, failed_run, outgoing)
+
+    @classmethod
+    def load(cls, dag_execution_status):
+        ##Returns None if there is no saved state or it does not match the dag nodes, the
+        ##caller then builds the scheduler from the graph
+        node_statuses = dag_execution_status['nodes']
+        state = dag_execution_status.get('scheduler')
+        if not state:
+            return None
+        if 'outgoing' not in state:
+            logger.warning('Scheduler state has no successors, rebuilding it')
+            return None
+        scheduler = cls(state['indegree'], state['ready'], set(state['running']),
+                        set(state['completed']), state.get('failed_run'), state['outgoing'])
+        if scheduler.num_nodes() != len(node_statuses) or scheduler.node_ids() != set(node_statuses):
+            logger.warning('Scheduler state does not match the dag nodes, rebuilding it')
+            return None
+        return scheduler
+
+    def to_dict(self):
+        return {'indegree': self.indegree, 'ready': self.ready, 'running': sorted(self.running),
+                'completed': sorted(self.completed), 'failed_run': self.failed_run,
+                'outgoing': self.outgoing}
+
+    def num_nodes(self):
+        return len(self.indegree) + len(self.ready) + len(self.running) + len(self.completed)
+
+    def node_ids(self):
+        return set(self.indegree).union(self.ready, self.running, self.completed)
+
+    def update(self, node_statuses):
+        ##Picks up the nodes that finished or failed since the last callback
+        for node in list(self.running):
+            status = node_statuses[node]['status']
+            if status == 'FINISHED':
+                self.mark_completed(node)
+            elif status == 'FAILED' and not self.failed_run:
+                self.failed_run = node_statuses[node]['run_id']
+
+    def mark_completed(self, node):
+        if node in self.completed:
+            return
+        self.running.discard(node)
+        self.completed.add(node)
+        for successor in self.outgoing.get(node, []):
+            if successor not in self.indegree:
+                continue
+            self.indegree[successor] -= 1
+            if self.indegree[successor] == 0:
+                self.indegree.pop(successor)
+                self.ready.append(successor)
+
+    def mark_launched(self, nodes):
+        launched = set(nodes)
+        self.ready = [n for n in self.ready if n not in launched]
+        self.running.update(launched)
+
+    def split_node(self, old_node, new_node_ids, outgoing_graph):
+        ##A ready node replaced by its partitions, each successor now waits on all of them
+        self.ready.remove(old_node)
+        self.ready.extend(new_node_ids)
+        self.outgoing.pop(old_node, None)
+        for new_node in new_node_ids:
+            if outgoing_graph.get(new_node):
+                self.outgoing[new_node] = list(outgoing_graph[new_node])
+        for successor in outgoing_graph.get(new_node_ids[0], []):
+            if successor in self.indegree:
+                self.indegree[successor] += len(new_node_ids) - 1
+
+    def get_ready_to_run_nodes(self):
+        """
+        Returns whether the dag execution is done, the nodes ready to run, and the new
+        status of the parent run
+        """
+        if self.failed_run:
+            print('Aborting: run-id ' + self.failed_run + ' failed')
+            return True, [], 'FAILED'
+        elif self.ready:
+            return False, list(self.ready), 'UNFINISHED'
+        elif len(self.completed) == self.num_nodes():
+            return True, [], 'FINISHED'
+        else:
+            return False, [], 'UNFINISHED'
@@ -59,6 +59,65 @@ def create_dag_execution_record(cognito_username, dag_id, dag_execution_id, stat
         raise Exception(status_msg)
     return
 
+##Node completion events of a dag execution are items in DAG_EXECUTION_TABLE with dag_id set to
+##EVENT_KEY_PREFIX + dag_execution_id, and a time ordered dag_execution_id of their own
+EVENT_KEY_PREFIX = 'events#'
+MAX_BATCH_WRITE_ITEMS = 25
+
+def append_dag_execution_event(dag_execution_id, event):
+    client = boto3.client('dynamodb')
+    now = time.time()
+    event_id = '{0:015d}-{1}'.format(int(now * 1000), uuid.uuid4().hex)
+    item = {
+        'dag_id': {'S': EVENT_KEY_PREFIX + dag_execution_id},
+        'dag_execution_id': {'S': event_id},
+        'event': {'S': json.dumps(event)},
+        'update_time': {'N': str(int(now))}
+    }
+    client.put_item(TableName=DAG_EXECUTION_TABLE, Item=item)
+    return event_id
+
+def fetch_dag_execution_events(dag_execution_id, limit=None):
+    """
+    Returns the pending events of the dag execution, oldest first, as a list of
+    (event_id, event) tuples
+    """
+    client = boto3.client('dynamodb')
+    kwargs = {
+        'TableName': DAG_EXECUTION_TABLE,
+        'KeyConditionExpression': 'dag_id = :di',
+        'ExpressionAttributeValues': {':di': {'S': EVENT_KEY_PREFIX + dag_execution_id}},
+        ##Must see every event appended before the call
+        'ConsistentRead': True
+    }
+    if limit:
+        kwargs['Limit'] = limit
+    events = []
+    while True:
+        response = client.query(**kwargs)
+        for item in response.get('Items', []):
+            events.append((item['dag_execution_id']['S'], json.loads(item['event']['S'])))
+        if limit or not response.get('LastEvaluatedKey'):
+            return events
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def delete_dag_execution_events(dag_execution_id, event_ids):
+    client = boto3.client('dynamodb')
+    requests = [{'DeleteRequest': {'Key': {'dag_id': {'S': EVENT_KEY_PREFIX + dag_execution_id},
+                                           'dag_execution_id': {'S': event_id}}}}
+                for event_id in event_ids]
+    for i in range(0, len(requests), MAX_BATCH_WRITE_ITEMS):
+        batch = {DAG_EXECUTION_TABLE: requests[i:i + MAX_BATCH_WRITE_ITEMS]}
+        for attempt in range(5):
+            response = client.batch_write_item(RequestItems=batch)
+            batch = response.get('UnprocessedItems')
+            if not batch:
+                break
+            time.sleep(0.1 * 2 ** attempt)
+        else:
+            logger.warning('Failed to delete ' + str(len(batch[DAG_EXECUTION_TABLE])) + ' events of '
+                           + dag_execution_id)
+
 def get_new_dag_exec_id(dagid):
     return dagid + "-" + str(uuid.uuid1())
 
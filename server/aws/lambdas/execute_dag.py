@@ -15,8 +15,9 @@ import traceback
 
 from utils import get_cognito_user, get_service_conf, create_request_context, get_custom_token
 import lock_utils, dag_utils, run_project
-from mlflow_utils import call_create_run, fetch_run_id_info, update_run, create_experiment, \
-    log_mlflow_artifact, log_params
+from dag_scheduler import DagScheduler
+from mlflow_utils import call_create_run, call_create_runs, fetch_run_id_infos, fetch_child_run_infos, \
+    update_run, create_experiment, log_mlflow_artifact, log_params
 import ddb_mlflow_parallels_txns as ddb_txns
 
 from kubernetes.client.exceptions import ApiException
@@ -26,6 +27,8 @@ from kubernetes.client.exceptions import ApiException
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 DAG_EXECUTION_TABLE = dag_utils.DAG_EXECUTION_TABLE
+##A recheck pass runs for at most the lambda timeout, no other one is started meanwhile
+SCHEDULER_RECHECK_CLAIM_SECONDS = 900
 
 def respond(err, res=None):
     return {
@@ -143,10 +146,45 @@ def execute_dag(event, context):
     print(f"cognito_username={cognito_username}, dag_id={dag_id}, dag_execution_id={dag_execution_id}")
 
     experiment_id = run_params.get('experiment_id')
-    
-    # if dag is already executing and execute_dag() callback (http rest call) invoked by a node in an executing dag
+    recovery = dagParamsJsonRuntime and 'recovery' in dagParamsJsonRuntime \
+        and dagParamsJsonRuntime['recovery'].lower() == 'true'
+
+    # if dag is already executing and execute_dag() callback (http rest call) invoked by a node in an executing dag.
+    # The node's completion is appended to the dag execution's event log, and the scheduler is woken up unless a
+    # scheduler pass is in progress, which picks up the event when it is done.  Callbacks never wait for the lock,
+    # a delayed recheck drains the event if the lambda of the pass in progress dies before it releases the lock.
+    if dag_execution_id and httpOperation:
+        dag_exec_record = dag_utils.get_dag_execution_record(cognito_username, groups, dag_id, dag_execution_id)
+        if not recovery:
+            append_node_event(dag_execution_id, run_params)
+        if recovery or not scheduler_is_active(dag_id, dag_execution_id):
+            invoke_scheduler(service_conf, cognito_username, groups, run_params, dag_execution_id,
+                             wakeup=not recovery)
+        else:
+            schedule_scheduler_recheck(service_conf, cognito_username, groups, run_params, dag_id, dag_execution_id)
+        rv = {'status' : 'success', 'dagExecutionId': dag_execution_id, 'parentRunId': dag_exec_record['parent_run_id']}
+        logger.info("Node event queued, returning http response: " + str(rv))
+        return respond(None, rv)
+
+    # if dag is already executing, run a scheduler pass for the events queued by its nodes
     if dag_execution_id:
-        lock_key, lock_lease_time = acquire_idle_row_lock(dag_id, dag_execution_id)
+        if recovery:
+            ##Recovery resets the node statuses, it waits for the scheduler pass in progress
+            lock_key, lock_lease_time = acquire_idle_row_lock(dag_id, dag_execution_id)
+        else:
+            if not run_params.get('scheduler_wakeup'):
+                append_node_event(dag_execution_id, run_params)
+            if run_params.get('scheduler_recheck'):
+                lock_key, lock_lease_time = recheck_scheduler_lock(service_conf, cognito_username, groups, run_params,
+                                                                   dag_id, dag_execution_id)
+            else:
+                lock_key, lock_lease_time = try_acquire_idle_row_lock(dag_id, dag_execution_id)
+                if not lock_key:
+                    schedule_scheduler_recheck(service_conf, cognito_username, groups, run_params,
+                                               dag_id, dag_execution_id)
+            if not lock_key:
+                print('Scheduler pass in progress for ' + dag_execution_id + ', node event queued')
+                return {'status' : 'success', 'dagExecutionId': dag_execution_id}
         dag_exec_record = dag_utils.fetch_dag_execution_info(cognito_username, groups, dag_id, dag_execution_id)
         dag_json, dag_execution_status, auth_info = dag_exec_record['dag_json'], dag_exec_record['run_status'], dag_exec_record['auth_info']
         token_info = get_custom_token(cognito_username, groups)
@@ -167,8 +205,7 @@ def execute_dag(event, context):
 
         dag_name = dag_json['name']
 
-        if dagParamsJsonRuntime and 'recovery' in dagParamsJsonRuntime \
-            and dagParamsJsonRuntime['recovery'].lower() == 'true':
+        if recovery:
             dag_json = override_dag_runtime_params_for_recovery(dag_json, dagParamsJsonRuntime, dag_execution_status)
 
     else:  # if a new dag execution is starting with an invocation of execute_dag()
@@ -228,43 +265,49 @@ def execute_dag(event, context):
         log_mlflow_artifact(cognito_username, groups, auth_info, parent_run_id, dag_detail_artifact, '.concurrent', 'dag_details.json.bin')
         dag_exec_details_artifact = {'dag_json': dag_json, 'run_status': dag_execution_status}
         log_mlflow_artifact(cognito_username, groups, auth_info, parent_run_id, dag_exec_details_artifact, '.concurrent', dag_utils.DAG_RUNTIME_ARTIFACT)
-        lock_key, lock_lease_time = acquire_idle_row_lock(dag_id, dag_execution_id)
 
-    # if lambda was invoked using http (api gateway), then make an asynchronous invocation using boto3 lambda invocation to avoid a blocked call
-    if httpOperation:
-        release_row_lock(lock_key)
-        logger.info("Invoke a separate lambda asynchronously and return")
-        run_params['username'] = cognito_username
-        if groups:
-            run_params['groups'] = groups
-        if dag_execution_id not in run_params:
-            run_params['dag_execution_id'] = dag_execution_id
-        client = boto3.client('lambda')
-        dag_lambda = service_conf['executeDagLambda']['S']
-        client.invoke(FunctionName=dag_lambda,
-                      InvocationType='Event',
-                      Payload=json.dumps(run_params))
-        rv = {'status' : 'success', 'dagExecutionId': dag_execution_id, 'parentRunId': parent_run_id}
-        logger.info("A separate lambda invoked, returning http response: " + str(rv))
-        return respond(None, rv)
+        # if lambda was invoked using http (api gateway), then make an asynchronous invocation using boto3 lambda invocation to avoid a blocked call
+        if httpOperation:
+            invoke_scheduler(service_conf, cognito_username, groups, run_params, dag_execution_id)
+            rv = {'status' : 'success', 'dagExecutionId': dag_execution_id, 'parentRunId': parent_run_id}
+            logger.info("A separate lambda invoked, returning http response: " + str(rv))
+            return respond(None, rv)
+        lock_key, lock_lease_time = acquire_idle_row_lock(dag_id, dag_execution_id)
 
     # if lambda was invoked directly using boto3 client (async call above).  This is the asynchronous execution of the lambda that happens after a http invocation above
+    events = []
     try:
-        incoming_dag_graph, outgoing_graph, node_dict, edge_dict = get_graph_struct(dag_json)
-        node_statuses, lock_lease_time = fetch_node_status(cognito_username, groups, auth_info, node_dict, dag_execution_status['nodes'],
-                                          lock_key, lock_lease_time)
+        ##Node events queued until now are handled by this pass, those queued later by the next one
+        events = dag_utils.fetch_dag_execution_events(dag_execution_id)
+        print(f'{len(events)} node events queued for {dag_execution_id}')
+        graph_struct = None
+        scheduler = DagScheduler.load(dag_execution_status)
+        if not scheduler:
+            graph_struct = get_graph_struct(dag_json)
+            scheduler = DagScheduler.build(graph_struct[0], graph_struct[1], dag_execution_status['nodes'])
+        apply_node_events(scheduler.running, dag_execution_status['nodes'], events)
+        ##Only the launched nodes can have changed status since the last callback
+        node_statuses, lock_lease_time = fetch_node_status(cognito_username, groups, auth_info, scheduler.running,
+                                                           dag_execution_status['nodes'], lock_key, lock_lease_time,
+                                                           parent_run_id)
         dag_execution_status['nodes'] = node_statuses
-        allDone, ready_to_run, parent_new_status = get_ready_to_run_nodes(incoming_dag_graph, node_statuses)
+        scheduler.update(node_statuses)
+        allDone, ready_to_run, parent_new_status = scheduler.get_ready_to_run_nodes()
+        ##The graph of the dag is only needed to partition and launch the ready nodes
+        if ready_to_run and not graph_struct:
+            graph_struct = get_graph_struct(dag_json)
+        incoming_dag_graph, outgoing_graph, node_dict, edge_dict = graph_struct or (dict(), dict(), dict(), dict())
 
         print(f'Nodes ready to run {ready_to_run}', "Analyze ready nodes for partitioning")
         modified = perform_node_partitioning(ready_to_run, incoming_dag_graph,
-                                             outgoing_graph, node_dict, edge_dict, dag_execution_status)
+                                             outgoing_graph, node_dict, edge_dict, dag_execution_status, scheduler)
         if modified:
             new_dag_json = dag_utils.create_new_dag_json(dag_json, node_dict, edge_dict)
+            dag_execution_status['scheduler'] = scheduler.to_dict()
             update_dag_exec_runtime_info(cognito_username, groups, dag_id, auth_info, new_dag_json, dag_execution_id,
                                          dag_execution_status, parent_run_id)
             ##Evaluate ready to run nodes again
-            allDone, ready_to_run, parent_new_status = get_ready_to_run_nodes(incoming_dag_graph, node_statuses)
+            allDone, ready_to_run, parent_new_status = scheduler.get_ready_to_run_nodes()
             dag_json = new_dag_json
 
         ## Group ready to run nodes by original_node_id
@@ -295,18 +338,21 @@ def execute_dag(event, context):
                     parallelization = node_details.get('parallelization')
                     k8s_params = node_details.get('k8s_params')
                     ##get all input specs
+                    input_data_specs = [get_input_data_spec(n, node_dict[n], dag_execution_status['nodes'], incoming_dag_graph)
+                                        for n in node_list_to_run]
+                    ##create the runs of all partitions together
+                    run_names = [node_dict[n]['name'] for n in node_list_to_run]
+                    created_runs = call_create_runs(cognito_username, groups, experiment_id, auth_info, run_names,
+                                                    parent_run_id, xformname)
                     run_input_spec_map = {}
-                    for n in node_list_to_run:
-                        node_details = node_dict[n]
-                        run_name = node_details['name']
-                        input_data_spec = get_input_data_spec(n, node_dict[n], dag_execution_status['nodes'], incoming_dag_graph)
-                        run_id, artifact_uri, run_status, run_lifecycle_stage = \
-                            call_create_run(cognito_username, groups, experiment_id, auth_info, run_name, parent_run_id, xformname)
+                    for n, input_data_spec, created_run in zip(node_list_to_run, input_data_specs, created_runs):
+                        run_id, artifact_uri, run_status, run_lifecycle_stage = created_run
                         run_input_spec_map[run_id] = input_data_spec
                         run_info = {'run_id': run_id, 'status': run_status, 'artifact_uri': artifact_uri,
                                     'lifecycle_stage': run_lifecycle_stage}
                         dag_execution_status['nodes'][n] = run_info
-                        lock_lease_time = renew_lock(lock_key, lock_lease_time)
+                    scheduler.mark_launched(node_list_to_run)
+                    lock_lease_time = renew_lock(lock_key, lock_lease_time)
 
                     print("Submit bootstrap for node {} to the executor".format(orig_node))
                     ##Compress and encode run_input_spec_map
@@ -388,6 +434,7 @@ def execute_dag(event, context):
                 #release_row_lock(lock_key)
                 return respond("Node launch failed", dict())
 
+        dag_execution_status['scheduler'] = scheduler.to_dict()
         update_dag_run_status(cognito_username, groups, dag_id, auth_info, dag_execution_id, dag_execution_status, parent_run_id)
         rv = {'status' : 'success', 'dagExecutionId': dag_execution_id, 'parentRunId': parent_run_id}
         if allDone:
@@ -404,7 +451,92 @@ def execute_dag(event, context):
         traceback.print_exc()
         raise e
     finally:
-        release_row_lock(lock_key)
+        release_scheduler_lock(service_conf, cognito_username, groups, run_params, dag_execution_id, lock_key, events)
+
+def append_node_event(dag_execution_id, run_params):
+    ##Completion event of the node run reported by the callback, if any
+    event = {'time': int(time.time())}
+    for k in ('run_id', 'run_status'):
+        if run_params.get(k):
+            event[k] = run_params[k]
+    dag_utils.append_dag_execution_event(dag_execution_id, event)
+
+def apply_node_events(launched_nodes, node_statuses, events):
+    ##Statuses reported with the node events need not be fetched from mlflow
+    event_statuses = dict()
+    for _, event in events:
+        if event.get('run_id') and event.get('run_status') in ('FINISHED', 'FAILED'):
+            event_statuses[event['run_id']] = event['run_status']
+    if not event_statuses:
+        return
+    for node in launched_nodes:
+        node_run_info = node_statuses[node]
+        if node_run_info.get('run_id') in event_statuses and node_run_info['status'] == 'RUNNING':
+            node_run_info['status'] = event_statuses[node_run_info['run_id']]
+
+def invoke_scheduler(service_conf, cognito_username, groups, run_params, dag_execution_id, wakeup=True,
+                     recheck=False):
+    ##Asynchronous invocation of this lambda, which runs a scheduler pass for the dag execution.
+    ##With recheck, the pass waits for the lock held by the pass in progress
+    logger.info("Invoke a separate lambda asynchronously for " + dag_execution_id)
+    params = dict(run_params)
+    params['username'] = cognito_username
+    if groups:
+        params['groups'] = groups
+    params['dag_execution_id'] = dag_execution_id
+    if wakeup:
+        ##No event of its own, and recovery is not applied again
+        params['scheduler_wakeup'] = True
+        params.pop('dagParamsJson', None)
+    if recheck:
+        params['scheduler_recheck'] = True
+    else:
+        params.pop('scheduler_recheck', None)
+    client = boto3.client('lambda')
+    dag_lambda = service_conf['executeDagLambda']['S']
+    client.invoke(FunctionName=dag_lambda,
+                  InvocationType='Event',
+                  Payload=json.dumps(params))
+
+def schedule_scheduler_recheck(service_conf, cognito_username, groups, run_params, dag_id, dag_execution_id):
+    ##The pass in progress picks up the queued events when it releases the lock, unless its lambda is killed
+    ##first.  A recheck pass waits out the lock and drains them, only one is pending at a time
+    try:
+        if lock_utils.claim_row_recheck(DAG_EXECUTION_TABLE, create_dag_execution_key(dag_id, dag_execution_id),
+                                        SCHEDULER_RECHECK_CLAIM_SECONDS):
+            invoke_scheduler(service_conf, cognito_username, groups, run_params, dag_execution_id, recheck=True)
+    except Exception as ex:
+        logger.warning('Failed to schedule a scheduler recheck of ' + dag_execution_id + ': ' + str(ex))
+
+def recheck_scheduler_lock(service_conf, cognito_username, groups, run_params, dag_id, dag_execution_id):
+    ##Waits until the pass in progress releases the lock, or stops renewing it for the idle window
+    dag_exec_key = create_dag_execution_key(dag_id, dag_execution_id)
+    try:
+        if not dag_utils.fetch_dag_execution_events(dag_execution_id, limit=1):
+            print('No node events queued for ' + dag_execution_id + ', recheck not needed')
+            return None, None
+        if lock_utils.acquire_idle_row_lock(DAG_EXECUTION_TABLE, dag_exec_key):
+            return dag_exec_key, int(time.time())
+    finally:
+        lock_utils.clear_row_recheck(DAG_EXECUTION_TABLE, dag_exec_key)
+    ##The pass in progress is still renewing the lock, check again later
+    schedule_scheduler_recheck(service_conf, cognito_username, groups, run_params, dag_id, dag_execution_id)
+    return None, None
+
+def release_scheduler_lock(service_conf, cognito_username, groups, run_params, dag_execution_id, lock_key, events):
+    if events:
+        try:
+            dag_utils.delete_dag_execution_events(dag_execution_id, [event_id for event_id, _ in events])
+        except Exception as ex:
+            ##Left over events only cause another scheduler pass
+            logger.warning('Failed to delete the node events of ' + dag_execution_id + ': ' + str(ex))
+    release_row_lock(lock_key)
+    ##Callbacks that found this pass in progress did not wake the scheduler, their events are still queued
+    try:
+        if dag_utils.fetch_dag_execution_events(dag_execution_id, limit=1):
+            invoke_scheduler(service_conf, cognito_username, groups, run_params, dag_execution_id)
+    except Exception as ex:
+        logger.warning('Failed to wake up the scheduler of ' + dag_execution_id + ': ' + str(ex))
 
 def _update_dag_status_mlflow_run_status_upload_logs(cognito_username, groups, dag_execution_status, auth_info, nid, err_dict:dict):
     logger.warning('Marking run_id ' + dag_execution_status['nodes'][nid]['run_id'] + ' as FAILED')
@@ -431,6 +563,15 @@ def acquire_idle_row_lock(dag_id, dag_execution_id):
 def release_row_lock(dag_exec_key):
     lock_utils.release_row_lock(DAG_EXECUTION_TABLE, dag_exec_key)
 
+def try_acquire_idle_row_lock(dag_id, dag_execution_id):
+    dag_exec_key = create_dag_execution_key(dag_id, dag_execution_id)
+    if not lock_utils.try_acquire_idle_row_lock(DAG_EXECUTION_TABLE, dag_exec_key):
+        return None, None
+    return dag_exec_key, int(time.time())
+
+def scheduler_is_active(dag_id, dag_execution_id):
+    return lock_utils.is_row_locked(DAG_EXECUTION_TABLE, create_dag_execution_key(dag_id, dag_execution_id))
+
 def renew_lock(key, lock_lease_time):
     return lock_utils.renew_lock(DAG_EXECUTION_TABLE, key, lock_lease_time)
 
@@ -498,60 +639,37 @@ def get_graph_struct(dag_json):
 
     return incoming_graph, outgoing_graph, node_dict, edge_dict
 
-def fetch_node_status(cognito_username, groups, auth_info, node_details, previous_statuses, lock_key, lock_lease_time):
-    node_statuses = dict()
-    for node in node_details.keys():
-        node_run_info = previous_statuses[node]
-        node_statuses[node] = node_run_info
-        if node_run_info.get('run_id'):
-            run_id = node_run_info['run_id']
-            status = node_run_info['status']
-            if run_id and status == "RUNNING":
-                run_info = fetch_run_id_info(cognito_username, groups, auth_info, run_id)
-                logger.debug('RUN INFO for '+run_id)
-                logger.debug(str(run_info))
-                node_statuses[node].update(run_info)
-                lock_lease_time = renew_lock(lock_key, lock_lease_time)
+def fetch_node_status(cognito_username, groups, auth_info, launched_nodes, node_statuses, lock_key, lock_lease_time,
+                      parent_run_id=None):
+    running_nodes = dict()
+    for node in launched_nodes:
+        node_run_info = node_statuses[node]
+        if node_run_info.get('run_id') and node_run_info['status'] == "RUNNING":
+            running_nodes[node] = node_run_info['run_id']
+    if not running_nodes:
+        return node_statuses, lock_lease_time
+
+    ##All node runs are children of the parent run, fetch their status with one search
+    run_infos = dict()
+    if parent_run_id:
+        try:
+            run_infos = fetch_child_run_infos(cognito_username, groups, auth_info, parent_run_id,
+                                              running_nodes.values())
+        except Exception as ex:
+            logger.warning('Search for child runs of ' + parent_run_id + ' failed: ' + str(ex))
+    missing_run_ids = [run_id for run_id in running_nodes.values() if run_id not in run_infos]
+    if missing_run_ids:
+        run_infos.update(fetch_run_id_infos(cognito_username, groups, auth_info, missing_run_ids))
+    lock_lease_time = renew_lock(lock_key, lock_lease_time)
+
+    for node, run_id in running_nodes.items():
+        run_info = run_infos.get(run_id)
+        logger.debug('RUN INFO for '+run_id)
+        logger.debug(str(run_info))
+        if run_info:
+            node_statuses[node].update(run_info)
     return node_statuses, lock_lease_time
 
-def get_ready_to_run_nodes(dag_graph, node_statuses):
-    ready_to_run = list()
-    failed_run = None
-    for node in dag_graph.keys():
-        if node_statuses[node]['status'] == 'FAILED':
-            failed_run = node_statuses[node]['run_id']
-            break
-        if node_statuses[node]['status'] != 'PENDING':
-            continue
-        dependency_nodes = dag_graph[node]
-        if not dependency_nodes:
-            ready_to_run.append(node)
-        else:
-            all_dependencies_completed = True
-            for n in dependency_nodes:
-                if n in node_statuses and node_statuses[n]['status'] != 'FINISHED':
-                    all_dependencies_completed = False
-                    break
-            if all_dependencies_completed:
-                ready_to_run.append(node)
-
-    if failed_run:
-        print('Aborting: run-id ' + node_statuses[node]['run_id'] + ' failed')
-        return True, [], 'FAILED'
-    elif not ready_to_run:
-        all_done = True
-        for n in node_statuses.keys():
-            if node_statuses[n]['status'] != 'FINISHED':
-                all_done = False
-                break
-        if all_done:
-            return True, [], 'FINISHED'
-        else:
-            return False, [], 'UNFINISHED'
-    else:
-        return False, ready_to_run, 'UNFINISHED'
-
-
 def get_xform_details(node_details):
     if 'transform' in node_details:
         xformname = node_details['transform']
@@ -731,7 +849,8 @@ def override_dag_runtime_params_for_recovery(dag_json, dagParamsJsonRuntime, dag
             run_status['previous_attempts'].append(prev_run_id)
             dag_execution_status['nodes'][json_node['id']] \
                 = {'status': 'PENDING', 'previous_attempts': run_status['previous_attempts']}
-
+    ##Failed nodes are pending again, the scheduler state is rebuilt from the node statuses
+    dag_execution_status.pop('scheduler', None)
 
     return dag_json
 
@@ -768,7 +887,7 @@ def update_dag_exec_runtime_info(cognito_username, groups, dag_id, auth_info, da
 
 
 def perform_node_partitioning(ready_to_run, incoming_edge_graph, outgoing_edge_graph,
-                              node_dict, edge_dict, dag_execution_status):
+                              node_dict, edge_dict, dag_execution_status, scheduler=None):
     modified = False
     for ready_node in ready_to_run:
         node_info = node_dict[ready_node]
@@ -809,6 +928,9 @@ def perform_node_partitioning(ready_to_run, incoming_edge_graph, outgoing_edge_g
         # Update edges
         perform_edge_split(ready_node, new_node_ids, edge_dict, node_dict,
                            incoming_edge_graph, outgoing_edge_graph)
+        dag_execution_status['nodes'].pop(ready_node, None)
+        if scheduler:
+            scheduler.split_node(ready_node, new_node_ids, outgoing_edge_graph)
     return modified
 
 def perform_edge_split(old_node, new_node_ids, edge_dict, node_dict, incoming_edge_graph, outgoing_edge_graph):
@@ -43,7 +43,7 @@ def release_row_lock(table, key):
         print ("Couldn't release lock")
         raise(ex)
 
-def force_release_row_lock(table, key):
+def force_release_row_lock(table, key, last_update_time=None):
     client = boto3.client('dynamodb')
     now = int(time.time())
     uxp = 'SET locked = :nolock, update_time = :ut'
@@ -52,42 +52,71 @@ def force_release_row_lock(table, key):
         ":nolock" : {"S" : "no"},
         ":ut": {"N":str(now)}
     }
+    kwargs = {}
+    if last_update_time is not None:
+        ##Only if nobody has taken or renewed the lock since it was found idle
+        kwargs['ConditionExpression'] = 'update_time = :lut'
+        eav[':lut'] = {"N": str(last_update_time)}
 
     try:
         client.update_item(TableName=table, Key=key, UpdateExpression=uxp,
-                           ExpressionAttributeValues=eav)
+                           ExpressionAttributeValues=eav, **kwargs)
         print("Force-released lock for key " + str(key) + " at " + str(now))
         return True
+    except client.exceptions.ConditionalCheckFailedException:
+        print("Lock for key " + str(key) + " is no longer idle")
+        return False
     except Exception as ex:
         print ("Couldn't release lock")
         raise(ex)
 
+def try_acquire_idle_row_lock(table, key, idle=120):
+    ### Acquire lock without waiting, force release it first if no updates for 'idle' number of seconds
+    if acquire_row_lock(table, key):
+        return True
+    last_update_time = get_update_time(table, key)
+    if int(time.time()) - last_update_time > idle:
+        print('Lock is idle, force release the lock.')
+        if force_release_row_lock(table, key, last_update_time):
+            return acquire_row_lock(table, key)
+    return False
+
+def is_row_locked(table, key, idle=120):
+    ### True if the lock is held and has been renewed in the last 'idle' seconds
+    client = boto3.client('dynamodb')
+    ret = client.get_item(TableName=table, Key=key, AttributesToGet=["locked", "update_time"],
+                          ConsistentRead=True)
+    item = ret['Item']
+    return item['locked']['S'] == 'yes' and int(time.time()) - int(item['update_time']['N']) <= idle
+
 def acquire_idle_row_lock(table, key, idle=120, max_wait=300):
     ### Acquire lock if no updates for 'idle' number of seconds
     if acquire_row_lock(table, key):
         return True
 
     total_wait_time = 0
-    sleep_time = 30
+    sleep_time = 5
     print('wait for lock to get released')
     while total_wait_time < max_wait:
         time.sleep(sleep_time)
+        ##The holder may have released it in the meantime
+        if acquire_row_lock(table, key):
+            return True
         last_update_time = get_update_time(table, key)
         now = int(time.time())
         if now - last_update_time > idle:
             print('Lock is idle, force release the lock.')
             print('last update time = ' + str(last_update_time) +", now = "+ str(now))
-            force_release_row_lock(table, key)
-            return acquire_row_lock(table, key)
-        else:
-            total_wait_time = total_wait_time+sleep_time
+            if force_release_row_lock(table, key, last_update_time):
+                return acquire_row_lock(table, key)
+        total_wait_time = total_wait_time+sleep_time
     ## Still no lock, give up
     print('Failed to acquire lock: give up')
     return False
 
 def get_update_time(table, key):
     client = boto3.client('dynamodb')
-    ret = client.get_item(TableName=table, Key=key, AttributesToGet=["update_time"])
+    ret = client.get_item(TableName=table, Key=key, AttributesToGet=["update_time"], ConsistentRead=True)
     return int(ret['Item']['update_time']['N'])
 
 def renew_lock(table, lock_key, lock_lease_time):
@@ -108,4 +137,27 @@ def renew_lock(table, lock_key, lock_lease_time):
             return now
         except Exception as ex:
             print("Couldn't renew lock")
-            raise (ex)
\ No newline at end of file
+            raise (ex)
+
+def claim_row_recheck(table, key, duration):
+    ### True if no other recheck of the row is pending, the claim lapses after 'duration' seconds
+    client = boto3.client('dynamodb')
+    now = int(time.time())
+    uxp = 'SET recheck_until = :until'
+    condition = 'attribute_not_exists(recheck_until) OR recheck_until < :now'
+    eav = {
+        ":until": {"N": str(now + duration)},
+        ":now": {"N": str(now)}
+    }
+    try:
+        client.update_item(TableName=table, Key=key, UpdateExpression=uxp,
+                           ConditionExpression=condition, ExpressionAttributeValues=eav)
+        print("Recheck claimed for key " + str(key) + " until " + str(now + duration))
+        return True
+    except client.exceptions.ConditionalCheckFailedException:
+        print("Recheck already pending for key " + str(key))
+        return False
+
+def clear_row_recheck(table, key):
+    client = boto3.client('dynamodb')
+    client.update_item(TableName=table, Key=key, UpdateExpression='REMOVE recheck_until')
@@ -0,0 +1,149 @@
+import os
+import time
+import threading
+import logging
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+##Connections kept open to the MLflow server by each client, enough for the parallel calls of one DAG step
+MLFLOW_CLIENT_POOL_SIZE = int(os.environ.get('MLFLOW_CLIENT_POOL_SIZE', 64))
+MLFLOW_CLIENT_TIMEOUT = int(os.environ.get('MLFLOW_CLIENT_TIMEOUT', 120))
+##MLflow server limits on params in one log-batch request, and on runs in one search page
+MAX_PARAMS_PER_BATCH = 100
+MAX_SEARCH_RESULTS = 1000
+
+MLFLOW_RUN_NAME = 'mlflow.runName'
+MLFLOW_SOURCE_NAME = 'mlflow.source.name'
+MLFLOW_SOURCE_TYPE = 'mlflow.source.type'
+MLFLOW_PARENT_RUN_ID = 'mlflow.parentRunId'
+
+
+class MlflowRestException(Exception):
+    pass
+
+
+def get_authorization_header(token):
+    ##infinstor custom tokens already carry their scheme, 'Custom <queue_message_uuid>:<token>'.
+    ##Plain tokens, e.g. MLFLOW_TRACKING_TOKEN, are bearer tokens
+    if token.startswith('Custom '):
+        return token
+    return 'Bearer ' + token
+
+
+class MlflowRestClient:
+    """
+    MLflow tracking REST client with a pool of keep-alive connections, safe to share
+    between threads. Sends the token the way mlflow's RestStore does for the tracking
+    uri's host, which is what the create_run.py etc. subprocesses did.
+    """
+    def __init__(self, host, token=None):
+        self.host = host.rstrip('/')
+        self.session = requests.Session()
+        ##Same retry policy as the mlflow client, POSTs included
+        retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['GET', 'POST']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MLFLOW_CLIENT_POOL_SIZE, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if token:
+            self.session.headers['Authorization'] = get_authorization_header(token)
+
+    def call(self, method, endpoint, json_body=None, params=None):
+        url = self.host + '/api/2.0/mlflow/' + endpoint
+        response = self.session.request(method, url, json=json_body, params=params,
+                                        timeout=MLFLOW_CLIENT_TIMEOUT)
+        if response.status_code != 200:
+            raise MlflowRestException('{0} {1} failed with status {2}: {3}'
+                                      .format(method, endpoint, response.status_code, response.text))
+        return response.json()
+
+    def create_run(self, experiment_id, tags=None):
+        tags = tags or {}
+        body = {'experiment_id': str(experiment_id),
+                'user_id': tags.get('mlflow.user', 'unknown'),
+                'start_time': int(time.time() * 1000),
+                'tags': [{'key': k, 'value': str(v)} for k, v in tags.items()]}
+        return self.call('POST', 'runs/create', body)['run']
+
+    def get_run(self, run_id):
+        return self.call('GET', 'runs/get', params={'run_id': run_id})['run']
+
+    def set_terminated(self, run_id, status):
+        body = {'run_id': run_id, 'run_uuid': run_id, 'status': status,
+                'end_time': int(time.time() * 1000)}
+        return self.call('POST', 'runs/update', body)
+
+    def search_runs(self, experiment_ids, filter_string):
+        runs = []
+        body = {'experiment_ids': [str(e) for e in experiment_ids], 'filter': filter_string,
+                'max_results': MAX_SEARCH_RESULTS}
+        while True:
+            response = self.call('POST', 'runs/search', body)
+            runs.extend(response.get('runs', []))
+            if not response.get('next_page_token'):
+                return runs
+            body['page_token'] = response['next_page_token']
+
+    def create_experiment(self, name):
+        return self.call('POST', 'experiments/create', {'name': name})['experiment_id']
+
+    def log_params(self, run_id, params):
+        items = [{'key': k, 'value': str(v)} for k, v in params.items()]
+        for i in range(0, len(items), MAX_PARAMS_PER_BATCH):
+            self.call('POST', 'runs/log-batch', {'run_id': run_id, 'params': items[i:i + MAX_PARAMS_PER_BATCH]})
+
+
+def get_run_info(run):
+    ##Same fields as printed by get_run_info.py
+    info = run['info']
+    run_info = {
+        'run_id': info.get('run_id', info.get('run_uuid')),
+        'artifact_uri': info.get('artifact_uri'),
+        'status': info.get('status'),
+        'lifecycle_stage': info.get('lifecycle_stage')
+    }
+    params = run.get('data', {}).get('params')
+    if params:
+        run_info['params'] = {p['key']: p['value'] for p in params}
+    return run_info
+
+
+##tracking uri -> https host of its MLflow server, and (tracking uri, token) -> MlflowRestClient,
+##kept for the life of the warm lambda container
+cached_tracking_hosts = dict()
+cached_clients = dict()
+clients_lock = threading.Lock()
+
+
+def get_tracking_host(tracking_uri):
+    parsed = urlparse(tracking_uri)
+    if parsed.scheme != 'infinstor':
+        return tracking_uri
+    with clients_lock:
+        if tracking_uri in cached_tracking_hosts:
+            return cached_tracking_hosts[tracking_uri]
+    ##The infinstor plugin's bootstrap: the server names its mlflow host relative to the uri's domain
+    url = 'https://' + parsed.hostname + '/api/2.0/mlflow/infinstor/get_version'
+    response = requests.get(url, headers={'Authorization': 'None'}, timeout=MLFLOW_CLIENT_TIMEOUT)
+    response.raise_for_status()
+    domain = parsed.hostname[parsed.hostname.index('.') + 1:]
+    host = 'https://' + response.json()['mlflowDnsName'] + '.' + domain + ':443'
+    logger.info('MLflow server for tracking uri ' + tracking_uri + ' is ' + host)
+    with clients_lock:
+        cached_tracking_hosts[tracking_uri] = host
+    return host
+
+
+def get_client(tracking_uri, token):
+    with clients_lock:
+        client = cached_clients.get((tracking_uri, token))
+    if client:
+        return client
+    client = MlflowRestClient(get_tracking_host(tracking_uri), token)
+    with clients_lock:
+        return cached_clients.setdefault((tracking_uri, token), client)
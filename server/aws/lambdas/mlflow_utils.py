@@ -5,11 +5,64 @@ import tempfile
 import subprocess
 import time
 import logging
+import threading
+import concurrent.futures
+from urllib.parse import urlparse
 from utils import get_custom_token
+import mlflow_rest_client
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+##Runs of one partitioned node created concurrently, and runs looked up concurrently
+CREATE_RUN_WORKERS = int(os.environ.get('CREATE_RUN_WORKERS', 16))
+FETCH_RUN_WORKERS = int(os.environ.get('FETCH_RUN_WORKERS', 16))
+##Run ids in the filter of one search_runs query
+SEARCH_RUN_IDS_PER_QUERY = 100
+
+##cognito username -> custom token info, reused until get_custom_token would replace the token.
+##Shared by the create and fetch worker threads. The lock guards the dicts only, the per user
+##lock keeps the threads from looking up a token for the same user at once
+cached_custom_tokens = dict()
+custom_token_user_locks = dict()
+cached_custom_tokens_lock = threading.Lock()
+CUSTOM_TOKEN_REFRESH_SECONDS = 60*60
+
+def get_cached_custom_token(cognito_username, groups):
+    with cached_custom_tokens_lock:
+        now = time.time()
+        for username in [u for u, t in cached_custom_tokens.items()
+                         if now > t['expiry'] - CUSTOM_TOKEN_REFRESH_SECONDS]:
+            del cached_custom_tokens[username]
+        token_info = cached_custom_tokens.get(cognito_username)
+        if token_info:
+            return token_info
+        user_lock = custom_token_user_locks.setdefault(cognito_username, threading.Lock())
+    with user_lock:
+        ##Another thread may have looked it up while we waited
+        with cached_custom_tokens_lock:
+            token_info = cached_custom_tokens.get(cognito_username)
+        if not token_info:
+            ##DynamoDB lookup, outside the lock so that other users' threads are not held up
+            token_info = get_custom_token(cognito_username, groups)
+            with cached_custom_tokens_lock:
+                cached_custom_tokens[cognito_username] = token_info
+        return token_info
+
+def get_custom_token_string(cognito_username, groups):
+    token_info = get_cached_custom_token(cognito_username, groups)
+    return "Custom {0}:{1}".format(token_info['queue_message_uuid'], token_info['token'])
+
+def get_mlflow_client(cognito_username, groups, auth_info):
+    """ in-process client for the tracking server the subprocesses would have used, with the same credentials """
+    tracking_uri = auth_info.get('mlflow_tracking_uri') or os.environ.get('MLFLOW_TRACKING_URI')
+    if urlparse(tracking_uri).scheme == 'infinstor':
+        ##The infinstor plugin authenticates with the custom token written to the token file
+        token = get_custom_token_string(cognito_username, groups)
+    else:
+        token = auth_info.get('mlflow_tracking_token') or os.environ.get('MLFLOW_TRACKING_TOKEN')
+    return mlflow_rest_client.get_client(tracking_uri, token)
+
 def setup_for_subprocess(cognito_username, groups, auth_info):
     modified_env = dict(os.environ)
     if 'mlflow_concurrent_uri' in auth_info and auth_info['mlflow_concurrent_uri']:
@@ -21,10 +74,7 @@ def setup_for_subprocess(cognito_username, groups, auth_info):
     modified_env['PYTHONPATH'] = os.environ['PYTHONPATH'] + ':/opt/python'
     tmphome = tempfile.mkdtemp()
     modified_env['HOME'] = tmphome
-    token_info = get_custom_token(cognito_username, groups)
-    queue_message_uuid = token_info['queue_message_uuid']
-    token = token_info['token']
-    custom_token = "Custom {0}:{1}".format(queue_message_uuid, token)
+    custom_token = get_custom_token_string(cognito_username, groups)
     os.makedirs(os.path.join(tmphome, ".concurrent"), exist_ok=True)
     with open(os.path.join(tmphome, ".concurrent", "token"), 'w') as fl:
         fl.write('Token=' + custom_token + '\n')
@@ -33,101 +83,107 @@ def setup_for_subprocess(cognito_username, groups, auth_info):
 
 def call_create_run(cognito_username, groups, experiment_id, auth_info, run_name=None,
                     parent_run_id=None, source_name=None, tags=None):
-    cmd = [sys.executable, os.getcwd() + '/create_run.py', '--experiment_id', str(experiment_id)]
-    if tags:
-        cmd.extend(['--tags', json.dumps(tags)])
-
+    run_tags = {}
     if run_name:
-        cmd.append('--run_name')
-        cmd.append(run_name)
+        run_tags[mlflow_rest_client.MLFLOW_RUN_NAME] = run_name
     if parent_run_id:
-        cmd.append('--parent_run_id')
-        cmd.append(parent_run_id)
+        run_tags[mlflow_rest_client.MLFLOW_PARENT_RUN_ID] = parent_run_id
+        run_tags[mlflow_rest_client.MLFLOW_SOURCE_TYPE] = 'PROJECT'
     if source_name:
-        cmd.append('--source_name')
-        cmd.append(source_name)
-
-    modified_env = setup_for_subprocess(cognito_username, groups, auth_info)
+        run_tags[mlflow_rest_client.MLFLOW_SOURCE_NAME] = source_name
+    if tags:
+        run_tags.update(tags)
 
-    run_id = None
-    artifact_uri = None
-    status = None
-    lifecycle_stage = None
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=modified_env)
-    full_out = ''
-    for line in proc.stdout:
-        fline = line.rstrip().decode("utf-8")
-        full_out = full_out + fline + '\n'
-    proc.wait()
-    if proc.returncode != 0:
-        print('Error calling create_run.py=' + full_out)
+    try:
+        client = get_mlflow_client(cognito_username, groups, auth_info)
+        run = mlflow_rest_client.get_run_info(client.create_run(experiment_id, tags=run_tags))
+    except Exception as ex:
+        print('Error creating run=' + str(ex))
         return None, None, None, None
-    else:
-        run = json.loads(full_out)
-        run_id = run['run_id']
-        artifact_uri = run['artifact_uri']
-        status = run['status']
-        lifecycle_stage = run['lifecycle_stage']
-        logger.debug('call_create_run: returning run_id=' +str(run_id)
-                +', artifact_uri=' +str(artifact_uri) +', status=' +str(status)
-                +', lifecycle_stage=' +str(lifecycle_stage))
-        return run_id, artifact_uri, status, lifecycle_stage
+    run_id = run['run_id']
+    artifact_uri = run['artifact_uri']
+    status = run['status']
+    lifecycle_stage = run['lifecycle_stage']
+    logger.debug('call_create_run: returning run_id=' +str(run_id)
+            +', artifact_uri=' +str(artifact_uri) +', status=' +str(status)
+            +', lifecycle_stage=' +str(lifecycle_stage))
+    return run_id, artifact_uri, status, lifecycle_stage
+
+def call_create_runs(cognito_username, groups, experiment_id, auth_info, run_names,
+                     parent_run_id=None, source_name=None, tags=None):
+    """ creates a run for each run name concurrently, returns the run infos of call_create_run in the same order """
+    if not run_names:
+        return []
+    try:
+        ##Look up the token and create the shared client once, before the workers use it
+        get_mlflow_client(cognito_username, groups, auth_info)
+    except Exception as ex:
+        print('Error creating runs=' + str(ex))
+        return [(None, None, None, None)] * len(run_names)
+    num_workers = min(CREATE_RUN_WORKERS, len(run_names))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(lambda run_name: call_create_run(cognito_username, groups, experiment_id, auth_info,
+                                                                  run_name, parent_run_id, source_name, tags),
+                                 run_names))
 
 def update_run(cognito_username, groups, auth_info, run_id, state):
-    cmd = [sys.executable, os.getcwd() + '/update_run.py', '--run_id', str(run_id),
-            '--state', str(state)]
-    modified_env = setup_for_subprocess(cognito_username, groups, auth_info)
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=modified_env)
-    full_out = ''
-    for line in proc.stdout:
-        fline = line.rstrip().decode("utf-8")
-        full_out = full_out + fline + '\n'
-    proc.wait()
-    if proc.returncode != 0:
-        print('Error calling update_run.py=' + full_out)
+    try:
+        client = get_mlflow_client(cognito_username, groups, auth_info)
+        client.set_terminated(str(run_id), str(state))
+    except Exception as ex:
+        print('Error updating run=' + str(ex))
 
 def fetch_run_id_info(cognito_username, groups, auth_info, run_id):
-    cmd = [sys.executable, os.getcwd() + '/get_run_info.py', '--run_id', str(run_id)]
-    modified_env = setup_for_subprocess(cognito_username, groups, auth_info)
-
-    run_id = None
-    artifact_uri = None
-    status = None
-    lifecycle_stage = None
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=modified_env)
-    full_out = ''
-    for line in proc.stdout:
-        fline = line.rstrip().decode("utf-8")
-        full_out = full_out + fline + '\n'
-    proc.wait()
-    if proc.returncode != 0:
-        print('Error calling get_run_info.py=' + full_out)
+    try:
+        client = get_mlflow_client(cognito_username, groups, auth_info)
+        run = mlflow_rest_client.get_run_info(client.get_run(str(run_id)))
+    except Exception as ex:
+        print('Error getting run info=' + str(ex))
         return None
-    else:
-        run = json.loads(full_out)
-        logger.debug('fetch_run_id_info: returning run_id=' +str(run['run_id'])
-                +', artifact_uri=' +str(run['artifact_uri']) +', status=' +str(run['status'])
-                +', lifecycle_stage=' +str(run['lifecycle_stage']))
-        return run
+    logger.debug('fetch_run_id_info: returning run_id=' +str(run['run_id'])
+            +', artifact_uri=' +str(run['artifact_uri']) +', status=' +str(run['status'])
+            +', lifecycle_stage=' +str(run['lifecycle_stage']))
+    return run
+
+def fetch_run_id_infos(cognito_username, groups, auth_info, run_ids):
+    """ fetch_run_id_info for each run id concurrently, returns run id -> run info, None if the lookup failed """
+    if not run_ids:
+        return {}
+    try:
+        ##Look up the token and create the shared client once, before the workers use it
+        get_mlflow_client(cognito_username, groups, auth_info)
+    except Exception as ex:
+        print('Error getting run info=' + str(ex))
+        return {run_id: None for run_id in run_ids}
+    num_workers = min(FETCH_RUN_WORKERS, len(run_ids))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        run_infos = executor.map(lambda run_id: fetch_run_id_info(cognito_username, groups, auth_info, run_id), run_ids)
+        return dict(zip(run_ids, run_infos))
+
+def fetch_child_run_infos(cognito_username, groups, auth_info, parent_run_id, run_ids):
+    """ run id -> run info of the given child runs of parent_run_id, with one search query per SEARCH_RUN_IDS_PER_QUERY runs """
+    client = get_mlflow_client(cognito_username, groups, auth_info)
+    experiment_id = get_experiment_id_from_run_id(parent_run_id)
+    run_ids = sorted(set(run_ids))
+    run_infos = dict()
+    for i in range(0, len(run_ids), SEARCH_RUN_IDS_PER_QUERY):
+        ##Only the launched runs, earlier child runs of the parent are not returned
+        filter_string = "tags.mlflow.parentRunId = '{0}' and attributes.run_id IN ({1})".format(
+            parent_run_id, ', '.join("'" + run_id + "'" for run_id in run_ids[i:i + SEARCH_RUN_IDS_PER_QUERY]))
+        for run in client.search_runs([experiment_id], filter_string):
+            run_info = mlflow_rest_client.get_run_info(run)
+            run_infos[run_info['run_id']] = run_info
+    return run_infos
 
 def create_experiment(cognito_username, groups, auth_info, experiment_name):
-    cmd = [sys.executable, os.getcwd() + '/create_experiment.py',
-            '--experiment_name', str(experiment_name)]
-    modified_env = setup_for_subprocess(cognito_username, groups, auth_info)
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=modified_env)
-    full_out = ''
-    for line in proc.stdout:
-        fline = line.rstrip().decode("utf-8")
-        full_out = full_out + fline + '\n'
-    proc.wait()
-    if proc.returncode != 0:
-        print('Error calling create_experiment.py=' + full_out)
+    try:
+        client = get_mlflow_client(cognito_username, groups, auth_info)
+        experiment_id = client.create_experiment(str(experiment_name))
+    except Exception as ex:
+        print('Error creating experiment=' + str(ex))
         return None
-    else:
-        run = json.loads(full_out)
-        experiment_id = run['experiment_id']
-        print('call_create_experiment: returning experiment_id=' +str(experiment_id))
-        return experiment_id
+    print('call_create_experiment: returning experiment_id=' +str(experiment_id))
+    return experiment_id
 
 def log_mlflow_artifact(cognito_username, groups, auth_info, run_id, artifact_object, path, file_name):
     modified_env = setup_for_subprocess(cognito_username, groups, auth_info)
@@ -180,17 +236,12 @@ def fetch_mlflow_artifact_file(cognito_username, groups, auth_info, run_id, arti
 
 
 def log_params(cognito_username, groups, auth_info, run_id, params):
-    cmd = [sys.executable, os.getcwd() + '/log_params.py',
-            '--run_id', run_id, '--params', json.dumps(params)]
-    modified_env = setup_for_subprocess(cognito_username, groups, auth_info)
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=modified_env)
-    full_out = ''
-    for line in proc.stdout:
-        fline = line.rstrip().decode("utf-8")
-        full_out = full_out + fline + '\n'
-    proc.wait()
-    if proc.returncode != 0:
-        print('Error calling log_params.py=' + full_out)
+    print("Logging params: ", params, "run_id: ", run_id)
+    try:
+        client = get_mlflow_client(cognito_username, groups, auth_info)
+        client.log_params(run_id, params)
+    except Exception as ex:
+        print('Error logging params=' + str(ex))
         raise Exception('log_params failed')
 
 
@@ -146,6 +146,8 @@ def update_dag_execution_info(cognito_username, dag_id, dag_execution_id, dag_ex
 
     ##Update the original graph
     new_dag_exec_status = copy.deepcopy(dag_execution_status)
+    ##The graph changes under the scheduler, execute_dag rebuilds its state from the node statuses
+    new_dag_exec_status.pop('scheduler', None)
 
     for nodeid in direct_nodes_to_split:
         old_input_spec = node_dict[nodeid]['input']